@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the spatial index used by the View.
+
+The diagrams are simulated: a number of small boxes and a number of long
+connectors, spread over a large area. Run with the name of a benchmark
+to run only that one::
+
+    $ python benchmark.py connectors
+"""
+
+__version__ = "$Revision$"
+# $HeadURL$
+
+import sys
+import random
+from timeit import default_timer as clock
+
+from gaphas.quadtree import Quadtree
+
+try:
+    from gaphas.arrayindex import ArrayIndex
+except ImportError:
+    ArrayIndex = None
+
+
+SIZE = 2000
+
+
+def diagram(n_boxes, n_lines, size=SIZE, seed=0):
+    """
+    Create a list of (item, bounds) tuples.
+    """
+    r = random.Random(seed)
+    items = []
+    for i in xrange(n_boxes):
+        items.append(('box%d' % i, (r.uniform(0, size - 100), r.uniform(0, size - 60), 100, 60)))
+    for i in xrange(n_lines):
+        x0, y0 = r.uniform(0, size), r.uniform(0, size)
+        x1, y1 = r.uniform(0, size), r.uniform(0, size)
+        items.append(('line%d' % i, (min(x0, x1), min(y0, y1), abs(x1 - x0), abs(y1 - y0) + 4)))
+    return items
+
+
+def timed(func, *args):
+    start = clock()
+    func(*args)
+    return clock() - start
+
+
+def bench_queries(qtree, items, n_queries=2000, size=SIZE, seed=1):
+    r = random.Random(seed)
+    rects = [(r.uniform(0, size), r.uniform(0, size), 1, 1) for i in xrange(n_queries)]
+    def add():
+        for item, bounds in items:
+            qtree.add(item, bounds)
+    def query():
+        for rect in rects:
+            qtree.find_intersect(rect)
+    return timed(add), timed(query)
+
+
+def connectors():
+    """
+    Compare a regular and a loose quadtree on diagrams with an increasing
+    amount of long connectors.
+    """
+    print '%-10s %-10s %12s %12s %14s' % ('lines', 'looseness', 'insert (s)', 'query (s)', 'root items')
+    for n_lines in (0, 250, 1000, 4000):
+        items = diagram(2000, n_lines)
+        for looseness in (1.0, 2.0):
+            qtree = Quadtree((0, 0, SIZE, SIZE), looseness=looseness)
+            t_add, t_query = bench_queries(qtree, items)
+            print '%-10d %-10.1f %12.4f %12.4f %14d' % (n_lines, looseness, t_add, t_query, len(qtree._bucket.items))
+
+
+def editing():
+    """
+    Query cost and tree structure after heavy editing: most items are
+    moved around and removed again.
+    """
+    print '%-10s %12s %8s %10s %12s' % ('autotune', 'query (s)', 'depth', 'buckets', 'capacity')
+    for autotune in (False, True):
+        r = random.Random(2)
+        items = diagram(5000, 0)
+        qtree = Quadtree((0, 0, SIZE, SIZE), autotune=autotune)
+        for item, bounds in items:
+            qtree.add(item, bounds)
+        for item, bounds in items:
+            qtree.add(item, (r.uniform(0, 200), r.uniform(0, 200), 10, 10))
+        for item, bounds in items[500:]:
+            qtree.remove(item)
+        t_add, t_query = bench_queries(qtree, [])
+        stats = qtree.stats()
+        print '%-10s %12.4f %8d %10d %12d' % (autotune, t_query, stats['depth'], stats['buckets'], stats['capacity'])
+
+
+def tuning():
+    """
+    Rectangle queries (the size of a window) on a dense diagram in a loose
+    quadtree, with the
+    default capacity and with auto-tuning.
+    """
+    size = 3 * SIZE
+    items = diagram(10000, 0, size=size)
+    r = random.Random(4)
+    rects = [(r.uniform(0, size), r.uniform(0, size), 1500, 1000) for i in xrange(6000)]
+    print '%-10s %12s %8s %10s %12s' % ('autotune', 'query (s)', 'depth', 'buckets', 'capacity')
+    for autotune in (False, True):
+        qtree = Quadtree((0, 0, size, size), looseness=2.0, autotune=autotune)
+        for item, bounds in items:
+            qtree.add(item, bounds)
+        def query():
+            for rect in rects:
+                qtree.find_intersect(rect)
+        # Warm up: give the tree a few tuning rounds
+        query()
+        stats = qtree.stats()
+        print '%-10s %12.4f %8d %10d %12d' % (autotune, timed(query), stats['depth'], stats['buckets'], stats['capacity'])
+
+
+def indexes():
+    """
+    Compare the Quadtree and the ArrayIndex (if NumPy is available) on
+    diagrams of 1k, 10k and 100k items: insertion, point and rectangle
+    queries and moving 10% of the items.
+    """
+    factories = [('quadtree', lambda: Quadtree(grow=True))]
+    if ArrayIndex:
+        factories.append(('array', ArrayIndex))
+    print '%-8s %-10s %12s %12s %12s %12s' % ('items', 'index', 'insert (s)', 'point (s)', 'rect (s)', 'move (s)')
+    for n in (1000, 10000, 100000):
+        size = int(SIZE * (n / 1000.) ** .5)
+        items = diagram(n * 9 / 10, n / 10, size=size)
+        r = random.Random(3)
+        points = [(r.uniform(0, size), r.uniform(0, size)) for i in xrange(2000)]
+        rects = [(x, y, 400, 300) for x, y in points]
+        moves = [(item, (x + 10, y + 10, w, h)) for item, (x, y, w, h) in items[::10]]
+        for name, factory in factories:
+            index = factory()
+            def add(items):
+                for item, bounds in items:
+                    index.add(item, bounds)
+            def find_point():
+                for x, y in points:
+                    index.find_point(x, y)
+            def find_intersect():
+                for rect in rects:
+                    index.find_intersect(rect)
+            print '%-8d %-10s %12.4f %12.4f %12.4f %12.4f' % (n, name, timed(add, items),
+                    timed(find_point), timed(find_intersect), timed(add, moves))
+
+
+BENCHMARKS = {
+    'connectors': connectors,
+    'editing': editing,
+    'indexes': indexes,
+    'tuning': tuning,
+}
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or sorted(BENCHMARKS):
+        print '==', name
+        BENCHMARKS[name]()
+
+# vim: sw=4:et:ai
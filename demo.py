@@ -10,7 +10,7 @@ It sports a small canvas and some trivial operations:
  - Delete focused item
  - Record state changes
  - Play back state changes (= undo !) With visual updates
- - Exports to SVG and PNG
+ - Exports to SVG, PDF and PNG
 
 """
 
@@ -26,12 +26,12 @@ else:
 
 import math
 import gtk
-import cairo
-from gaphas import Canvas, GtkView, View
+from gaphas import Canvas, GtkView
 from gaphas.examples import Box, PortoBox, Text, FatLine, Circle
 from gaphas.item import Line, NW, SE
 from gaphas.tool import PlacementTool, HandleTool
 from gaphas.segment import Segment
+from gaphas.export import Exporter
 import gaphas.guide
 from gaphas.painter import PainterChain, ItemPainter, HandlePainter, FocusedItemPainter, ToolPainter, BoundingBoxPainter
 from gaphas import state
@@ -235,27 +235,7 @@ def create_window(canvas, title, zoom=1.0):
     b = gtk.Button('Write demo.png')
 
     def on_clicked(button):
-        svgview = View(view.canvas)
-        svgview.painter = ItemPainter()
-
-        # Update bounding boxes with a temporaly CairoContext
-        # (used for stuff like calculating font metrics)
-        tmpsurface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 0, 0)
-        tmpcr = cairo.Context(tmpsurface)
-        svgview.update_bounding_box(tmpcr)
-        tmpcr.show_page()
-        tmpsurface.flush()
-       
-        w, h = svgview.bounding_box.width, svgview.bounding_box.height
-        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, int(w), int(h))
-        cr = cairo.Context(surface)
-        svgview.matrix.translate(-svgview.bounding_box.x, -svgview.bounding_box.y)
-        cr.save()
-        svgview.paint(cr)
-
-        cr.restore()
-        cr.show_page()
-        surface.write_to_png('demo.png')
+        Exporter(view.canvas).write_png('demo.png')
 
     b.connect('clicked', on_clicked)
     v.add(b)
@@ -263,25 +243,15 @@ def create_window(canvas, title, zoom=1.0):
     b = gtk.Button('Write demo.svg')
 
     def on_clicked(button):
-        svgview = View(view.canvas)
-        svgview.painter = ItemPainter()
-
-        # Update bounding boxes with a temporaly CairoContext
-        # (used for stuff like calculating font metrics)
-        tmpsurface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 0, 0)
-        tmpcr = cairo.Context(tmpsurface)
-        svgview.update_bounding_box(tmpcr)
-        tmpcr.show_page()
-        tmpsurface.flush()
-       
-        w, h = svgview.bounding_box.width, svgview.bounding_box.height
-        surface = cairo.SVGSurface('demo.svg', w, h)
-        cr = cairo.Context(surface)
-        svgview.matrix.translate(-svgview.bounding_box.x, -svgview.bounding_box.y)
-        svgview.paint(cr)
-        cr.show_page()
-        surface.flush()
-        surface.finish()
+        Exporter(view.canvas).write_svg('demo.svg')
+
+    b.connect('clicked', on_clicked)
+    v.add(b)
+
+    b = gtk.Button('Write demo.pdf')
+
+    def on_clicked(button):
+        Exporter(view.canvas).write_pdf('demo.pdf')
 
     b.connect('clicked', on_clicked)
     v.add(b)
@@ -0,0 +1,349 @@
+"""
+Array index
+===========
+
+A flat spatial index, with the same interface as `gaphas.quadtree.Quadtree`.
+Bounds are stored in NumPy arrays and queries are answered with vectorized
+comparisons, instead of walking a tree. For large diagrams this is
+considerably faster than the (pure Python) Quadtree.
+
+Items are kept in a snapshot. The snapshot is split up in classes of items
+of similar width (powers of two), each sorted on the left side (x0) of the
+items. A rectangle query only tests the slices of the snapshot that can
+possibly intersect with the rectangle, so a few long lines do not slow down
+queries for all the small items. Items that are added or moved after the snapshot was
+taken are kept in a pending set, which is tested as a whole. Once the
+pending set becomes too large, a new snapshot is taken.
+
+This module requires NumPy.
+"""
+
+__version__ = "$Revision$"
+# $HeadURL$
+
+import numpy
+
+
+class ArrayIndex(object):
+    """
+    Array backed spatial index.
+
+    Rectangles use the same scheme throughout Gaphas: (x, y, width, height).
+
+    >>> index = ArrayIndex()
+    >>> for i in range(20):
+    ...     index.add('%d' % i, ((i * 4) % 90, (i * 10) % 90, 10, 10))
+    >>> len(index)
+    20
+    >>> sorted(index.find_inside((40, 40, 40, 40)))
+    ['13', '14', '15', '16']
+    >>> sorted(index.find_intersect((40, 40, 20, 20)))
+    ['12', '13', '14', '15']
+    >>> index.remove('13')
+    >>> sorted(index.find_intersect((40, 40, 20, 20)))
+    ['12', '14', '15']
+
+    The index is not bounded:
+
+    >>> index.add('far', (-1000, -1000, 10, 10))
+    >>> index.find_point(-995, -995)
+    set(['far'])
+    """
+
+    # Minimum number of pending items before a new snapshot is taken
+    MIN_PENDING = 64
+
+    def __init__(self, bounds=(0, 0, 0, 0), capacity=64):
+        """
+        Create a new index. ``bounds`` is kept for compatibility with the
+        Quadtree: the index is not limited to its bounds.
+
+        Capacity is the initial size of the arrays. The arrays grow as
+        needed.
+        """
+        self._bounds = bounds
+
+        # Item -> (bounds, data, slot) mapping
+        self._ids = dict()
+
+        # Slot -> item
+        self._items = [None] * capacity
+        self._free = range(capacity - 1, -1, -1)
+
+        # (x0, y0, x1, y1) per slot
+        self._rects = numpy.zeros((capacity, 4))
+        self._alive = numpy.zeros(capacity, dtype=bool)
+
+        # Snapshot: (slots, sorted x0, max width) per width class
+        self._snapshot = []
+        self._stale = numpy.zeros(capacity, dtype=bool)
+        self._pending = set()
+
+
+    bounds = property(lambda s: s._bounds)
+
+
+    def resize(self, bounds):
+        """
+        Set the bounds. The index itself is not affected.
+        """
+        self._bounds = bounds
+
+
+    def get_soft_bounds(self):
+        """
+        Calculate the size of all items in the index.
+
+        Returns a tuple (x, y, width, height).
+
+        >>> index = ArrayIndex()
+        >>> index.add('1', (10, 20, 30, 40))
+        >>> index.add('2', (20, 30, 40, 10))
+        >>> index.soft_bounds
+        (10.0, 20.0, 50.0, 40.0)
+        """
+        rects = self._rects[self._alive]
+        if not len(rects):
+            return 0, 0, 0, 0
+        x0, y0 = rects[:, 0].min(), rects[:, 1].min()
+        x1, y1 = rects[:, 2].max(), rects[:, 3].max()
+        return (float(x0), float(y0), float(x1 - x0), float(y1 - y0))
+
+    soft_bounds = property(get_soft_bounds)
+
+
+    def _grow(self):
+        """
+        Double the size of the arrays.
+        """
+        size = len(self._items)
+        self._items.extend([None] * size)
+        self._free.extend(range(2 * size - 1, size - 1, -1))
+        self._rects = numpy.concatenate((self._rects, numpy.zeros((size, 4))))
+        self._alive = numpy.concatenate((self._alive, numpy.zeros(size, dtype=bool)))
+        self._stale = numpy.concatenate((self._stale, numpy.zeros(size, dtype=bool)))
+
+
+    def add(self, item, bounds, data=None):
+        """
+        Add an item to the index.
+        If an item already exists, its bounds are updated.
+        Data can be used to add some extra info to the item
+        """
+        if item in self._ids:
+            slot = self._ids[item][2]
+        else:
+            if not self._free:
+                self._grow()
+            slot = self._free.pop()
+            self._items[slot] = item
+            self._alive[slot] = True
+
+        x, y, w, h = bounds
+        self._rects[slot] = (x, y, x + w, y + h)
+        self._ids[item] = (bounds, data, slot)
+
+        self._stale[slot] = True
+        pending = self._pending
+        pending.add(slot)
+        if len(pending) > max(self.MIN_PENDING, len(self._ids) / 8):
+            self.rebuild()
+
+
+    def remove(self, item):
+        """
+        Remove an item from the index.
+        """
+        bounds, data, slot = self._ids.pop(item)
+        self._items[slot] = None
+        self._alive[slot] = False
+        self._pending.discard(slot)
+        self._free.append(slot)
+
+
+    def clear(self):
+        """
+        Remove all items from the index.
+        """
+        self._ids.clear()
+        capacity = len(self._items)
+        self._items = [None] * capacity
+        self._free = range(capacity - 1, -1, -1)
+        self._alive[:] = False
+        self._stale[:] = False
+        self._pending.clear()
+        self._snapshot = []
+
+
+    def rebuild(self):
+        """
+        Take a new snapshot of the index.
+        """
+        slots = numpy.flatnonzero(self._alive)
+        rects = self._rects[slots]
+        widths = rects[:, 2] - rects[:, 0]
+        classes = numpy.ceil(numpy.log2(widths + 1)).astype(int)
+        snapshot = []
+        for c in numpy.unique(classes):
+            mask = classes == c
+            class_slots, x0 = slots[mask], rects[mask, 0]
+            order = numpy.argsort(x0, kind='mergesort')
+            snapshot.append((class_slots[order], x0[order], float(widths[mask].max())))
+        self._snapshot = snapshot
+        self._stale[:] = False
+        self._pending.clear()
+
+
+    def get_bounds(self, item):
+        """
+        Return the bounding box for the given item.
+        """
+        return self._ids[item][0]
+
+
+    def get_data(self, item):
+        """
+        Return the data for the given item, None if no data was provided.
+        """
+        return self._ids[item][1]
+
+
+    def get_clipped_bounds(self, item):
+        """
+        Return the bounding box for the given item. Bounds are never clipped.
+        """
+        return self._ids[item][0]
+
+
+    def _candidates(self, x0, x1):
+        """
+        Return the slots of items that may intersect with the vertical
+        strip x0..x1.
+        """
+        found = []
+        for slots, sorted_x0, max_width in self._snapshot:
+            lo = sorted_x0.searchsorted(x0 - max_width, 'left')
+            hi = sorted_x0.searchsorted(x1, 'right')
+            if lo < hi:
+                found.append(slots[lo:hi])
+        if found:
+            slots = numpy.concatenate(found)
+            slots = slots[~self._stale[slots] & self._alive[slots]]
+            found = [slots]
+        if self._pending:
+            pending = self._pending
+            found.append(numpy.fromiter(pending, dtype=int, count=len(pending)))
+        if not found:
+            return numpy.zeros(0, dtype=int)
+        return numpy.concatenate(found)
+
+
+    def _found(self, slots):
+        items = self._items
+        return set(items[i] for i in slots)
+
+
+    def find_inside(self, rect):
+        """
+        Find all items in the given rectangle (x, y, with, height).
+        Returns a set.
+        """
+        x, y, w, h = rect
+        x1, y1 = x + w, y + h
+        slots = self._candidates(x, x1)
+        r = self._rects[slots]
+        mask = (r[:, 0] >= x) & (r[:, 1] >= y) & (r[:, 2] <= x1) & (r[:, 3] <= y1)
+        return self._found(slots[mask])
+
+
+    def find_intersect(self, rect):
+        """
+        Find all items that intersect with the given rectangle
+        (x, y, width, height).
+        Returns a set.
+        """
+        x, y, w, h = rect
+        x1, y1 = x + w, y + h
+        slots = self._candidates(x, x1)
+        r = self._rects[slots]
+        mask = (r[:, 0] <= x1) & (r[:, 2] >= x) & (r[:, 1] <= y1) & (r[:, 3] >= y)
+        return self._found(slots[mask])
+
+
+    def find_point(self, x, y):
+        """
+        Find all items whose bounds contain the point (x, y).
+        Returns a set.
+        """
+        return self.find_intersect((x, y, 0, 0))
+
+
+    def find_nearest(self, x, y, k=1, max_distance=None):
+        """
+        Find the ``k`` items nearest to the point (x, y). See
+        `Quadtree.find_nearest()`.
+
+        >>> index = ArrayIndex()
+        >>> index.add('a', (10, 10, 10, 10))
+        >>> index.add('b', (50, 10, 10, 10))
+        >>> index.add('c', (80, 80, 10, 10))
+        >>> index.find_nearest(40, 15, k=2)
+        ['b', 'a']
+        >>> index.find_nearest(40, 15, k=None, max_distance=15)
+        ['b']
+        """
+        found = [item for distance, item in self.iter_nearest(x, y, max_distance)]
+        return k and found[:k] or found
+
+
+    def iter_nearest(self, x, y, max_distance=None):
+        """
+        Iterate the items near the point (x, y), nearest first. Tuples
+        (distance, item) are returned.
+
+        >>> index = ArrayIndex()
+        >>> index.add('a', (10, 10, 10, 10))
+        >>> index.add('b', (50, 10, 10, 10))
+        >>> list(index.iter_nearest(40, 15))
+        [(10.0, 'b'), (20.0, 'a')]
+        """
+        if max_distance is None:
+            slots = numpy.flatnonzero(self._alive)
+        else:
+            slots = self._candidates(x - max_distance, x + max_distance)
+        r = self._rects[slots]
+        dx = numpy.maximum(numpy.maximum(r[:, 0] - x, x - r[:, 2]), 0)
+        dy = numpy.maximum(numpy.maximum(r[:, 1] - y, y - r[:, 3]), 0)
+        distances = numpy.sqrt(dx * dx + dy * dy)
+        if max_distance is not None:
+            mask = distances <= max_distance
+            slots, distances = slots[mask], distances[mask]
+        order = numpy.argsort(distances, kind='mergesort')
+        items = self._items
+        for i in order:
+            yield float(distances[i]), items[slots[i]]
+
+
+    def __len__(self):
+        """
+        Return number of items in the index.
+        """
+        return len(self._ids)
+
+
+    def __contains__(self, item):
+        """
+        Check if an item is in the index.
+        """
+        return item in self._ids
+
+
+    def dump(self):
+        """
+        Print the index to stdout.
+        """
+        for item, (bounds, data, slot) in sorted(self._ids.iteritems()):
+            print slot, item, bounds
+
+
+# vim:sw=4:et:ai
@@ -354,4 +354,50 @@ class ItemPaintFocused(object):
 PaintFocused = generic(ItemPaintFocused)
 
 
+class ItemLevelOfDetail(object):
+    """
+    Draws an item in less detail, when the view is zoomed out (see
+    gaphas.painter.ItemPainter). If the scale from item to view coordinates
+    is below ``threshold``, ``draw()`` is called instead of the item's
+    own ``draw()`` method. Below ``handle_threshold`` the handles of the
+    item are not drawn (see gaphas.painter.HandlePainter). Levels of detail
+    are only considered if the view is scaled below 1.0.
+
+    Levels of detail are off by default: both thresholds are 0. Set them
+    on this class, or on an aspect registered for an item type, to turn
+    them on. Thresholds are looked up once per item type for each frame
+    painted.
+
+    By default the outline of the item's bounding box is drawn.
+    """
+
+    threshold = 0
+
+    handle_threshold = 0
+
+    def __init__(self, item, view):
+        self.item = item
+        self.view = view
+
+    def draw(self, context):
+        """
+        Draw the item. Like ``Item.draw()``, the cairo context is set up
+        for item coordinates.
+        """
+        cairo = context.cairo
+        cairo.save()
+        try:
+            cairo.set_matrix(self.view.matrix)
+            cairo.rectangle(*self.view.get_canvas_bounding_box(self.item))
+            cairo.identity_matrix()
+            cairo.set_source_rgb(.5, .5, .5)
+            cairo.set_line_width(1.0)
+            cairo.stroke()
+        finally:
+            cairo.restore()
+
+
+LevelOfDetail = generic(ItemLevelOfDetail)
+
+
 # vim:sw=4:et:ai
@@ -92,6 +92,8 @@ class Canvas(object):
         self._tree = tree.Tree()
         self._solver = solver.Solver()
         self._connections = table.Table(Connection, range(4))
+        # handle -> Connection, for get_connection()
+        self._handle_connections = {}
         self._dirty_items = set()
         self._dirty_matrix_items = set()
         self._dirty_index = False
@@ -324,6 +326,7 @@ class Canvas(object):
             raise ConnectionError('Handle %r of item %r is already connected' % (handle, item))
 
         self._connections.insert(item, handle, connected, port, constraint, callback)
+        self._handle_connections[handle] = Connection(item, handle, connected, port, constraint, callback)
 
         if constraint:
             self._solver.add_constraint(constraint)
@@ -352,6 +355,7 @@ class Canvas(object):
             callback()
 
         self._connections.delete(item, handle, connected, port, constraint, callback)
+        self._handle_connections.pop(handle, None)
 
     reversible_pair(connect_item, _disconnect_item)
 
@@ -426,7 +430,10 @@ class Canvas(object):
             self._solver.remove_constraint(cinfo.constraint)
         self._connections.delete(item=cinfo.item, handle=cinfo.handle)
 
+        self._handle_connections.pop(cinfo.handle, None)
+
         self._connections.insert(item, handle, cinfo.connected, cinfo.port, constraint, cinfo.callback)
+        self._handle_connections[handle] = Connection(item, handle, cinfo.connected, cinfo.port, constraint, cinfo.callback)
         if constraint:
             self._solver.add_constraint(constraint)
 
@@ -436,7 +443,9 @@ class Canvas(object):
 
     def get_connection(self, handle):
         """
-        Get connection information for specified handle.
+        Get connection information for specified handle. This is a
+        dictionary lookup, so it is cheap enough to be called for every
+        handle drawn.
 
         >>> c = Canvas()
         >>> from gaphas.item import Line
@@ -452,10 +461,7 @@ class Canvas(object):
         >>> c.get_connection(i.handles()[1])     # doctest: +ELLIPSIS
         >>> c.get_connection(ii.handles()[0])    # doctest: +ELLIPSIS
         """
-        try:
-            return self._connections.query(handle=handle).next()
-        except StopIteration, ex:
-            return None
+        return self._handle_connections.get(handle)
 
 
     def get_connections(self, item=None, handle=None, connected=None, port=None):
@@ -571,9 +577,18 @@ class Canvas(object):
         >>> c.update_now()
         >>> len(c._dirty_items)
         0
+
+        A full update request also increases the item's version, so cached
+        renderings of the item become stale:
+
+        >>> v = i._version
+        >>> c.request_update(i)
+        >>> i._version == v + 1
+        True
         """
         if update:
             self._dirty_items.add(item)
+            item._version += 1
         if matrix:
             self._dirty_matrix_items.add(item)
 
@@ -651,10 +666,14 @@ class Canvas(object):
         sort = self.sort
         extend_dirty_items = self._extend_dirty_items
 
-        # perform update requests for parents of dirty items
+        # perform update requests for parents of dirty items. Like
+        # request_update(), increase the version of the parents
         dirty_items = self._dirty_items
         for item in set(dirty_items):
-            dirty_items.update(self._tree.get_ancestors(item))
+            for parent in self._tree.get_ancestors(item):
+                if parent not in dirty_items:
+                    dirty_items.add(parent)
+                    parent._version += 1
 
         # order the dirty items, so they are updated bottom to top
         dirty_items = sort(self._dirty_items, reverse=True)
@@ -870,10 +889,11 @@ class Canvas(object):
 
     def __getstate__(self):
         """
-        Persist canvas. Dirty item sets and views are not saved.
+        Persist canvas. Dirty item sets and views are not saved. The
+        handle to connection map is rebuilt from the connection table.
         """
         d = dict(self.__dict__)
-        for n in ('_dirty_items', '_dirty_matrix_items', '_dirty_index', '_registered_views'):
+        for n in ('_dirty_items', '_dirty_matrix_items', '_dirty_index', '_registered_views', '_handle_connections'):
             try:
                 del d[n]
             except KeyError:
@@ -892,6 +912,7 @@ class Canvas(object):
         self._dirty_matrix_items = set(self._tree.nodes)
         self._dirty_index = True
         self._registered_views = set()
+        self._handle_connections = dict((c.handle, c) for c in self._connections)
         #self.update()
 
 
@@ -0,0 +1,193 @@
+"""
+Damage regions
+==============
+
+Areas of a view that need to be redrawn are collected in a `DamageRegion`
+during a main loop iteration. Nearby areas are merged, as long as the area
+drawn for nothing (the *redundant* area) does not outweigh the cost of
+an extra rectangle. Far apart areas are kept separate, so two small changes
+at opposite corners of the view do not cause the whole view to be redrawn.
+"""
+
+__version__ = "$Revision$"
+# $HeadURL$
+
+
+def _area(r):
+    return (r[2] - r[0]) * (r[3] - r[1])
+
+
+def _union(a, b):
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
+
+def _overlap(a, b):
+    w = min(a[2], b[2]) - max(a[0], b[0])
+    h = min(a[3], b[3]) - max(a[1], b[1])
+    if w > 0 and h > 0:
+        return w * h
+    return 0
+
+
+def _waste(a, b):
+    """
+    Area covered by the union of a and b, that is covered by neither a nor b.
+    """
+    return _area(_union(a, b)) - _area(a) - _area(b) + _overlap(a, b)
+
+
+class DamageRegion(object):
+    """
+    Collection of rectangles (x, y, width, height) to be redrawn.
+
+    A rectangle is merged with an existing rectangle if the redundant area
+    of the union is at most ``cost``, the overhead of drawing an extra
+    rectangle (in square pixels). At most ``max_rectangles`` rectangles are
+    kept.
+
+    >>> damage = DamageRegion(cost=100)
+    >>> damage.add((0, 0, 10, 10))
+    >>> damage.add((5, 5, 10, 10))
+    >>> damage.rectangles()
+    [(0, 0, 15, 15)]
+
+    Rectangles far apart are kept separate:
+
+    >>> damage.add((200, 200, 10, 10))
+    >>> damage.add((2, 2, 5, 5))
+    >>> sorted(damage.rectangles())
+    [(0, 0, 15, 15), (200, 200, 10, 10)]
+
+    The region is emptied by flushing it:
+
+    >>> sorted(damage.flush())
+    [(0, 0, 15, 15), (200, 200, 10, 10)]
+    >>> damage.rectangles()
+    []
+    >>> sorted(damage.stats().items())
+    [('area', 325), ('flushes', 1), ('rectangles', 2), ('redundant', 50), ('requested', 325)]
+    """
+
+    def __init__(self, cost=64 * 64, max_rectangles=16):
+        self.cost = cost
+        self.max_rectangles = max_rectangles
+        # Rectangles as (x0, y0, x1, y1)
+        self._rects = []
+        self._requested = 0
+        self._redundant = 0
+
+        self.flushes = 0
+        self.rectangles_flushed = 0
+        self.requested = 0
+        self.area = 0
+        self.redundant = 0
+
+
+    def __len__(self):
+        return len(self._rects)
+
+
+    def add(self, rect):
+        """
+        Add a rectangle (x, y, width, height).
+        """
+        x, y, w, h = rect
+        if w <= 0 or h <= 0:
+            return
+        r = (x, y, x + w, y + h)
+        self._requested += _area(r)
+        rects = self._rects
+        cost = self.cost
+
+        # Merge until no rectangle is close enough
+        merged = True
+        while merged:
+            merged = False
+            for i, other in enumerate(rects):
+                waste = _waste(r, other)
+                if waste <= cost:
+                    del rects[i]
+                    self._redundant += waste
+                    r = _union(r, other)
+                    merged = True
+                    break
+        rects.append(r)
+
+        while len(rects) > self.max_rectangles:
+            self._merge_cheapest()
+
+
+    def _merge_cheapest(self):
+        """
+        Merge the two rectangles with the least redundant area.
+        """
+        rects = self._rects
+        n = len(rects)
+        waste, i, j = min((_waste(rects[i], rects[j]), i, j)
+                          for i in xrange(n) for j in xrange(i + 1, n))
+        r = _union(rects[i], rects[j])
+        del rects[j]
+        rects[i] = r
+        self._redundant += waste
+
+
+    def translate(self, dx, dy):
+        """
+        Move the rectangles, e.g. when the view is scrolled.
+
+        >>> damage = DamageRegion()
+        >>> damage.add((0, 0, 10, 10))
+        >>> damage.translate(5, -5)
+        >>> damage.rectangles()
+        [(5, -5, 10, 10)]
+        """
+        self._rects = [(x0 + dx, y0 + dy, x1 + dx, y1 + dy)
+                       for x0, y0, x1, y1 in self._rects]
+
+
+    def rectangles(self):
+        """
+        Return the rectangles (x, y, width, height) to be drawn.
+        """
+        return [(x0, y0, x1 - x0, y1 - y0) for x0, y0, x1, y1 in self._rects]
+
+
+    def flush(self):
+        """
+        Return the rectangles to be drawn and empty the region.
+        """
+        rects = self.rectangles()
+        if rects:
+            self.flushes += 1
+            self.rectangles_flushed += len(rects)
+            self.requested += self._requested
+            self.area += sum(_area(r) for r in self._rects)
+            self.redundant += self._redundant
+        self.clear()
+        return rects
+
+
+    def clear(self):
+        """
+        Drop the rectangles, without drawing them.
+        """
+        self._rects = []
+        self._requested = 0
+        self._redundant = 0
+
+
+    def stats(self):
+        """
+        Return a dictionary with statistics of the flushed regions: the
+        number of flushes and rectangles, the area requested (overlapping
+        areas are counted more than once), the area to be drawn and the
+        redundant part of that area.
+        """
+        return dict(flushes=self.flushes,
+                    rectangles=self.rectangles_flushed,
+                    requested=self.requested,
+                    area=self.area,
+                    redundant=self.redundant)
+
+
+# vim:sw=4:et:ai
@@ -33,6 +33,11 @@ class Box(Element):
         c.set_source_rgb(0,0,0.8)
         c.stroke()
 
+    def bounds(self):
+        # The outline is drawn with the default line width (2)
+        nw = self._handles[NW].pos
+        return nw.x - 1, nw.y - 1, self.width + 2, self.height + 2
+
 
 class PortoBox(Box):
     """
@@ -89,6 +94,10 @@ class PortoBox(Box):
         self._ports.append(self._lport)
 
 
+    def bounds(self):
+        # The ports are drawn outside the box
+        return None
+
     def draw(self, context):
         super(PortoBox, self).draw(context)
         c = context.cairo
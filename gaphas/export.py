@@ -0,0 +1,439 @@
+"""
+Export a canvas to an image, without a GTK+ widget.
+
+The rendering is done by a `gaphas.view.View`. Its bounding boxes should be
+up to date (see `View.update_bounding_box()`).
+
+Large images are rendered in tiles. Tiles are rendered concurrently: Cairo
+releases the global interpreter lock while rasterizing, so all cores can be
+put to work.
+
+`Exporter` writes a canvas to a PNG, SVG or PDF file. PNG images are
+rendered in bands (rows of tiles), that are encoded as they arrive. Only one
+band is kept in memory, regardless of the size of the diagram.
+"""
+
+__version__ = "$Revision$"
+# $HeadURL$
+
+import sys
+import struct
+import zlib
+import threading
+from Queue import Queue
+from math import ceil, floor
+import cairo
+
+from canvas import Context
+from geometry import Rectangle
+from view import View
+from painter import ItemPainter
+
+# Offsets of the red, green and blue bytes in a (native endian) 32 bits
+# Cairo pixel.
+if sys.byteorder == 'little':
+    RGB_OFFSETS = (2, 1, 0)
+else:
+    RGB_OFFSETS = (1, 2, 3)
+
+
+def cpu_count():
+    """
+    Return the number of processors, 1 if it can not be determined.
+    """
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+
+def pixel_area(area):
+    """
+    Return the smallest area in whole pixels (x, y, width, height)
+    containing ``area``.
+
+    >>> pixel_area((-0.5, 1.2, 10, 10))
+    (-1, 1, 10, 11)
+    """
+    x, y, w, h = area
+    x0, y0 = int(floor(x)), int(floor(y))
+    return x0, y0, int(ceil(x + w)) - x0, int(ceil(y + h)) - y0
+
+
+class TileRenderer(object):
+    """
+    Render (part of) a view in tiles. Each tile is rendered on its own image
+    surface, in a pool of ``threads`` threads.
+
+    Tiles are produced in row-major order. Only a few tiles per thread are
+    kept in memory, so huge images can be produced, provided the tiles are
+    consumed (written to file) as they arrive.
+
+    The view's painter is used. Typically this is a ``painter.ItemPainter``,
+    since a plain View has no tools and no selection.
+
+    If ``background`` (an RGB tuple) is set, the tiles are filled with that
+    colour first. The tiles are transparent otherwise.
+    """
+
+    def __init__(self, view, tile_size=512, threads=None, background=None):
+        self.view = view
+        self.tile_size = tile_size
+        self.threads = threads or cpu_count()
+        self.background = background
+
+
+    def tiles(self, area=None):
+        """
+        Return the tiles (x, y, width, height) covering ``area`` (in view
+        coordinates), in row-major order. By default the bounding box of the
+        view is used.
+        """
+        if area is None:
+            area = self.view.bounding_box
+        x0, y0, w, h = pixel_area(area)
+        size = self.tile_size
+        tiles = []
+        for y in xrange(y0, y0 + h, size):
+            th = min(size, y0 + h - y)
+            for x in xrange(x0, x0 + w, size):
+                tiles.append((x, y, min(size, x0 + w - x), th))
+        return tiles
+
+
+    def render_tile(self, rect):
+        """
+        Render one tile (x, y, width, height). An ARGB image surface is
+        returned.
+        """
+        x, y, w, h = rect
+        view = self.view
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
+        # Painters set the view matrix, so shift the surface instead
+        surface.set_device_offset(-x, -y)
+        cr = cairo.Context(surface)
+        cr.rectangle(x, y, w, h)
+        cr.clip()
+        if self.background:
+            cr.set_source_rgb(*self.background)
+            cr.paint()
+        area = Rectangle(x, y, w, h)
+        view.painter.paint(Context(cairo=cr,
+                                   items=view.get_items_in_rectangle(area),
+                                   area=area))
+        surface.flush()
+        surface.set_device_offset(0, 0)
+        return surface
+
+
+    def _prepare(self):
+        """
+        Calculate the item matrices up front, so the rendering threads
+        only read shared data.
+        """
+        view = self.view
+        for item in view.canvas.get_all_items():
+            view.get_matrix_i2v(item)
+            view.get_matrix_v2i(item)
+
+
+    def iter_tiles(self, area=None):
+        """
+        Render the tiles covering ``area``. Tuples ((x, y, width, height),
+        surface) are generated in row-major order.
+        """
+        tiles = self.tiles(area)
+        self._prepare()
+
+        if self.threads <= 1:
+            for rect in tiles:
+                yield rect, self.render_tile(rect)
+            return
+
+        tasks = Queue()
+        results = {}
+        done = threading.Condition()
+
+        def worker():
+            while True:
+                i = tasks.get()
+                if i is None:
+                    return
+                try:
+                    result = self.render_tile(tiles[i])
+                except Exception:
+                    # Keep the traceback of the worker
+                    result = sys.exc_info()
+                done.acquire()
+                try:
+                    results[i] = result
+                    done.notifyAll()
+                finally:
+                    done.release()
+
+        workers = [threading.Thread(target=worker) for i in xrange(self.threads)]
+        for w in workers:
+            w.setDaemon(True)
+            w.start()
+
+        # Limit the number of tiles in memory
+        queued = min(2 * self.threads, len(tiles))
+        for i in xrange(queued):
+            tasks.put(i)
+
+        try:
+            for i in xrange(len(tiles)):
+                done.acquire()
+                try:
+                    while i not in results:
+                        done.wait()
+                    result = results.pop(i)
+                finally:
+                    done.release()
+                if queued < len(tiles):
+                    tasks.put(queued)
+                    queued += 1
+                if isinstance(result, tuple):
+                    raise result[0], result[1], result[2]
+                yield tiles[i], result
+        finally:
+            for w in workers:
+                tasks.put(None)
+
+
+    def render(self, cr, area=None):
+        """
+        Render ``area`` on cairo context ``cr``, tile by tile. The top-left
+        corner of the area is placed at the origin of ``cr``.
+        """
+        if area is None:
+            area = self.view.bounding_box
+        x0, y0 = pixel_area(area)[:2]
+        for (x, y, w, h), surface in self.iter_tiles(area):
+            cr.set_source_surface(surface, x - x0, y - y0)
+            cr.paint()
+
+
+    def iter_bands(self, area=None):
+        """
+        Render the area in bands of ``tile_size`` pixels high. For each
+        band the rows of pixels are generated, as RGB strings. Tiles
+        should be opaque (see ``background``), since the alpha channel is
+        dropped.
+        """
+        band = []
+        for rect, surface in self.iter_tiles(area):
+            if band and band[0][0][1] != rect[1]:
+                yield _band_rows(band)
+                band = []
+            band.append((rect, surface))
+        if band:
+            yield _band_rows(band)
+
+
+def _band_rows(band):
+    """
+    Return the rows of pixels of a band (a list of (rect, surface) tuples),
+    as RGB strings.
+    """
+    tiles = [(str(surface.get_data()), surface.get_stride(), w * 4)
+             for (x, y, w, h), surface in band]
+    height = band[0][0][3]
+    rows = []
+    for i in xrange(height):
+        argb = ''.join(data[i * stride:i * stride + n] for data, stride, n in tiles)
+        rgb = bytearray(len(argb) / 4 * 3)
+        for c, offset in enumerate(RGB_OFFSETS):
+            rgb[c::3] = argb[offset::4]
+        rows.append(str(rgb))
+    return rows
+
+
+class PNGWriter(object):
+    """
+    Write a PNG image (8 bits RGB) row by row. Rows are compressed and
+    written as they are added.
+
+    >>> from StringIO import StringIO
+    >>> f = StringIO()
+    >>> png = PNGWriter(f, 2, 1)
+    >>> png.write_row('\\xff\\x00\\x00\\x00\\x00\\xff')
+    >>> png.close()
+    >>> f.getvalue()[:8]
+    '\\x89PNG\\r\\n\\x1a\\n'
+
+    All rows should be written:
+
+    >>> png = PNGWriter(StringIO(), 2, 2)
+    >>> png.write_row('\\xff\\x00\\x00\\x00\\x00\\xff')
+    >>> png.close()
+    Traceback (most recent call last):
+    ...
+    ValueError: 1 of 2 rows written
+    """
+
+    def __init__(self, f, width, height, level=6):
+        self._file = f
+        self.width = width
+        self.height = height
+        self._rows = 0
+        self._compressor = zlib.compressobj(level)
+        f.write('\x89PNG\r\n\x1a\n')
+        # 8 bits per sample, colour type 2 (RGB), no interlacing
+        self._chunk('IHDR', struct.pack('!IIBBBBB', width, height, 8, 2, 0, 0, 0))
+
+
+    def _chunk(self, tag, data):
+        f = self._file
+        f.write(struct.pack('!I', len(data)))
+        f.write(tag)
+        f.write(data)
+        f.write(struct.pack('!I', zlib.crc32(tag + data) & 0xffffffff))
+
+
+    def write_row(self, row):
+        """
+        Add a row of RGB pixels.
+        """
+        assert len(row) == self.width * 3, 'Row should be %d bytes' % (self.width * 3)
+        # Filter type 0: no filtering
+        data = self._compressor.compress('\x00' + row)
+        if data:
+            self._chunk('IDAT', data)
+        self._rows += 1
+
+
+    def close(self):
+        """
+        Write the remaining image data. The file is not closed.
+        """
+        if self._rows != self.height:
+            raise ValueError, '%d of %d rows written' % (self._rows, self.height)
+        self._chunk('IDAT', self._compressor.flush())
+        self._chunk('IEND', '')
+
+
+class Exporter(object):
+    """
+    Export a canvas to an image file.
+
+    A private `View` with an `ItemPainter` is used, scaled by ``scale``.
+    The size of the image is determined by the bounding boxes of the items,
+    as stored in the view's spatial index.
+
+    Files can be given as file name or as file object.
+    """
+
+    def __init__(self, canvas, scale=1.0, band_height=256, threads=None):
+        self.view = view = View(canvas)
+        view.painter = ItemPainter()
+        view.matrix.scale(scale, scale)
+        view.update_view_matrix()
+        self.band_height = band_height
+        self.threads = threads
+        self.update_bounding_box()
+
+
+    def update_bounding_box(self):
+        """
+        Calculate the bounding boxes of the items. This is done on creation.
+        Call this method again if the canvas changes.
+        """
+        # The view is not registered with the canvas, so it is not told
+        # about removed items. Start with an empty index.
+        self.view.clear_index()
+        # Bounding boxes are calculated with a temporary context (used for
+        # stuff like calculating font metrics)
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 0, 0)
+        self.view.update_bounding_box(cairo.Context(surface))
+        surface.finish()
+
+
+    bounding_box = property(lambda s: s.view.bounding_box,
+                            doc="Area exported, in view coordinates")
+
+    size = property(lambda s: tuple(pixel_area(s.view.bounding_box)[2:]),
+                    doc="Size of the exported (PNG) image, in pixels")
+
+
+    def write_png(self, f, background=(1, 1, 1)):
+        """
+        Write the canvas as PNG image. The image has no alpha channel, the
+        items are drawn on ``background``.
+        """
+        area = pixel_area(self.bounding_box)
+        renderer = TileRenderer(self.view, tile_size=self.band_height,
+                                threads=self.threads, background=background)
+        f, close = _open(f)
+        try:
+            png = PNGWriter(f, area[2], area[3])
+            for rows in renderer.iter_bands(area):
+                for row in rows:
+                    png.write_row(row)
+            png.close()
+        finally:
+            if close:
+                f.close()
+
+
+    def write_svg(self, f):
+        """
+        Write the canvas as a SVG image.
+        """
+        x, y, w, h = self.bounding_box
+        surface = cairo.SVGSurface(f, w, h)
+        self._paint_pages(surface, [(x, y, w, h)])
+
+
+    def write_pdf(self, f, page_height=None):
+        """
+        Write the canvas as PDF document. If ``page_height`` is set, the
+        diagram is split over multiple pages. Each page is written when it is
+        finished.
+        """
+        x, y, w, h = self.bounding_box
+        page_height = page_height or h
+        pages = []
+        py = y
+        while py < y + h:
+            pages.append((x, py, w, min(page_height, y + h - py)))
+            py += page_height
+        surface = cairo.PDFSurface(f, w, pages[0][3])
+        self._paint_pages(surface, pages)
+
+
+    def _paint_pages(self, surface, pages):
+        """
+        Paint the pages (x, y, width, height) on a vector surface. Only the
+        items in a page are painted.
+        """
+        view = self.view
+        for x, y, w, h in pages:
+            if isinstance(surface, cairo.PDFSurface):
+                surface.set_size(w, h)
+            # Painters set the view matrix, so shift the surface instead.
+            # The offset is applied to contexts created after this call.
+            surface.set_device_offset(-x, -y)
+            cr = cairo.Context(surface)
+            cr.rectangle(x, y, w, h)
+            cr.clip()
+            area = Rectangle(x, y, w, h)
+            view.painter.paint(Context(cairo=cr,
+                                       items=view.get_items_in_rectangle(area),
+                                       area=area))
+            cr.show_page()
+        surface.finish()
+
+
+def _open(f):
+    """
+    Return a file object for ``f`` (a file name or file object) and whether
+    it should be closed afterwards.
+    """
+    if isinstance(f, basestring):
+        return open(f, 'wb'), True
+    return f, False
+
+
+# vim:sw=4:et:ai
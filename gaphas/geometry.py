@@ -13,6 +13,14 @@ __version__ = "$Revision$"
 
 from math import sqrt
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Number of segments from which distance_point_segments() uses NumPy
+SEGMENTS_NUMPY_THRESHOLD = 16
+
 
 class Rectangle(object):
     """
@@ -420,6 +428,59 @@ def distance_line_point(line_start, line_end, point):
                (line_start[0] + proj[0], line_start[1] + proj[1])
 
 
+def distance_point_segments(point, segments):
+    """
+    Find the line segment nearest to ``point``. Segments are given as
+    ``(x0, y0, x1, y1)`` tuples, a segment of length 0 is a point.
+
+    A tuple (index, distance, nearest point) is returned, or None if there
+    are no segments. Large numbers of segments are handled at once if
+    NumPy is available.
+
+    >>> distance_point_segments((5, 5), [(0, 0, 10, 0), (0, 10, 10, 10), (6, 6, 6, 6)])
+    (2, 1.4142135623730951, (6.0, 6.0))
+    >>> distance_point_segments((12, 4), [(0, 0, 10, 0), (0, 10, 10, 10)])
+    (0, 4.47213595499958, (10.0, 0.0))
+    >>> distance_point_segments((12, 4), [])
+    """
+    if numpy is not None and len(segments) >= SEGMENTS_NUMPY_THRESHOLD:
+        return _distance_point_segments_numpy(point, segments)
+    px, py = point
+    best = None
+    for i, (x0, y0, x1, y1) in enumerate(segments):
+        dx, dy = x1 - x0, y1 - y0
+        len_sqr = dx * dx + dy * dy
+        if len_sqr:
+            t = ((px - x0) * dx + (py - y0) * dy) / float(len_sqr)
+            t = min(1.0, max(0.0, t))
+        else:
+            t = 0.0
+        nx, ny = x0 + t * dx, y0 + t * dy
+        d = (px - nx) ** 2 + (py - ny) ** 2
+        if best is None or d < best[0]:
+            best = d, i, nx, ny
+    if best is None:
+        return None
+    d, i, nx, ny = best
+    return i, sqrt(d), (float(nx), float(ny))
+
+
+def _distance_point_segments_numpy(point, segments):
+    """
+    NumPy version of `distance_point_segments()`.
+    """
+    px, py = point
+    x0, y0, x1, y1 = numpy.asarray(segments, dtype=float).T
+    dx, dy = x1 - x0, y1 - y0
+    len_sqr = dx * dx + dy * dy
+    t = ((px - x0) * dx + (py - y0) * dy) / numpy.where(len_sqr, len_sqr, 1.0)
+    t = numpy.clip(t, 0.0, 1.0)
+    nx, ny = x0 + t * dx, y0 + t * dy
+    d = (px - nx) ** 2 + (py - ny) ** 2
+    i = int(d.argmin())
+    return i, sqrt(d[i]), (float(nx[i]), float(ny[i]))
+
+
 def intersect_line_line(line1_start, line1_end, line2_start, line2_end):
     """
     Find the point where the lines (segments) defined by
@@ -547,6 +608,20 @@ def intersect_line_line(line1_start, line1_end, line2_start, line2_end):
     return x, y
 
 
+def transform_rectangle(matrix, rect):
+    """
+    Transform a rectangle (x, y, width, height) with ``matrix`` (e.g. a
+    cairo.Matrix). A Rectangle containing all four transformed corners is
+    returned.
+    """
+    x, y, w, h = rect
+    t = matrix.transform_point
+    points = (t(x, y), t(x + w, y), t(x, y + h), t(x + w, y + h))
+    xs = [p[0] for p in points]
+    ys = [p[1] for p in points]
+    return Rectangle(min(xs), min(ys), x1=max(xs), y1=max(ys))
+
+
 def rectangle_contains(inner, outer):
     """
     Returns True if ``inner`` rect is contained in ``outer`` rect.
@@ -6,7 +6,6 @@ __version__ = "$Revision$"
 # $HeadURL$
 
 from math import atan2
-from weakref import WeakKeyDictionary
 try:
     # python 3.0 (better be prepared)
     from weakref import WeakSet
@@ -38,10 +37,10 @@ class Item(object):
     - _ports:       list of ports, connectable areas of an item
     - _matrix_i2c:  item to canvas coordinates matrix
     - _matrix_c2i:  canvas to item coordinates matrix
-    - _matrix_i2v:  item to view coordinates matrices
-    - _matrix_v2i:  view to item coordinates matrices
     - _sort_key:  used to sort items
     - _canvas_projections:  used to sort items
+    - _version:  incremented on each update request, see
+      `Canvas.request_update()`
     """
 
     def __init__(self):
@@ -54,11 +53,8 @@ class Item(object):
         # used by gaphas.canvas.Canvas to hold conversion matrices
         self._matrix_i2c = None
         self._matrix_c2i = None
-
-        # used by gaphas.view.GtkView to hold item 2 view matrices (view=key)
-        self._matrix_i2v = WeakKeyDictionary()
-        self._matrix_v2i = WeakKeyDictionary()
 	self._canvas_projections = WeakSet()
+        self._version = 0
 
     @observed
     def _set_canvas(self, canvas):
@@ -189,6 +185,9 @@ class Item(object):
         - view: the view that is to be rendered to
         - selected, focused, hovered, dropzone: view state of items (True/False)
         - draw_all: a request to draw everything, for bounding box calculations
+        - scale: the scale from item to view coordinates; details, such as
+          text, can be left out if the item is drawn very small. See also
+          `gaphas.aspect.ItemLevelOfDetail`.
         """
         pass
 
@@ -215,6 +214,18 @@ class Item(object):
         pass
 
 
+    def bounds(self):
+        """
+        Return the area covered by the drawing of the item, as
+        (x, y, width, height) in item coordinates. Line widths should be
+        taken into account. Handles need not be.
+
+        By default None is returned: the bounds are determined by drawing
+        the item (see `gaphas.painter.BoundingBoxPainter`).
+        """
+        return None
+
+
     def constraint(self,
             horizontal=None,
             vertical=None,
@@ -279,7 +290,7 @@ class Item(object):
         Persist all, but calculated values (``_matrix_?2?``).
         """
         d = dict(self.__dict__)
-        for n in ('_matrix_i2c', '_matrix_c2i', '_matrix_i2v', '_matrix_v2i'):
+        for n in ('_matrix_i2c', '_matrix_c2i'):
             try:
                 del d[n]
             except KeyError:
@@ -294,8 +305,7 @@ class Item(object):
         """
         for n in ('_matrix_i2c', '_matrix_c2i'):
             setattr(self, n, None)
-        for n in ('_matrix_i2v', '_matrix_v2i'):
-            setattr(self, n, WeakKeyDictionary())
+        self._version = 0
         self.__dict__.update(state)
         self._canvas_projections = WeakSet(state['_canvas_projections'])
 
@@ -6,6 +6,10 @@ Matrix
 ------
 Small utility class wrapping cairo.Matrix. The `Matrix` class
 adds state preservation capabilities.
+
+MatrixTable
+-----------
+Item to view matrices, as kept by a view. See `MatrixTable`.
 """
 
 __version__ = "$Revision$"
@@ -98,4 +102,136 @@ class Matrix(object):
     def __repr__(self):
         return 'Matrix(%g, %g, %g, %g, %g, %g)' % tuple(self._matrix)
 
+
+class MatrixTable(object):
+    """
+    Table of item to view matrices, owned by a view. Items are assigned a
+    slot, the matrices are kept in lists indexed by slot.
+
+    The view to item matrices are calculated (inverted) when they are first
+    asked for.
+
+    All matrices are invalidated at once by increasing the generation of
+    the table (e.g. when the view is zoomed). Entries of an older
+    generation are outdated.
+
+    The table holds references to the items. The view removes items when
+    the canvas reports them removed, which requires the view to be
+    registered with the canvas (as `view.GtkView` is). Otherwise items stay
+    in the table, just like in the view's spatial index, until the table is
+    cleared (e.g. by setting the view's canvas).
+
+    >>> table = MatrixTable()
+    >>> table.get_i2v('item')
+    >>> table.set('item', cairo.Matrix(2, 0, 0, 2, 10, 10))
+    >>> table.get_i2v('item')
+    cairo.Matrix(2, 0, 0, 2, 10, 10)
+    >>> table.get_v2i('item')
+    cairo.Matrix(0.5, 0, 0, 0.5, -5, -5)
+    >>> 'item' in table
+    True
+    >>> table.invalidate()
+    >>> 'item' in table, table.get_i2v('item'), len(table)
+    (False, None, 1)
+    >>> table.remove('item')
+    >>> len(table)
+    0
+    """
+
+    def __init__(self):
+        self.generation = 0
+        # item -> slot
+        self._slots = {}
+        self._free = []
+        self._i2v = []
+        self._v2i = []
+        self._generations = []
+
+
+    def __len__(self):
+        return len(self._slots)
+
+
+    def __contains__(self, item):
+        """
+        Return True if ``item`` has up to date matrices.
+        """
+        slot = self._slots.get(item)
+        return slot is not None and self._generations[slot] == self.generation
+
+
+    def get_i2v(self, item):
+        """
+        Return the item to view matrix of ``item``, or None if it is not
+        known or outdated.
+        """
+        slot = self._slots.get(item)
+        if slot is not None and self._generations[slot] == self.generation:
+            return self._i2v[slot]
+        return None
+
+
+    def get_v2i(self, item):
+        """
+        Return the view to item matrix of ``item``, or None if it is not
+        known or outdated.
+        """
+        slot = self._slots.get(item)
+        if slot is None or self._generations[slot] != self.generation:
+            return None
+        v2i = self._v2i[slot]
+        if v2i is None:
+            v2i = cairo.Matrix(*self._i2v[slot])
+            v2i.invert()
+            self._v2i[slot] = v2i
+        return v2i
+
+
+    def set(self, item, i2v):
+        """
+        Set the item to view matrix of ``item``.
+        """
+        slot = self._slots.get(item)
+        if slot is None:
+            if self._free:
+                slot = self._free.pop()
+            else:
+                slot = len(self._i2v)
+                self._i2v.append(None)
+                self._v2i.append(None)
+                self._generations.append(None)
+            self._slots[item] = slot
+        self._i2v[slot] = i2v
+        self._v2i[slot] = None
+        self._generations[slot] = self.generation
+
+
+    def remove(self, item):
+        """
+        Remove the matrices of ``item``.
+        """
+        slot = self._slots.pop(item, None)
+        if slot is not None:
+            self._i2v[slot] = self._v2i[slot] = self._generations[slot] = None
+            self._free.append(slot)
+
+
+    def invalidate(self):
+        """
+        Mark all matrices as outdated.
+        """
+        self.generation += 1
+
+
+    def clear(self):
+        """
+        Remove all items.
+        """
+        self._slots.clear()
+        del self._free[:]
+        del self._i2v[:]
+        del self._v2i[:]
+        del self._generations[:]
+
+
 # vim:sw=4:et
@@ -10,20 +10,50 @@ and handles).
 __version__ = "$Revision$"
 # $HeadURL$
 
-from cairo import Matrix, ANTIALIAS_NONE, LINE_JOIN_ROUND
+import logging
+from weakref import ref
+from collections import OrderedDict
+from math import floor, ceil, sqrt
+from threading import local
+from time import time
+from cairo import Matrix, ANTIALIAS_NONE, LINE_JOIN_ROUND, CONTENT_COLOR_ALPHA
+from cairo import Context as CairoContext
 
 from gaphas.canvas import Context
-from gaphas.geometry import Rectangle
+from gaphas.geometry import Rectangle, transform_rectangle, rectangle_contains
 from gaphas.item import Line
-from gaphas.aspect import PaintFocused
+from gaphas.aspect import PaintFocused, LevelOfDetail, ItemLevelOfDetail
 
 
 DEBUG_DRAW_BOUNDING_BOX = False
 
+# Draw items with bounds (Item.bounds()) anyway, and report items that are
+# drawn outside their bounds.
+DEBUG_BOUNDS = False
+
+# Tolerance (in view coordinates) for DEBUG_BOUNDS
+BOUNDS_TOLERANCE = 2
+
 # The tolerance for Cairo. Bigger values increase speed and reduce accuracy
 # (default: 0.1)
 TOLERANCE = 0.8
 
+
+def matrix_scale(matrix):
+    """
+    Return the (average) scale factor of a cairo matrix.
+
+    >>> matrix_scale(Matrix(2, 0, 0, 2, 10, 10))
+    2.0
+    >>> m = Matrix()
+    >>> m.rotate(1)
+    >>> round(matrix_scale(m), 6)
+    1.0
+    """
+    xx, yx, xy, yy, x0, y0 = tuple(matrix)
+    return sqrt(abs(xx * yy - xy * yx))
+
+
 class Painter(object):
     """
     Painter interface.
@@ -41,6 +71,14 @@ class Painter(object):
         """
         pass
 
+    def paint_items(self, context):
+        """
+        Only paint the items in the context, leave out decorations such as
+        handles. Used by views that paint progressively (see
+        `view.GtkView.frame_budget`). By default nothing is painted.
+        """
+        pass
+
 
 class PainterChain(Painter):
     """
@@ -78,12 +116,20 @@ class PainterChain(Painter):
         for painter in self._painters:
             painter.paint(context)
 
+    def paint_items(self, context):
+        """
+        See Painter.paint_items().
+        """
+        for painter in self._painters:
+            painter.paint_items(context)
+
 
 class DrawContext(Context):
     """
     Special context for draw()'ing the item. The draw-context contains
     stuff like the cairo context and properties like selected and
-    focused.
+    focused. ``scale`` is the effective scale from item to view
+    coordinates, items can leave out details (e.g. text) if it's small.
     """
 
     deprecated = False
@@ -92,38 +138,156 @@ class DrawContext(Context):
         super(DrawContext, self).__init__(**kwargs)
 
 
+class _FrameState(local):
+    """
+    State of an `ItemPainter`, per thread: the draw context that is reused
+    for each item, the state of the view during a frame and the counters of
+    the frame.
+    """
+    context = None
+    view_state = None
+    items = 0
+    contexts = 0
+    start = 0.0
+
+
 class ItemPainter(Painter):
+    """
+    Draw the items.
+
+    One `DrawContext` is used for all items drawn (by a thread), it is
+    updated for each item. Items should not hold on to the context after
+    drawing. The state of the view (selection, focused item, etc.) is looked
+    up once per frame.
+
+    ``frame_stats`` contains the counters of the last frame painted: the
+    number of items drawn, the number of draw contexts allocated and the time
+    spent (in seconds).
+    """
 
     draw_all = False
 
-    def _draw_item(self, item, cairo, area=None):
+    def __init__(self, view=None):
+        super(ItemPainter, self).__init__(view)
+        self._frame = _FrameState()
+        self.frame_stats = dict(items=0, contexts=0, time=0.0)
+
+    def _begin_frame(self):
+        """
+        Look up the state of the view for the frame to be painted.
+        """
         view = self.view
+        frame = self._frame
+        frame.view_state = (view.selected_items, view.focused_item,
+                            view.hovered_item, view.dropzone_item)
+        frame.items = 0
+        frame.contexts = 0
+        frame.start = time()
+
+    def _end_frame(self):
+        frame = self._frame
+        frame.view_state = None
+        self.frame_stats = dict(items=frame.items,
+                                contexts=frame.contexts,
+                                time=time() - frame.start)
+
+    def _item_state(self, item):
+        """
+        Return (selected, focused, hovered, dropzone) for ``item``.
+        """
+        state = self._frame.view_state
+        if state is None:
+            # Not painting a frame
+            view = self.view
+            state = (view.selected_items, view.focused_item,
+                     view.hovered_item, view.dropzone_item)
+        selected_items, focused, hovered, dropzone = state
+        return (item in selected_items, item is focused,
+                item is hovered, item is dropzone)
+
+    def _draw_item(self, item, cairo, area=None, draw=None):
+        """
+        Draw an item. ``draw`` can be used instead of the item's draw()
+        method, e.g. for drawing less detail.
+        """
+        frame = self._frame
+        context = frame.context
+        if context is None:
+            context = frame.context = DrawContext(painter=self)
+            frame.contexts += 1
+        i2v = self.view.get_matrix_i2v(item)
+        selected, focused, hovered, dropzone = self._item_state(item)
+        # Contexts are read-only, so bypass __setattr__
+        context.__dict__.update(cairo=cairo,
+                                _area=area,
+                                _item=item,
+                                selected=selected,
+                                focused=focused,
+                                hovered=hovered,
+                                dropzone=dropzone,
+                                draw_all=self.draw_all,
+                                scale=matrix_scale(i2v))
         cairo.save()
         try:
-            cairo.set_matrix(view.matrix)
-            cairo.transform(view.canvas.get_matrix_i2c(item))
-
-            item.draw(DrawContext(painter=self,
-                                  cairo=cairo,
-                                  _area=area,
-                                  _item=item,
-                                  selected=(item in view.selected_items),
-                                  focused=(item is view.focused_item),
-                                  hovered=(item is view.hovered_item),
-                                  dropzone=(item is view.dropzone_item),
-                                  draw_all=self.draw_all))
-
+            cairo.set_matrix(i2v)
+            (draw or item.draw)(context)
         finally:
             cairo.restore()
+        frame.items += 1
 
     def _draw_items(self, items, cairo, area=None):
         """
         Draw the items.
+
+        If the view is zoomed out, the level of detail of items is
+        considered (see `aspect.ItemLevelOfDetail`). Items drawn as
+        bounding box are drawn at once.
         """
+        view = self.view
+        lod = not self.draw_all and matrix_scale(view.matrix) < 1.0
+        # item type -> (threshold, aspect type)
+        levels = {}
+        outlines = []
         for item in items:
+            if lod:
+                level = levels.get(type(item))
+                if level is None:
+                    aspect = LevelOfDetail(item, view)
+                    level = levels[type(item)] = (aspect.threshold, type(aspect))
+                threshold, aspect_type = level
+                if threshold and matrix_scale(view.get_matrix_i2v(item)) < threshold:
+                    if aspect_type is ItemLevelOfDetail:
+                        outlines.append(item)
+                    else:
+                        self._draw_item(item, cairo, area=area,
+                                        draw=LevelOfDetail(item, view).draw)
+                    continue
             self._draw_item(item, cairo, area=area)
             if DEBUG_DRAW_BOUNDING_BOX:
                 self._draw_bounds(item, cairo)
+        if outlines:
+            self._draw_outlines(outlines, cairo)
+
+    def _draw_outlines(self, items, cairo):
+        """
+        Draw the bounding boxes of ``items``, in one go.
+        """
+        view = self.view
+        get_bounds = view.get_canvas_bounding_box
+        cairo.save()
+        try:
+            cairo.set_matrix(view.matrix)
+            for item in items:
+                try:
+                    cairo.rectangle(*get_bounds(item))
+                except KeyError:
+                    pass # No bounding box right now..
+            cairo.identity_matrix()
+            cairo.set_source_rgb(.5, .5, .5)
+            cairo.set_line_width(1.0)
+            cairo.stroke()
+        finally:
+            cairo.restore()
 
     def _draw_bounds(self, item, cairo):
         view = self.view
@@ -144,7 +308,144 @@ class ItemPainter(Painter):
         cairo = context.cairo
         cairo.set_tolerance(TOLERANCE)
         cairo.set_line_join(LINE_JOIN_ROUND)
-        self._draw_items(context.items, cairo, context.area)
+        self._begin_frame()
+        try:
+            self._draw_items(context.items, cairo, context.area)
+        finally:
+            self._end_frame()
+
+    def paint_items(self, context):
+        self.paint(context)
+
+
+class CachedItemPainter(ItemPainter):
+    """
+    An ItemPainter that retains the rendering of each item in an off-screen
+    surface. The surface is painted as long as the item is not updated
+    (`Canvas.request_update()` increments the item's version), its state
+    (selected, focused, hovered, dropzone) and the size of its bounding box
+    do not change and the item to view matrix only changes in translation
+    (moving and scrolling).
+
+    The memory used by the surfaces is limited to ``max_memory`` bytes. Least
+    recently used surfaces are dropped first. Items that do not fit in a
+    quarter of the memory budget are drawn directly.
+    """
+
+    def __init__(self, view=None, max_memory=16 * 1024 * 1024):
+        super(CachedItemPainter, self).__init__(view)
+        self.max_memory = max_memory
+        # weak reference to item -> [key, surface, offset, memory, reference],
+        # least recently used first
+        self._cache = OrderedDict()
+        self._memory = 0
+        self.hits = 0
+        self.misses = 0
+
+    def set_view(self, view):
+        super(CachedItemPainter, self).set_view(view)
+        self.clear()
+
+    def clear(self):
+        """
+        Drop all cached surfaces.
+        """
+        self._cache.clear()
+        self._memory = 0
+
+    def memory(self):
+        """
+        Return the amount of memory used by the cached surfaces, in bytes.
+        """
+        return self._memory
+
+    def _drop(self, itemref):
+        """
+        Drop the surface of an item. Also called when the item is garbage
+        collected.
+        """
+        entry = self._cache.pop(itemref, None)
+        if entry:
+            self._memory -= entry[3]
+
+    def _evict(self, needed):
+        """
+        Drop least recently used surfaces until ``needed`` bytes are
+        available.
+        """
+        cache = self._cache
+        while cache and self._memory + needed > self.max_memory:
+            itemref, entry = cache.popitem(last=False)
+            self._memory -= entry[3]
+
+    def _render(self, item, cairo, key, bounds, ox, oy, draw=None):
+        """
+        Render ``item`` in a new surface, covering ``bounds`` (view
+        coordinates). The offset of the surface is stored relative to
+        the item origin (ox, oy), so the surface can be reused if the
+        item or view is moved.
+        """
+        x, y = int(floor(bounds.x)), int(floor(bounds.y))
+        width = int(ceil(bounds.x + bounds.width)) - x
+        height = int(ceil(bounds.y + bounds.height)) - y
+        memory = width * height * 4
+        if width <= 0 or height <= 0 or memory > self.max_memory / 4:
+            return None
+
+        self._drop(ref(item))
+        self._evict(memory)
+
+        surface = cairo.get_target().create_similar(CONTENT_COLOR_ALPHA, width, height)
+        # Items are drawn in view coordinates, so shift the surface instead
+        surface.set_device_offset(-x, -y)
+        cr = CairoContext(surface)
+        cr.set_tolerance(TOLERANCE)
+        cr.set_line_join(LINE_JOIN_ROUND)
+        super(CachedItemPainter, self)._draw_item(item, cr, draw=draw)
+        surface.set_device_offset(0, 0)
+
+        itemref = ref(item, self._drop)
+        entry = [key, surface, (x - ox, y - oy), memory, itemref]
+        self._cache[itemref] = entry
+        self._memory += memory
+        return entry
+
+    def _draw_item(self, item, cairo, area=None, draw=None):
+        view = self.view
+        try:
+            bounds = view.get_item_bounding_box(item)
+        except KeyError:
+            # No bounding box, so the size of the surface is unknown
+            super(CachedItemPainter, self)._draw_item(item, cairo, area, draw)
+            return
+
+        xx, yx, xy, yy, x0, y0 = tuple(view.get_matrix_i2v(item))
+        ox, oy = floor(x0), floor(y0)
+        key = (item._version, xx, yx, xy, yy, x0 - ox, y0 - oy,
+               bounds.width, bounds.height) + self._item_state(item)
+
+        cache = self._cache
+        entry = cache.get(ref(item))
+        if entry and entry[0] == key:
+            self.hits += 1
+            # Move to the end, as most recently used
+            del cache[entry[4]]
+            cache[entry[4]] = entry
+        else:
+            self.misses += 1
+            entry = self._render(item, cairo, key, bounds, ox, oy, draw)
+            if not entry:
+                super(CachedItemPainter, self)._draw_item(item, cairo, area, draw)
+                return
+
+        dx, dy = entry[2]
+        cairo.save()
+        try:
+            cairo.identity_matrix()
+            cairo.set_source_surface(entry[1], ox + dx, oy + dy)
+            cairo.paint()
+        finally:
+            cairo.restore()
 
 
 class CairoBoundingBoxContext(object):
@@ -246,26 +547,48 @@ class BoundingBoxPainter(ItemPainter):
     """
     This specific case of an ItemPainter is used to calculate the bounding
     boxes (in canvas coordinates) for the items.
+
+    Items that know their bounds (see `Item.bounds()`) are not drawn. Set
+    ``DEBUG_BOUNDS`` to check those bounds against the drawn bounds.
     """
 
     draw_all = True
 
     def _draw_item(self, item, cairo, area=None):
-        cairo = CairoBoundingBoxContext(cairo)
-        super(BoundingBoxPainter, self)._draw_item(item, cairo)
-        bounds = cairo.get_bounds()
-
-        # Update bounding box with handles.
         view = self.view
-        i2v = view.get_matrix_i2v(item).transform_point
-        for h in item.handles():
-            cx, cy = i2v(*h.pos)
-            bounds += (cx - 5, cy - 5, 9, 9)
+        ibounds = item.bounds()
+        if ibounds is None or DEBUG_BOUNDS:
+            cairo = CairoBoundingBoxContext(cairo)
+            super(BoundingBoxPainter, self)._draw_item(item, cairo)
+            bounds = cairo.get_bounds()
+        if ibounds is not None:
+            analytic = transform_rectangle(view.get_matrix_i2v(item), ibounds)
+            if DEBUG_BOUNDS:
+                self._check_bounds(item, analytic, bounds)
+            bounds = analytic
+
+        # Update bounding box with handles. The view adds a margin, wide
+        # enough for the handles to fit (see view.BOUNDING_BOX_MARGIN).
+        handles = item.handles()
+        if handles:
+            i2v = view.get_matrix_i2v(item).transform_point
+            xs, ys = zip(*(i2v(*h.pos) for h in handles))
+            bounds += Rectangle(min(xs), min(ys), x1=max(xs), y1=max(ys))
 
-        bounds.expand(1)
         view.set_item_bounding_box(item, bounds)
 
 
+    def _check_bounds(self, item, analytic, drawn):
+        """
+        Report an item drawn outside its bounds.
+        """
+        allowed = Rectangle(*analytic)
+        allowed.expand(BOUNDS_TOLERANCE)
+        if drawn and not rectangle_contains(tuple(drawn), tuple(allowed)):
+            logging.warning('Item %s is drawn outside its bounds: %s, drawn: %s',
+                            item, analytic, drawn)
+
+
     def _draw_items(self, items, cairo, area=None):
         """
         Draw the items.
@@ -274,55 +597,76 @@ class BoundingBoxPainter(ItemPainter):
             self._draw_item(item, cairo)
 
     def paint(self, context):
-        self._draw_items(context.items, context.cairo)
+        self._begin_frame()
+        try:
+            self._draw_items(context.items, context.cairo)
+        finally:
+            self._end_frame()
 
 
 class HandlePainter(Painter):
     """
     Draw handles of items that are marked as selected in the view.
+
+    If the view is zoomed out, handles are left out for items scaled below
+    their level of detail's ``handle_threshold`` (see
+    `aspect.ItemLevelOfDetail`).
     """
 
+    def _show_handles(self, item):
+        """
+        Return True if the handles of ``item`` are drawn at the current
+        zoom level.
+        """
+        view = self.view
+        if matrix_scale(view.matrix) >= 1.0:
+            return True
+        threshold = LevelOfDetail(item, view).handle_threshold
+        return not threshold or matrix_scale(view.get_matrix_i2v(item)) >= threshold
+
     def _draw_handles(self, item, cairo, opacity=None, inner=False):
         """
         Draw handles for an item.
         The handles are drawn in non-antialiased mode for clearity.
+        Handles of the same colour are drawn as one path.
         """
         view = self.view
         cairo.save()
-        i2v = view.get_matrix_i2v(item)
+        transform_point = view.get_matrix_i2v(item).transform_point
         if not opacity:
             opacity = (item is view.focused_item) and .7 or .4
 
-        cairo.set_line_width(1)
-
+        # colour -> [(x, y, connectable)]
+        handles = {}
         get_connection = view.canvas.get_connection
         for h in item.handles():
             if not h.visible:
                 continue
-            # connected and not being moved, see HandleTool.on_button_press
             if get_connection(h):
-                r, g, b = 1, 0, 0
-            # connected but being moved, see HandleTool.on_button_press
-            elif get_connection(h):
-                r, g, b = 1, 0.6, 0
+                colour = (1, 0, 0)
             elif h.movable:
-                r, g, b = 0, 1, 0
+                colour = (0, 1, 0)
             else:
-                r, g, b = 0, 0, 1
+                colour = (0, 0, 1)
+            x, y = transform_point(*h.pos)
+            handles.setdefault(colour, []).append((x, y, h.connectable))
 
-            cairo.identity_matrix()
-            cairo.set_antialias(ANTIALIAS_NONE)
-            cairo.translate(*i2v.transform_point(*h.pos))
-            cairo.rectangle(-4, -4, 8, 8)
-            if inner:
-                cairo.rectangle(-3, -3, 6, 6)
+        cairo.identity_matrix()
+        cairo.set_antialias(ANTIALIAS_NONE)
+        cairo.set_line_width(1)
+        for (r, g, b), points in handles.iteritems():
+            for x, y, connectable in points:
+                cairo.rectangle(x - 4, y - 4, 8, 8)
+                if inner:
+                    cairo.rectangle(x - 3, y - 3, 6, 6)
             cairo.set_source_rgba(r, g, b, opacity)
             cairo.fill_preserve()
-            if h.connectable:
-                cairo.move_to(-2, -2)
-                cairo.line_to(2, 3)
-                cairo.move_to(2, -2)
-                cairo.line_to(-2, 3)
+            for x, y, connectable in points:
+                if connectable:
+                    cairo.move_to(x - 2, y - 2)
+                    cairo.line_to(x + 2, y + 3)
+                    cairo.move_to(x + 2, y - 2)
+                    cairo.line_to(x - 2, y + 3)
             cairo.set_source_rgba(r/4., g/4., b/4., opacity*1.3)
             cairo.stroke()
         cairo.restore()
@@ -333,13 +677,14 @@ class HandlePainter(Painter):
         cairo = context.cairo
         # Order matters here:
         for item in canvas.sort(view.selected_items):
-            self._draw_handles(item, cairo)
+            if self._show_handles(item):
+                self._draw_handles(item, cairo)
         # Draw nice opaque handles when hovering an item:
         item = view.hovered_item
-        if item and item not in view.selected_items:
+        if item and item not in view.selected_items and self._show_handles(item):
             self._draw_handles(item, cairo, opacity=.25)
         item = view.dropzone_item
-        if item and item not in view.selected_items:
+        if item and item not in view.selected_items and self._show_handles(item):
             self._draw_handles(item, cairo, opacity=.25, inner=True)
 
 
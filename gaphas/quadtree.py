@@ -22,7 +22,9 @@ __version__ = "$Revision$"
 # $HeadURL$
 
 import operator
-from geometry import rectangle_contains, rectangle_intersects, rectangle_clip
+from math import sqrt
+from heapq import heappush, heappop
+from geometry import Rectangle, rectangle_contains, rectangle_intersects, rectangle_clip
 
 
 class Quadtree(object):
@@ -80,36 +82,151 @@ class Quadtree(object):
     >>> sorted([qtree.get_bounds(item) for item in qtree.find_intersect((40, 40, 20, 20))])
     [(48, 30, 10, 10), (52, 40, 10, 10), (56, 50, 10, 10), (60, 60, 10, 10)]
     >>> qtree.rebuild()
+
+    Items that cross the center lines of a bucket are kept in that bucket.
+    Long lines therefore tend to pile up in the top-level bucket. A loose
+    quadtree avoids this: the bounds of the sub-buckets are enlarged by
+    ``looseness`` and items are placed according to their center:
+
+    >>> qtree = Quadtree((0, 0, 100, 100), capacity=2, looseness=2.0)
+    >>> for i in range(4):
+    ...     qtree.add('%d' % i, (i * 20 + 5, 45, 10, 10))
+    >>> sorted(qtree._bucket.items)
+    []
+    >>> sorted(qtree.find_intersect((30, 40, 20, 20)))
+    ['1', '2']
+
+    Buckets are collapsed again when items are removed:
+
+    >>> qtree.stats()['depth']
+    2
+    >>> for i in range(4):
+    ...     qtree.remove('%d' % i)
+    >>> qtree.stats()['depth']
+    1
+
+    A growing quadtree does not clip items. Instead the top-level bucket is
+    doubled in size, until the item fits:
+
+    >>> qtree = Quadtree((0, 0, 100, 100), grow=True)
+    >>> qtree.add('far', (250, -30, 10, 10))
+    >>> qtree.bounds
+    (0, -100, 400, 400)
+    >>> qtree.find_intersect((240, -40, 20, 20))
+    set(['far'])
     """
 
-    def __init__(self, bounds=(0, 0, 0, 0), capacity=10):
+    # Boundaries for capacity auto-tuning
+    MIN_CAPACITY = 4
+    MAX_CAPACITY = 256
+
+    # Number of operations (queries and inserts) between two tuning rounds
+    TUNE_INTERVAL = 1000
+
+    # Cost of visiting a bucket, relative to testing one item
+    BUCKET_COST = 4
+
+    # Minimal relative gain in cost per operation for a capacity change to
+    # be kept
+    TUNE_GAIN = 0.02
+
+    # Number of tuning rounds the capacity is left alone after a change
+    # has been reverted
+    TUNE_HOLD = 4
+
+    def __init__(self, bounds=(0, 0, 0, 0), capacity=10, looseness=1.0, autotune=False, grow=False):
         """
         Create a new Quadtree instance.
         
         Bounds is the boundries of the quadtree. this is fixed and do not
-        change depending on the contents.
+        change depending on the contents, unless grow is set. In that case
+        the tree grows as items are added outside the bounds, so items are
+        never clipped.
         
         Capacity defines the number of elements in one tree bucket (default: 10)
+
+        Looseness defines the factor by which the bounds of sub-buckets are
+        enlarged. The default, 1.0, results in a regular quadtree. A value
+        of 2.0 is common for loose quadtrees.
+
+        If autotune is set, the capacity is adapted to the measured cost
+        of queries and inserts (see `tune()`).
         """
+        if looseness < 1.0:
+            raise ValueError('Looseness should be 1.0 or larger')
         self._capacity = capacity
-        self._bucket = QuadtreeBucket(bounds, capacity)
+        self._looseness = looseness
+        self._autotune = autotune
+        self._grow = grow
+        self._bucket = QuadtreeBucket(bounds, capacity, looseness)
 
         # Easy lookup item->(bounds, data, clipped bounds) mapping
         self._ids = dict()
 
+        # Items that lie outside the tree altogether (their clipped bounds
+        # are empty). They are not held by any bucket.
+        self._outside = set()
+
+        # Operation counters, used for auto-tuning
+        self._counters = dict.fromkeys(('queries', 'query_buckets',
+                'item_tests', 'item_hits', 'inserts', 'insert_buckets'), 0)
+
+        # Capacity and cost before the last tuning step, None if the
+        # last round did not change the capacity
+        self._tune_step = None
+        self._tune_hold = 0
+
 
     bounds = property(lambda s: s._bucket.bounds)
 
+    capacity = property(lambda s: s._capacity)
+
+    looseness = property(lambda s: s._looseness)
+
+    grow = property(lambda s: s._grow)
+
 
     def resize(self, bounds):
         """
         Resize the tree.
         The tree structure is rebuild.
         """
-        self._bucket = QuadtreeBucket(bounds, self._capacity)
+        self._bucket = QuadtreeBucket(bounds, self._capacity, self._looseness)
         self.rebuild()
 
 
+    def _clip(self, bounds):
+        """
+        Clip bounds to the top-level bucket. Growing trees are not clipped.
+        """
+        if self._grow:
+            return tuple(bounds)
+        return rectangle_clip(bounds, self._bucket.bounds)
+
+
+    def _grown_bounds(self, bounds):
+        """
+        Return the bounds of the top-level bucket, doubled in size as often
+        as needed to contain ``bounds``. The tree is grown towards the
+        given bounds.
+        """
+        rx, ry, rw, rh = self._bucket.bounds
+        if rw <= 0 or rh <= 0:
+            # No proper bounds yet, start from the current content
+            if self._ids:
+                bounds = Rectangle(*self.soft_bounds) + bounds
+            bx, by, bw, bh = bounds
+            rx, ry, rw, rh = bx, by, max(bw, 1), max(bh, 1)
+        bx, by, bw, bh = bounds
+        while not rectangle_contains(bounds, (rx, ry, rw, rh)):
+            if bx < rx:
+                rx -= rw
+            if by < ry:
+                ry -= rh
+            rw, rh = rw * 2, rh * 2
+        return rx, ry, rw, rh
+
+
     def get_soft_bounds(self):
         """
         Calculate the size of all items in the tree. This size may be beyond
@@ -129,20 +246,66 @@ class Quadtree(object):
 
         >>> qtree.bounds
         (0, 0, 0, 0)
-        """
-        x_y_w_h = zip(*map(operator.getitem, self._ids.itervalues(), [0] * len(self._ids)))
-        if not x_y_w_h:
+
+        The extents of the items are kept per bucket. Only the buckets
+        affected by a change (and their parents) are recalculated:
+
+        >>> qtree.add('2', (20, 30, 40, 30))
+        >>> qtree.soft_bounds
+        (10, 20, 50, 40)
+        >>> qtree.remove('1')
+        >>> qtree.soft_bounds
+        (20, 30, 40, 30)
+        """
+        x0, y0, x1, y1 = self._bucket_extents(self._bucket) or (None,) * 4
+        ids = self._ids
+        for item in self._outside:
+            x, y, w, h = ids[item][0]
+            if x0 is None:
+                x0, y0, x1, y1 = x, y, x + w, y + h
+            else:
+                x0, y0, x1, y1 = min(x0, x), min(y0, y), max(x1, x + w), max(y1, y + h)
+        if x0 is None:
             return 0, 0, 0, 0
-        x0 = min(x_y_w_h[0])
-        y0 = min(x_y_w_h[1])
-        add = operator.add
-        x1 = max(map(add, x_y_w_h[0], x_y_w_h[2]))
-        y1 = max(map(add, x_y_w_h[1], x_y_w_h[3]))
         return (x0, y0, x1 - x0, y1 - y0)
 
     soft_bounds = property(get_soft_bounds)
 
 
+    def _bucket_extents(self, bucket):
+        """
+        Return the extents (x0, y0, x1, y1) of the (original, not clipped)
+        bounds of the items in ``bucket`` and its sub-buckets. An empty
+        tuple is returned for an empty bucket.
+
+        The extents are cached on the bucket. Buckets reset their cached
+        extents (and those of their parents) when their content changes.
+        """
+        extents = bucket.extents
+        if extents is None:
+            ids = self._ids
+            x_y_w_h = zip(*(ids[item][0] for item in bucket.items))
+            if x_y_w_h:
+                add = operator.add
+                extents = [min(x_y_w_h[0]), min(x_y_w_h[1]),
+                           max(map(add, x_y_w_h[0], x_y_w_h[2])),
+                           max(map(add, x_y_w_h[1], x_y_w_h[3]))]
+            for sub in bucket._buckets:
+                sub_extents = self._bucket_extents(sub)
+                if not sub_extents:
+                    continue
+                if not extents:
+                    extents = list(sub_extents)
+                else:
+                    x0, y0, x1, y1 = sub_extents
+                    extents[0] = min(extents[0], x0)
+                    extents[1] = min(extents[1], y0)
+                    extents[2] = max(extents[2], x1)
+                    extents[3] = max(extents[3], y1)
+            extents = bucket.extents = tuple(extents or ())
+        return extents
+
+
     def add(self, item, bounds, data=None):
         """
         Add an item to the tree.
@@ -150,10 +313,17 @@ class Quadtree(object):
         moved to the right bucket.
         Data can be used to add some extra info to the item
         """
+        if self._grow and not rectangle_contains(bounds, self._bucket.bounds):
+            # Register the item and let the tree rebuild itself
+            self._ids[item] = (bounds, data, tuple(bounds))
+            self.resize(self._grown_bounds(bounds))
+            return
+
         # Clip item bounds to fit in top-level bucket
         # Keep original bounds in _ids, for reference
-        clipped_bounds = rectangle_clip(bounds, self._bucket.bounds)
+        clipped_bounds = self._clip(bounds)
 
+        old_bucket = None
         if item in self._ids:
             old_clip = self._ids[item][2]
             if old_clip:
@@ -161,27 +331,46 @@ class Quadtree(object):
                 assert item in bucket.items
                 # Fast lane, if item moved just a little it may still reside
                 # in the same bucket. We do not need to search from top-level.
-                if bucket and clipped_bounds and \
-                        rectangle_contains(clipped_bounds, bucket.bounds):
+                if bucket and clipped_bounds and bucket.owns(clipped_bounds):
                     bucket.update(item, clipped_bounds)
                     self._ids[item] = (bounds, data, clipped_bounds)
                     return
                 elif bucket:
                     bucket.remove(item)
+                    old_bucket = bucket
 
         if clipped_bounds:
-            self._bucket.find_bucket(clipped_bounds).add(item, clipped_bounds)
+            bucket = self._bucket.find_bucket(clipped_bounds)
+            bucket.add(item, clipped_bounds)
+            if self._autotune:
+                counters = self._counters
+                counters['inserts'] += 1
+                counters['insert_buckets'] += bucket.depth()
+            self._outside.discard(item)
+        else:
+            self._outside.add(item)
         self._ids[item] = (bounds, data, clipped_bounds)
 
+        # Collapse after the item has been added, so the tree does not
+        # collapse and split again.
+        if old_bucket:
+            old_bucket.collapse()
+        if self._autotune:
+            self._tune_interval()
+
 
     def remove(self, item):
         """
         Remove an item from the tree.
+        Buckets that become (nearly) empty are collapsed.
         """
         bounds, data, clipped_bounds = self._ids[item]
         del self._ids[item]
+        self._outside.discard(item)
         if clipped_bounds:
-            self._bucket.find_bucket(clipped_bounds).remove(item)
+            bucket = self._bucket.find_bucket(clipped_bounds)
+            bucket.remove(item)
+            bucket.collapse()
 
 
     def clear(self):
@@ -190,6 +379,7 @@ class Quadtree(object):
         """
         self._bucket.clear()
         self._ids.clear()
+        self._outside.clear()
 
 
     def rebuild(self):
@@ -199,10 +389,19 @@ class Quadtree(object):
         # Clean bucket and items:
         self._bucket.clear()
 
+        if self._grow and self._ids:
+            soft_bounds = self.soft_bounds
+            if not rectangle_contains(soft_bounds, self._bucket.bounds):
+                self._bucket = QuadtreeBucket(self._grown_bounds(soft_bounds),
+                                              self._capacity, self._looseness)
+
+        self._outside.clear()
         for item, (bounds, data, _) in dict(self._ids).iteritems():
-            clipped_bounds = rectangle_clip(bounds, self._bucket.bounds)
+            clipped_bounds = self._clip(bounds)
             if clipped_bounds:
                 self._bucket.find_bucket(clipped_bounds).add(item, clipped_bounds)
+            else:
+                self._outside.add(item)
             self._ids[item] = (bounds, data, clipped_bounds)
 
 
@@ -234,6 +433,8 @@ class Quadtree(object):
         Find all items in the given rectangle (x, y, with, height).
         Returns a set.
         """
+        if self._autotune:
+            return self._find_measured(rect, rectangle_contains)
         return set(self._bucket.find(rect, method=rectangle_contains))
         
 
@@ -243,8 +444,261 @@ class Quadtree(object):
         (x, y, width, height).
         Returns a set.
         """
+        if self._autotune:
+            return self._find_measured(rect, rectangle_intersects)
         return set(self._bucket.find(rect, method=rectangle_intersects))
-        
+
+
+    def find_point(self, x, y):
+        """
+        Find all items whose bounds contain the point (x, y).
+        Only buckets containing the point are visited.
+        Returns a set.
+
+        >>> qtree = Quadtree((0, 0, 100, 100))
+        >>> qtree.add('a', (10, 10, 20, 20))
+        >>> qtree.add('b', (20, 20, 20, 20))
+        >>> sorted(qtree.find_point(25, 25))
+        ['a', 'b']
+        >>> sorted(qtree.find_point(35, 35))
+        ['b']
+        """
+        found = set()
+        buckets = [self._bucket]
+        while buckets:
+            bucket = buckets.pop()
+            bx, by, bw, bh = bucket.loose_bounds
+            if bx <= x <= bx + bw and by <= y <= by + bh:
+                for item, (ix, iy, iw, ih) in bucket.items.iteritems():
+                    if ix <= x <= ix + iw and iy <= y <= iy + ih:
+                        found.add(item)
+                buckets.extend(bucket._buckets)
+        return found
+
+
+    def find_nearest(self, x, y, k=1, max_distance=None):
+        """
+        Find the ``k`` items nearest to the point (x, y). The distance is
+        measured from the point to the item's bounds. Items further away
+        than ``max_distance`` are ignored. If ``k`` is None, all items within
+        ``max_distance`` are returned.
+
+        Returns a list, nearest item first.
+
+        >>> qtree = Quadtree((0, 0, 100, 100))
+        >>> qtree.add('a', (10, 10, 10, 10))
+        >>> qtree.add('b', (50, 10, 10, 10))
+        >>> qtree.add('c', (80, 80, 10, 10))
+        >>> qtree.find_nearest(40, 15)
+        ['b']
+        >>> qtree.find_nearest(40, 15, k=2)
+        ['b', 'a']
+        >>> qtree.find_nearest(40, 15, k=None, max_distance=15)
+        ['b']
+        """
+        found = []
+        for distance, item in self.iter_nearest(x, y, max_distance):
+            found.append(item)
+            if k and len(found) >= k:
+                break
+        return found
+
+
+    def iter_nearest(self, x, y, max_distance=None):
+        """
+        Iterate the items near the point (x, y), nearest first. Tuples
+        (distance, item) are returned.
+
+        Buckets are visited nearest first and only when the iteration
+        proceeds, so a caller that stops early never visits buckets
+        further away.
+
+        >>> qtree = Quadtree((0, 0, 100, 100))
+        >>> qtree.add('a', (10, 10, 10, 10))
+        >>> qtree.add('b', (50, 10, 10, 10))
+        >>> list(qtree.iter_nearest(40, 15))
+        [(10.0, 'b'), (20.0, 'a')]
+        """
+        if max_distance is None:
+            limit = float('inf')
+        else:
+            limit = max_distance * max_distance
+        counter = 0
+        heap = [(0, counter, self._bucket, None)]
+        while heap:
+            d, _, bucket, item = heappop(heap)
+            if bucket is None:
+                yield sqrt(d), item
+                continue
+            for item, bounds in bucket.items.iteritems():
+                d = _distance2(bounds, x, y)
+                if d <= limit:
+                    counter += 1
+                    heappush(heap, (d, counter, None, item))
+            for b in bucket._buckets:
+                d = _distance2(b.loose_bounds, x, y)
+                if d <= limit:
+                    counter += 1
+                    heappush(heap, (d, counter, b, None))
+
+
+    def _find_measured(self, rect, method):
+        """
+        Like ``QuadtreeBucket.find()``, but keep track of the number of
+        buckets visited and items tested.
+        """
+        found = set()
+        visited = tests = 0
+        buckets = [self._bucket]
+        while buckets:
+            bucket = buckets.pop()
+            visited += 1
+            if rectangle_intersects(rect, bucket.loose_bounds):
+                tests += len(bucket.items)
+                for item, bounds in bucket.items.iteritems():
+                    if method(bounds, rect):
+                        found.add(item)
+                buckets.extend(bucket._buckets)
+
+        counters = self._counters
+        counters['queries'] += 1
+        counters['query_buckets'] += visited
+        counters['item_tests'] += tests
+        counters['item_hits'] += len(found)
+        self._tune_interval()
+        return found
+
+
+    def _tune_interval(self):
+        """
+        Tune the tree once every ``TUNE_INTERVAL`` operations.
+        """
+        counters = self._counters
+        if counters['queries'] + counters['inserts'] >= self.TUNE_INTERVAL:
+            self.tune()
+
+
+    def tune(self):
+        """
+        Adapt the bucket capacity to the measured query and insert costs.
+
+        The cost of an operation is expressed in item tests, visiting a
+        bucket costs ``BUCKET_COST`` tests.
+
+        Halving the capacity adds about half a level to the tree: queries
+        test about half as many items that do not match (the matching items
+        are tested anyway), but each query and insert visits more buckets.
+        Doubling the capacity does the opposite. The capacity
+        is changed (by a factor of two at most) if the expected gain
+        outweighs the expected loss.
+
+        The estimate is not always right: how deep the tree gets depends on
+        how the items are spread more than on the capacity. Therefore the
+        next round checks the change: if the cost per operation did not drop
+        by at least ``TUNE_GAIN``, the old capacity is restored and left
+        alone for ``TUNE_HOLD`` rounds.
+
+        The tree is rebuild if the capacity changes. The measurements are
+        reset afterwards.
+
+        Returns the (new) capacity.
+
+        >>> qtree = Quadtree((0, 0, 100, 100), autotune=True)
+        >>> qtree._counters.update(queries=100, query_buckets=100, item_tests=10)
+        >>> qtree.tune()
+        20
+        >>> qtree._counters.update(queries=100, query_buckets=100, item_tests=20)
+        >>> qtree.tune()
+        10
+        >>> qtree._counters.update(queries=100, query_buckets=100, item_tests=10)
+        >>> qtree.tune()
+        10
+        """
+        counters = self._counters
+        operations = counters['queries'] + counters['inserts']
+        visits = counters['query_buckets'] + counters['insert_buckets']
+        tests = counters['item_tests']
+        misses = tests - counters['item_hits']
+        cost = float(self.BUCKET_COST * visits + tests) / max(operations, 1)
+        # Cost of visiting the buckets of half a level:
+        half_level = self.BUCKET_COST * visits / (2. * self.stats()['depth'])
+
+        for key in counters:
+            counters[key] = 0
+
+        step, self._tune_step = self._tune_step, None
+        if step:
+            capacity, previous_cost = step
+            if cost > previous_cost * (1. - self.TUNE_GAIN):
+                # The last change did not pay off
+                self._tune_hold = self.TUNE_HOLD
+                return self._set_capacity(capacity)
+
+        capacity = self._capacity
+        if self._tune_hold:
+            self._tune_hold -= 1
+        elif misses > 2 * half_level:
+            capacity = max(self.MIN_CAPACITY, capacity // 2)
+        elif misses < half_level:
+            capacity = min(self.MAX_CAPACITY, capacity * 2)
+
+        if capacity != self._capacity:
+            self._tune_step = (self._capacity, cost)
+        return self._set_capacity(capacity)
+
+
+    def _set_capacity(self, capacity):
+        """
+        Set the bucket capacity and rebuild the tree if it changed.
+        """
+        if capacity != self._capacity:
+            self._capacity = capacity
+            self._bucket.capacity = capacity
+            self.rebuild()
+        return capacity
+
+
+    def stats(self):
+        """
+        Return statistics on the tree structure as a dictionary:
+
+        - items: number of items in the tree
+        - capacity: bucket capacity
+        - depth: number of levels in the tree
+        - buckets: number of buckets in the tree
+        - items_per_level: number of items held by the buckets per level
+        - buckets_per_level: number of buckets per level
+        - fill_factors: average fill factor (items / capacity) per level
+
+        >>> qtree = Quadtree((0, 0, 100, 100), capacity=4)
+        >>> for i in range(5):
+        ...     qtree.add(i, (i * 20, i * 20, 5, 5))
+        >>> stats = qtree.stats()
+        >>> stats['depth'], stats['buckets']
+        (2, 5)
+        >>> stats['items_per_level']
+        [0, 5]
+        >>> stats['fill_factors']
+        [0.0, 0.3125]
+        """
+        items_per_level = []
+        buckets_per_level = []
+        level = [self._bucket]
+        while level:
+            items_per_level.append(sum(len(b.items) for b in level))
+            buckets_per_level.append(len(level))
+            level = [sb for b in level for sb in b._buckets]
+
+        capacity = float(self._capacity)
+        return dict(items=len(self._ids),
+                    capacity=self._capacity,
+                    depth=len(buckets_per_level),
+                    buckets=sum(buckets_per_level),
+                    items_per_level=items_per_level,
+                    buckets_per_level=buckets_per_level,
+                    fill_factors=[i / (b * capacity) for i, b in zip(items_per_level, buckets_per_level)])
+
+
 
     def __len__(self):
         """
@@ -267,21 +721,62 @@ class Quadtree(object):
         self._bucket.dump()
 
 
+def _distance2(rect, x, y):
+    """
+    Return the squared distance from point (x, y) to rectangle ``rect``.
+    """
+    rx, ry, rw, rh = rect
+    if x < rx:
+        dx = rx - x
+    elif x > rx + rw:
+        dx = x - rx - rw
+    else:
+        dx = 0
+    if y < ry:
+        dy = ry - y
+    elif y > ry + rh:
+        dy = y - ry - rh
+    else:
+        dy = 0
+    return dx * dx + dy * dy
+
+
 class QuadtreeBucket(object):
     """
     A node in a Quadtree structure.
+
+    ``bounds`` is the area covered by the bucket. Items stored in the bucket
+    (or its sub-buckets) should fit in ``loose_bounds``. For a regular
+    quadtree both are the same.
     """
 
-    def __init__(self, bounds, capacity):
+    def __init__(self, bounds, capacity, looseness=1.0, loose_bounds=None, parent=None):
         """
         Set bounding box for the node as (x, y, width, height).
         """
         self.bounds = bounds
+        self.loose_bounds = loose_bounds or bounds
         self.capacity = capacity
+        self.looseness = looseness
+        self.parent = parent
 
         self.items = {}
         self._buckets = []
 
+        # Extents of the items in the bucket and its sub-buckets, as
+        # maintained by the Quadtree. None if they need to be recalculated.
+        self.extents = None
+
+
+    def invalidate(self):
+        """
+        Reset the cached extents of this bucket and its parents.
+        """
+        bucket = self
+        while bucket:
+            bucket.extents = None
+            bucket = bucket.parent
+
 
     def add(self, item, bounds):
         """
@@ -289,16 +784,17 @@ class QuadtreeBucket(object):
         The bucket is split when nessecary.
         Items are otherwise added to this bucket, not some sub-bucket.
         """
-        assert rectangle_contains(bounds, self.bounds)
+        assert rectangle_contains(bounds, self.loose_bounds)
+        self.invalidate()
         # create new subnodes if threshold is reached
         if not self._buckets and len(self.items) >= self.capacity:
             x, y, w, h = self.bounds
             rw, rh = w / 2., h / 2.
             cx, cy = x + rw, y + rh
-            self._buckets = [QuadtreeBucket((x, y, rw, rh), self.capacity),
-                             QuadtreeBucket((cx, y, rw, rh), self.capacity),
-                             QuadtreeBucket((x, cy, rw, rh), self.capacity),
-                             QuadtreeBucket((cx, cy, rw, rh), self.capacity)]
+            self._buckets = [self._create_bucket((x, y, rw, rh)),
+                             self._create_bucket((cx, y, rw, rh)),
+                             self._create_bucket((x, cy, rw, rh)),
+                             self._create_bucket((cx, cy, rw, rh))]
             # Add items to subnodes
             items = self.items.items()
             self.items.clear()
@@ -309,12 +805,64 @@ class QuadtreeBucket(object):
             self.items[item] = bounds
 
 
+    def _create_bucket(self, bounds):
+        """
+        Create a sub-bucket for ``bounds``. For loose quadtrees the loose
+        bounds of the new bucket are enlarged by the looseness factor.
+        """
+        looseness = self.looseness
+        if looseness == 1.0:
+            return QuadtreeBucket(bounds, self.capacity, parent=self)
+        x, y, w, h = bounds
+        dx, dy = w * (looseness - 1) / 2., h * (looseness - 1) / 2.
+        return QuadtreeBucket(bounds, self.capacity, looseness,
+                              (x - dx, y - dy, w + 2 * dx, h + 2 * dy), self)
+
+
     def remove(self, item):
         """
         Remove an item from the quadtree bucket.
         The item should be contained by *this* bucket (not a sub-bucket).
         """
         del self.items[item]
+        self.invalidate()
+
+
+    def collapse(self):
+        """
+        Merge the sub-buckets back into this bucket if their combined
+        population dropped to half the capacity or below. Only sub-buckets
+        without sub-buckets of their own are merged.
+
+        Parent buckets are collapsed as well, as far as possible.
+        """
+        buckets = self._buckets
+        if buckets:
+            for bucket in buckets:
+                if bucket._buckets:
+                    return
+            if sum(len(b.items) for b in buckets) * 2 > self.capacity:
+                return
+            for bucket in buckets:
+                self.items.update(bucket.items)
+                bucket.parent = None
+            del buckets[:]
+            self.invalidate()
+        if self.parent:
+            self.parent.collapse()
+
+
+    def depth(self):
+        """
+        Return the level of this bucket in the tree. The top-level bucket
+        has depth 1.
+        """
+        depth = 1
+        parent = self.parent
+        while parent:
+            depth += 1
+            parent = parent.parent
+        return depth
         
 
     def update(self, item, new_bounds):
@@ -335,7 +883,19 @@ class QuadtreeBucket(object):
         This method should be used to find a bucket that fits, before add()
         or remove() is called.
         """
-        if self._buckets:
+        if self._buckets and self.looseness != 1.0:
+            sx, sy, sw, sh = self.bounds
+            x, y, w, h = bounds
+            index = 0
+            if x + w / 2. >= sx + sw / 2.:
+                index += 1
+            if y + h / 2. >= sy + sh / 2.:
+                index += 2
+            bucket = self._buckets[index]
+            if rectangle_contains(bounds, bucket.loose_bounds):
+                return bucket.find_bucket(bounds)
+            return self
+        elif self._buckets:
             sx, sy, sw, sh = self.bounds
             cx, cy = sx + sw / 2., sy + sh / 2.
             x, y, w, h = bounds
@@ -353,6 +913,20 @@ class QuadtreeBucket(object):
         return self
 
 
+    def owns(self, bounds):
+        """
+        Return True if a lookup of ``bounds`` from the top-level bucket
+        would end up in this bucket or one of its sub-buckets.
+        """
+        if self.looseness == 1.0:
+            return rectangle_contains(bounds, self.bounds)
+        sx, sy, sw, sh = self.bounds
+        x, y, w, h = bounds
+        cx, cy = x + w / 2., y + h / 2.
+        return sx <= cx < sx + sw and sy <= cy < sy + sh \
+                and rectangle_contains(bounds, self.loose_bounds)
+
+
     def find(self, rect, method):
         """
         Find all items in the given rectangle (x, y, with, height).
@@ -360,7 +934,7 @@ class QuadtreeBucket(object):
 
         Returns an iterator.
         """
-        if rectangle_intersects(rect, self.bounds):
+        if rectangle_intersects(rect, self.loose_bounds):
             for item, bounds in self.items.iteritems():
                 if method(bounds, rect):
                     yield item
@@ -375,6 +949,7 @@ class QuadtreeBucket(object):
         """
         del self._buckets[:]
         self.items.clear()
+        self.invalidate()
 
 
     def dump(self, indent=''):
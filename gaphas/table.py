@@ -120,6 +120,24 @@ class Table(object):
                         del index[n][v]
 
 
+    def __iter__(self):
+        """
+        Iterate over all rows, in no particular order.
+
+        >>> from collections import namedtuple
+        >>> C = namedtuple('C', "foo bar baz")
+        >>> s = Table(C, (0, 1,))
+        >>> s.insert('a', 'b', 'c')
+        >>> s.insert(1, 2, 3)
+        >>> sorted(s)
+        [C(foo=1, bar=2, baz=3), C(foo='a', bar='b', baz='c')]
+        """
+        # Each row is in the index of each indexed column
+        for rows in self._index[self._indexes[0]].itervalues():
+            for row in rows:
+                yield row
+
+
     def query(self, **kv):
         """
         Get rows (tuples) for each key defined. An iterator is returned.
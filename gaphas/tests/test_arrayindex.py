@@ -0,0 +1,98 @@
+
+import unittest
+import random
+from gaphas.quadtree import Quadtree
+
+try:
+    from gaphas.arrayindex import ArrayIndex
+except ImportError:
+    # NumPy is not available
+    ArrayIndex = None
+
+
+def random_items(n, seed=0):
+    r = random.Random(seed)
+    return [('item%d' % i, (r.uniform(0, 1000), r.uniform(0, 1000),
+                            r.uniform(1, 200), r.uniform(1, 200)))
+            for i in range(n)]
+
+
+def nearest(index, x, y):
+    return sorted((round(d, 6), i) for d, i in index.iter_nearest(x, y, max_distance=20))
+
+
+class ArrayIndexTestCase(unittest.TestCase):
+
+    def test_add_and_remove(self):
+        index = ArrayIndex(capacity=2)
+        for i in range(10):
+            index.add(i, (i * 10, 0, 5, 5), data=i * 2)
+        assert len(index) == 10, len(index)
+        assert 4 in index
+        assert index.get_bounds(4) == (40, 0, 5, 5)
+        assert index.get_data(4) == 8
+        assert index.find_intersect((40, 0, 1, 1)) == set([4])
+
+        index.remove(4)
+        assert len(index) == 9
+        assert 4 not in index
+        assert index.find_intersect((40, 0, 1, 1)) == set()
+
+        index.clear()
+        assert len(index) == 0
+        assert index.find_intersect((0, 0, 100, 100)) == set()
+
+
+    def test_moving_items(self):
+        index = ArrayIndex()
+        index.add('a', (0, 0, 10, 10))
+        index.rebuild()
+        index.add('a', (100, 100, 10, 10))
+        assert index.find_point(5, 5) == set()
+        assert index.find_point(105, 105) == set(['a'])
+        index.rebuild()
+        assert index.find_point(5, 5) == set()
+        assert index.find_point(105, 105) == set(['a'])
+
+
+    def test_same_results_as_quadtree(self):
+        items = random_items(500)
+        qtree = Quadtree((0, 0, 1200, 1200))
+        index = ArrayIndex()
+        for item, bounds in items:
+            qtree.add(item, bounds)
+            index.add(item, bounds)
+        # Move and remove some items, so both the snapshot and the pending
+        # items are queried
+        for item, bounds in random_items(100, seed=1):
+            qtree.add(item, bounds)
+            index.add(item, bounds)
+        for item, bounds in items[400:450]:
+            qtree.remove(item)
+            index.remove(item)
+
+        r = random.Random(2)
+        for i in range(100):
+            rect = (r.uniform(0, 1000), r.uniform(0, 1000), r.uniform(0, 300), r.uniform(0, 300))
+            assert index.find_intersect(rect) == set(qtree.find_intersect(rect))
+            assert index.find_inside(rect) == set(qtree.find_inside(rect))
+            x, y = rect[:2]
+            assert index.find_point(x, y) == set(qtree.find_point(x, y))
+            assert nearest(index, x, y) == nearest(qtree, x, y)
+
+
+    def test_soft_bounds(self):
+        index = ArrayIndex()
+        assert index.soft_bounds == (0, 0, 0, 0)
+        index.add('a', (10, 10, 10, 10))
+        index.add('b', (-10, 50, 10, 10))
+        assert index.soft_bounds == (-10, 10, 30, 50), index.soft_bounds
+        index.remove('b')
+        assert index.soft_bounds == (10, 10, 10, 10), index.soft_bounds
+
+
+if ArrayIndex is None:
+    del ArrayIndexTestCase
+
+
+# vim:sw=4:et:ai
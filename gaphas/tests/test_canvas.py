@@ -31,6 +31,20 @@ class MatricesTestCase(unittest.TestCase):
         c.add(b2, b1)
         c.reparent(b2, None)
 
+    def test_update_increases_version_of_parents(self):
+        c = Canvas()
+        b1 = Box()
+        b2 = Box()
+        c.add(b1)
+        c.add(b2, b1)
+        c.update_now()
+
+        v1, v2 = b1._version, b2._version
+        c.request_update(b2)
+        c.update_now()
+        assert b2._version == v2 + 1
+        assert b1._version == v1 + 1, (b1._version, v1)
+
 # fixme: what about multiple constraints for a handle?
 #        what about 1d projection?
 
@@ -154,6 +168,32 @@ class CanvasTestCase(unittest.TestCase):
         self.assertEquals(2, len(c.solver.constraints))
 
 
+    def test_get_connection_follows_connections(self):
+        b1 = Box()
+        b2 = Box()
+        l = Line()
+        c = Canvas()
+        c.add(b1)
+        c.add(b2)
+        c.add(l)
+        h = l.handles()[0]
+
+        assert c.get_connection(h) is None
+        c.connect_item(l, h, b1, b1.ports()[0])
+        assert c.get_connection(h).connected is b1
+
+        cons = b1.ports()[0].constraint(c, l, h, b1)
+        c.reconnect_item(l, h, cons)
+        assert c.get_connection(h).constraint is cons
+
+        c.disconnect_item(l, h)
+        assert c.get_connection(h) is None
+
+        c.connect_item(l, h, b2, b2.ports()[0])
+        c.remove(b2)
+        assert c.get_connection(h) is None
+
+
 class ConstraintProjectionTestCase(unittest.TestCase):
 
     def test_line_projection(self):
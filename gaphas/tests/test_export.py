@@ -0,0 +1,126 @@
+
+import unittest
+import re
+import struct
+import zlib
+from StringIO import StringIO
+import cairo
+from gaphas.canvas import Canvas
+from gaphas.view import View
+from gaphas.painter import ItemPainter
+from gaphas.examples import Box
+from gaphas.export import TileRenderer, Exporter
+
+
+def create_canvas():
+    canvas = Canvas()
+    for i in range(10):
+        box = Box(40, 30)
+        box.matrix.translate(i * 45, i * 20)
+        canvas.add(box)
+    return canvas
+
+
+def create_view():
+    view = View(create_canvas())
+    view.painter = ItemPainter()
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 0, 0)
+    view.update_bounding_box(cairo.Context(surface))
+    return view
+
+
+def render(renderer):
+    b = renderer.view.bounding_box
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, int(b.width) + 1, int(b.height) + 1)
+    renderer.render(cairo.Context(surface))
+    return str(surface.get_data())
+
+
+class TileRendererTestCase(unittest.TestCase):
+
+    def test_tiles(self):
+        renderer = TileRenderer(create_view(), tile_size=100)
+        tiles = renderer.tiles((-10, 0, 250, 100))
+        assert tiles[0] == (-10, 0, 100, 100), tiles
+        assert tiles[2] == (190, 0, 50, 100), tiles
+        assert len(tiles) == 3, tiles
+
+    def test_threads_produce_the_same_image(self):
+        view = create_view()
+        single = render(TileRenderer(view, tile_size=64, threads=1))
+        threaded = render(TileRenderer(view, tile_size=64, threads=4))
+        assert single == threaded
+
+    def test_tiles_are_ordered(self):
+        renderer = TileRenderer(create_view(), tile_size=32, threads=3)
+        rects = [rect for rect, surface in renderer.iter_tiles()]
+        assert rects == renderer.tiles()
+
+    def test_errors_keep_the_traceback(self):
+        import sys
+        import traceback
+
+        class BrokenBox(Box):
+            def draw(self, context):
+                raise ZeroDivisionError('broken')
+
+        view = create_view()
+        view.canvas.add(BrokenBox())
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 0, 0)
+        view.update_bounding_box(cairo.Context(surface))
+
+        renderer = TileRenderer(view, tile_size=64, threads=2)
+        try:
+            list(renderer.iter_tiles())
+        except ZeroDivisionError:
+            functions = [f[2] for f in traceback.extract_tb(sys.exc_info()[2])]
+            assert 'draw' in functions, functions
+        else:
+            assert False, 'ZeroDivisionError expected'
+
+
+class ExporterTestCase(unittest.TestCase):
+
+    def test_png(self):
+        exporter = Exporter(create_canvas(), band_height=32, threads=2)
+        f = StringIO()
+        exporter.write_png(f)
+        png = f.getvalue()
+        assert png.startswith('\x89PNG\r\n\x1a\n')
+        width, height = struct.unpack('!II', png[16:24])
+        assert (width, height) == exporter.size, (width, height)
+
+        # Decompress the image data: one filter byte and 3 bytes per pixel
+        data, pos = '', 8
+        while pos < len(png):
+            length, tag = struct.unpack('!I4s', png[pos:pos + 8])
+            if tag == 'IDAT':
+                data += png[pos + 8:pos + 8 + length]
+            pos += length + 12
+        assert len(zlib.decompress(data)) == height * (width * 3 + 1)
+
+    def test_removed_items_are_dropped(self):
+        canvas = create_canvas()
+        exporter = Exporter(canvas)
+        size = exporter.size
+        last = canvas.get_all_items()[-1]
+        canvas.remove(last)
+        exporter.update_bounding_box()
+        assert last not in exporter.view._matrices
+        assert exporter.size != size, (exporter.size, size)
+
+    def test_png_scale(self):
+        canvas = create_canvas()
+        w, h = Exporter(canvas).size
+        w2, h2 = Exporter(canvas, scale=2.0).size
+        assert abs(w2 - (w - 12) * 2 - 12) <= 2, (w, w2)
+        assert abs(h2 - (h - 12) * 2 - 12) <= 2, (h, h2)
+
+    def test_pdf_pages(self):
+        f = StringIO()
+        Exporter(create_canvas()).write_pdf(f, page_height=100)
+        assert f.getvalue().startswith('%PDF')
+        assert len(re.findall(r'/Type\s*/Page\b', f.getvalue())) == 3
+
+
+# vim:sw=4:et:ai
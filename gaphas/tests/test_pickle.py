@@ -124,6 +124,25 @@ class PickleTestCase(unittest.TestCase):
         assert h.disconnect() is None, h.disconnect()
 
 
+    def test_pickle_connection_lookup(self):
+        """
+        The handle to connection map is rebuilt on unpickling.
+        """
+        canvas = Canvas()
+        box = Box()
+        canvas.add(box)
+        line = Line()
+        canvas.add(line)
+        canvas.connect_item(line, line.handles()[0], box, box.ports()[0])
+
+        c2 = pickle.loads(pickle.dumps(canvas))
+        box2, line2 = c2.get_all_items()
+        cinfo = c2.get_connection(line2.handles()[0])
+        assert cinfo.item is line2
+        assert cinfo.connected is box2
+        assert c2.get_connection(line2.handles()[-1]) is None
+
+
     def test_pickle_with_view(self):
         canvas = create_canvas()
 
@@ -1,6 +1,7 @@
 
 import unittest
 from gaphas.quadtree import Quadtree
+from gaphas.geometry import rectangle_intersects, rectangle_contains
 
 class QuadtreeTestCase(unittest.TestCase):
 
@@ -92,6 +93,217 @@ class QuadtreeTestCase(unittest.TestCase):
         self.assertEquals((0, 0, 20, 20), qtree.get_clipped_bounds(1))
 
 
+    def test_loose_long_lines(self):
+        """
+        Long horizontal lines crossing the center do not end up in the
+        top-level bucket of a loose quadtree.
+        """
+        qtree = Quadtree((0, 0, 100, 100), capacity=4, looseness=2.0)
+        for i in range(20):
+            qtree.add(i, (30, i * 5, 40, 1))
+        assert len(qtree._bucket.items) < 20, qtree._bucket.items
+        self.assertEquals(set(range(20)), qtree.find_intersect((0, 0, 100, 100)))
+        self.assertEquals(set([0, 1]), qtree.find_intersect((40, 0, 1, 5)))
+
+    def test_loose_moving_and_removing(self):
+        import random
+        r = random.Random(42)
+        qtree = Quadtree((0, 0, 100, 100), capacity=4, looseness=2.0)
+        bounds = {}
+        for n in range(200):
+            i = r.randint(0, 50)
+            if i in bounds and r.random() < 0.3:
+                qtree.remove(i)
+                del bounds[i]
+                continue
+            b = (r.uniform(0, 90), r.uniform(0, 90), r.uniform(0, 40), r.uniform(0, 10))
+            qtree.add(i, b)
+            bounds[i] = qtree.get_clipped_bounds(i)
+
+        for rect in [(0, 0, 100, 100), (10, 10, 5, 5), (50, 50, 30, 2), (90, 0, 10, 100)]:
+            expected = set(i for i, b in bounds.iteritems() if rectangle_intersects(b, rect))
+            self.assertEquals(expected, qtree.find_intersect(rect))
+
+    def test_invalid_looseness(self):
+        self.assertRaises(ValueError, Quadtree, (0, 0, 100, 100), 10, 0.5)
+
+    def test_collapse_after_removal(self):
+        qtree = Quadtree((0, 0, 100, 100), capacity=10)
+        for i in range(0, 100, 10):
+            for j in range(0, 100, 10):
+                qtree.add("%dx%d" % (i, j), (i, j, 10, 10))
+        self.assertEquals(3, qtree.stats()['depth'])
+
+        for i in range(0, 100, 10):
+            for j in range(0, 90, 10):
+                qtree.remove("%dx%d" % (i, j))
+        stats = qtree.stats()
+        self.assertEquals(10, stats['items'])
+        self.assertEquals(10, sum(stats['items_per_level']))
+        self.assertEquals(2, stats['depth'])
+        self.assertEquals(set(["%dx90" % i for i in range(0, 100, 10)]),
+                          qtree.find_intersect((0, 0, 100, 100)))
+
+    def test_collapse_after_moving(self):
+        qtree = Quadtree((0, 0, 100, 100), capacity=4)
+        for i in range(10):
+            qtree.add(i, (i * 10, i * 10, 5, 5))
+        assert qtree.stats()['depth'] > 1
+        for i in range(10):
+            qtree.add(i, (45, 45, 10, 10))
+        self.assertEquals(1, qtree.stats()['depth'])
+        self.assertEquals(set(range(10)), qtree.find_intersect((50, 50, 1, 1)))
+
+    def test_autotune_capacity(self):
+        # Many items on one spot: item tests dominate, capacity decreases
+        qtree = Quadtree((0, 0, 1000, 1000), capacity=64, autotune=True)
+        for i in range(500):
+            qtree.add(i, ((i % 25) * 40, (i / 25) * 40, 10, 10))
+        for i in range(1000):
+            qtree.find_intersect((i % 1000, 5, 1, 1))
+        assert qtree.capacity < 64, qtree.capacity
+        self.assertEquals(qtree.capacity, qtree.stats()['capacity'])
+        self.assertEquals(500, len(qtree.find_intersect((0, 0, 1000, 1000))))
+
+    def test_tune_deep_tree(self):
+        # Tiny capacity: bucket visits dominate, capacity increases
+        qtree = Quadtree((0, 0, 1000, 1000), capacity=1)
+        qtree._counters.update(queries=10, query_buckets=100, item_tests=10)
+        self.assertEquals(2, qtree.tune())
+
+    def test_tune_reverts_useless_change(self):
+        qtree = Quadtree((0, 0, 1000, 1000), capacity=10, autotune=True)
+        qtree._counters.update(queries=100, query_buckets=400, item_tests=100)
+        self.assertEquals(20, qtree.tune())
+        # Cheaper: the new capacity is kept and the next step is taken
+        qtree._counters.update(queries=100, query_buckets=300, item_tests=100)
+        self.assertEquals(40, qtree.tune())
+        # No gain: back to the previous capacity, for a while
+        qtree._counters.update(queries=100, query_buckets=300, item_tests=110)
+        self.assertEquals(20, qtree.tune())
+        for i in range(qtree.TUNE_HOLD):
+            qtree._counters.update(queries=100, query_buckets=400, item_tests=100)
+            self.assertEquals(20, qtree.tune())
+
+    def test_find_point(self):
+        for looseness in (1.0, 2.0):
+            qtree = Quadtree((0, 0, 100, 100), capacity=4, looseness=looseness)
+            for i in range(0, 100, 10):
+                for j in range(0, 100, 10):
+                    qtree.add("%dx%d" % (i, j), (i, j, 8, 8))
+            self.assertEquals(set(['20x30']), qtree.find_point(24, 34))
+            self.assertEquals(set(), qtree.find_point(29, 34))
+            self.assertEquals(qtree.find_intersect((52, 3, 0, 0)), qtree.find_point(52, 3))
+
+    def test_find_nearest(self):
+        import random
+        r = random.Random(7)
+        qtree = Quadtree((0, 0, 100, 100), capacity=4, looseness=2.0)
+        for i in range(100):
+            qtree.add(i, (r.uniform(0, 95), r.uniform(0, 95), r.uniform(0, 5), r.uniform(0, 5)))
+
+        def distance(i, x, y):
+            bx, by, bw, bh = qtree.get_bounds(i)
+            dx = max(bx - x, 0, x - bx - bw)
+            dy = max(by - y, 0, y - by - bh)
+            return (dx * dx + dy * dy) ** 0.5
+
+        for x, y in [(0, 0), (50, 50), (99, 10), (120, 120)]:
+            expected = sorted(range(100), key=lambda i: distance(i, x, y))
+            nearest = qtree.find_nearest(x, y, k=5)
+            self.assertEquals(5, len(nearest))
+            self.assertEquals([distance(i, x, y) for i in expected[:5]],
+                              [distance(i, x, y) for i in nearest])
+
+            within = qtree.find_nearest(x, y, k=None, max_distance=10)
+            self.assertEquals(set(i for i in expected if distance(i, x, y) <= 10), set(within))
+
+    def test_grow(self):
+        import random
+        r = random.Random(3)
+        for looseness in (1.0, 2.0):
+            qtree = Quadtree(capacity=4, looseness=looseness, grow=True)
+            bounds = {}
+            for n in range(300):
+                i = r.randint(0, 60)
+                b = (r.uniform(-1000, 1000), r.uniform(-1000, 1000), r.uniform(0, 50), r.uniform(0, 50))
+                qtree.add(i, b)
+                bounds[i] = b
+                if n % 7 == 0:
+                    i = r.choice(bounds.keys())
+                    qtree.remove(i)
+                    del bounds[i]
+
+            assert rectangle_contains(qtree.soft_bounds, qtree.bounds)
+            for i, b in bounds.iteritems():
+                self.assertEquals(b, qtree.get_clipped_bounds(i))
+            for rect in [(-1000, -1000, 2000, 2000), (0, 0, 100, 100), (-500, 200, 300, 2)]:
+                expected = set(i for i, b in bounds.iteritems() if rectangle_intersects(b, rect))
+                self.assertEquals(expected, qtree.find_intersect(rect))
+
+    def test_grow_does_not_clip(self):
+        qtree = Quadtree((0, 0, 100, 100), capacity=10, grow=True)
+        qtree.add(1, (-100, -100, 120, 120))
+        self.assertEquals((-100, -100, 120, 120), qtree.get_clipped_bounds(1))
+        self.assertEquals(set([1]), qtree.find_point(-90, -90))
+
+    def test_soft_bounds(self):
+        import random
+        r = random.Random(5)
+        qtree = Quadtree((0, 0, 100, 100), grow=True)
+        bounds = {}
+        for n in range(500):
+            i = r.randint(0, 30)
+            if i in bounds and r.random() < 0.3:
+                qtree.remove(i)
+                del bounds[i]
+            else:
+                b = (r.uniform(-100, 100), r.uniform(-100, 100), r.uniform(0, 50), r.uniform(0, 50))
+                qtree.add(i, b)
+                bounds[i] = b
+            if bounds:
+                x0 = min(b[0] for b in bounds.values())
+                y0 = min(b[1] for b in bounds.values())
+                x1 = max(b[0] + b[2] for b in bounds.values())
+                y1 = max(b[1] + b[3] for b in bounds.values())
+                self.assertEquals((x0, y0, x1 - x0, y1 - y0), qtree.soft_bounds)
+            else:
+                self.assertEquals((0, 0, 0, 0), qtree.soft_bounds)
+
+    def test_soft_bounds_are_cached(self):
+        qtree = Quadtree((0, 0, 100, 100))
+        for i in range(20):
+            qtree.add(i, (i * 5, i * 5, 5, 5))
+        qtree.add('edge', (-10, 0, 110, 100))
+        self.assertEquals((-10, 0, 110, 100), qtree.soft_bounds)
+        buckets = qtree._bucket._buckets
+        assert buckets
+
+        # 'edge' lives in the top-level bucket: sub-buckets are not reset
+        qtree.remove('edge')
+        assert qtree._bucket.extents is None
+        assert None not in [b.extents for b in buckets]
+        self.assertEquals((0, 0, 100, 100), qtree.soft_bounds)
+
+        # Only the buckets on the path of the moved item are reset
+        bucket = qtree._bucket.find_bucket(qtree.get_clipped_bounds(19))
+        qtree.add(19, (90, 90, 5, 5))
+        assert bucket.extents is None
+        assert [b for b in buckets if b.extents is not None]
+        self.assertEquals((0, 0, 95, 95), qtree.soft_bounds)
+
+    def test_soft_bounds_outside(self):
+        qtree = Quadtree((0, 0, 100, 100))
+        qtree.add('in', (10, 10, 10, 10))
+        qtree.add('out', (200, 200, 10, 10))
+        self.assertEquals((10, 10, 200, 200), qtree.soft_bounds)
+        qtree.add('out', (50, 50, 10, 10))
+        self.assertEquals((10, 10, 50, 50), qtree.soft_bounds)
+        qtree.add('out', (-50, 50, 10, 10))
+        self.assertEquals((-50, 10, 70, 50), qtree.soft_bounds)
+        qtree.remove('out')
+        self.assertEquals((10, 10, 10, 10), qtree.soft_bounds)
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -0,0 +1,80 @@
+import unittest
+import threading
+import cairo
+from gaphas.util import text_cache, text_extents, text_align, text_set_font, TextCache
+
+
+def create_context():
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 100, 100)
+    return cairo.Context(surface)
+
+
+class TextCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        text_cache.clear()
+        text_cache.hits = text_cache.misses = 0
+
+    def test_text_extents_are_cached(self):
+        cr = create_context()
+        size = text_extents(cr, 'Label', font='sans 10')
+        hits = text_cache.hits
+        assert text_extents(cr, 'Label', font='sans 10') == size
+        assert text_cache.hits == hits + 1
+
+        # Font and multiline flag are part of the key
+        misses = text_cache.misses
+        larger = text_extents(cr, 'Label', font='sans 20')
+        assert larger[0] > size[0], (larger, size)
+        text_extents(cr, 'Label', font='sans 10', multiline=True)
+        assert text_cache.misses == misses + 2
+
+    def test_text_align_is_cached(self):
+        cr = create_context()
+        text_align(cr, 50, 50, 'Label')
+        hits = text_cache.hits
+        text_align(cr, 50, 50, 'Label')
+        assert text_cache.hits == hits + 1
+
+        # A different font size is measured again
+        misses = text_cache.misses
+        text_set_font(cr, 'sans 20')
+        text_align(cr, 50, 50, 'Label')
+        assert text_cache.misses == misses + 1
+
+    def test_font_face_is_part_of_the_key(self):
+        cr = create_context()
+        text_set_font(cr, 'sans 10')
+        text_extents(cr, 'Label Label')
+        text_set_font(cr, 'sans bold 10')
+        text_extents(cr, 'Label Label')
+        assert text_cache.hits == 0, text_cache.stats()
+        assert len(text_cache.keys()) == 2
+        cr.select_font_face('serif')
+        cr.set_font_size(10)
+        text_extents(cr, 'Label Label')
+        assert len(text_cache.keys()) == 3
+
+    def test_threads(self):
+        cache = TextCache(size=16)
+        errors = []
+
+        def fill(n):
+            try:
+                for i in xrange(2000):
+                    key = (n, i % 50)
+                    if cache.get(key) is None:
+                        cache.put(key, (i, i))
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=fill, args=(n,)) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert not errors, errors
+        assert len(cache.keys()) <= 16
+
+
+# vim:sw=4:et:ai
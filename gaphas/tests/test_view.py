@@ -11,6 +11,26 @@ from gaphas.item import Line
 from gaphas.examples import Box
 from gaphas.tool import HoverTool
 
+from gaphas.aspect import LevelOfDetail, ItemLevelOfDetail
+
+
+class SmallBox(Box):
+    pass
+
+
+@LevelOfDetail.when_type(SmallBox)
+class SmallBoxLevelOfDetail(ItemLevelOfDetail):
+    """
+    Level of detail used by the tests. Registered once, for a type only
+    used in the tests.
+    """
+    threshold = 0.25
+    handle_threshold = 0.25
+    drawn = []
+
+    def draw(self, context):
+        self.drawn.append(context.scale)
+
 
 class ViewTestCase(unittest.TestCase):
 
@@ -85,6 +105,96 @@ class ViewTestCase(unittest.TestCase):
 
         window.destroy()
 
+    def test_spatial_index(self):
+        import cairo
+        from gaphas.arrayindex import ArrayIndex
+        from gaphas.painter import ItemPainter
+
+        index = ArrayIndex()
+        canvas = Canvas()
+        view = View(canvas, spatial_index=index)
+        view.painter = ItemPainter()
+        assert view._qtree is index
+
+        box = Box(20, 20)
+        box.matrix.translate(10, 10)
+        canvas.add(box)
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 0, 0)
+        view.update_bounding_box(cairo.Context(surface))
+
+        assert box in index
+        assert view.get_item_at_point((20, 20)) is box
+        assert view.get_item_at_point((50, 50)) is None
+
+    def test_get_item_at_point_stacked(self):
+        canvas = Canvas()
+        view = GtkView(canvas)
+        window = gtk.Window(gtk.WINDOW_TOPLEVEL)
+        window.add(view)
+        window.show_all()
+
+        parent = Box(100, 100)
+        canvas.add(parent)
+        boxes = [parent]
+        for i in range(5):
+            box = Box(100, 100)
+            canvas.add(box, parent=boxes[-1])
+            boxes.append(box)
+        top = Box(100, 100)
+        canvas.add(top)
+
+        while gtk.events_pending():
+            gtk.main_iteration()
+
+        assert view.get_item_at_point((50, 50)) is top
+        view.select_item(top)
+        assert view.get_item_at_point((50, 50), selected=False) is boxes[-1]
+
+        window.destroy()
+
+    def test_get_item_at_point_cache(self):
+        canvas = Canvas()
+        view = GtkView(canvas)
+        window = gtk.Window(gtk.WINDOW_TOPLEVEL)
+        window.add(view)
+        window.show_all()
+
+        box = Box(100, 100)
+        canvas.add(box)
+        small = Box(10, 10)
+        small.matrix.translate(80, 80)
+        canvas.add(small)
+
+        while gtk.events_pending():
+            gtk.main_iteration()
+
+        assert view.get_item_at_point((20, 20)) is box
+
+        queries = []
+        find_point = view._qtree.find_point
+        view._qtree.find_point = lambda *pos: queries.append(pos) or find_point(*pos)
+
+        # Within the area owned by box
+        assert view.get_item_at_point((30, 40)) is box
+        assert not queries
+
+        # In the area of an item on top
+        assert view.get_item_at_point((85, 85)) is small
+        assert len(queries) == 1
+
+        # Canvas updates drop the cache
+        assert view.get_item_at_point((86, 86)) is small
+        assert len(queries) == 1
+        small.matrix.translate(-80, -80)
+        canvas.request_matrix_update(small)
+        canvas.update_now()
+        while gtk.events_pending():
+            gtk.main_iteration()
+        assert view.get_item_at_point((86, 86)) is box
+        assert len(queries) == 2
+
+        window.destroy()
+
     def test_get_handle_at_point(self):
         canvas = Canvas()
         view = GtkView(canvas)
@@ -123,6 +233,472 @@ class ViewTestCase(unittest.TestCase):
         assert i is box
         assert h is box.handles()[0]
 
+    def test_get_handle_at_point_uses_handle_index(self):
+        canvas = Canvas()
+        view = GtkView(canvas)
+        window = gtk.Window(gtk.WINDOW_TOPLEVEL)
+        window.add(view)
+        window.show_all()
+
+        box1 = Box(20, 20)
+        box2 = Box(20, 20)
+        box2.matrix.translate(22, 22)
+        canvas.add(box1)
+        canvas.add(box2)
+
+        while gtk.events_pending():
+            gtk.main_iteration()
+
+        # Handles of both boxes are near: the nearest of the topmost item
+        i, h = view.get_handle_at_point((21, 21))
+        assert i is box2 and h is box2.handles()[0], (i, h)
+
+        # The focused item is preferred
+        view.focused_item = box1
+        i, h = view.get_handle_at_point((21, 21))
+        assert i is box1 and h is box1.handles()[2], (i, h)
+
+        # The index follows the items
+        box2.matrix.translate(100, 0)
+        canvas.request_matrix_update(box2)
+        canvas.update_now()
+        while gtk.events_pending():
+            gtk.main_iteration()
+        assert view.get_handle_at_point((27, 27)) == (None, None)
+        i, h = view.get_handle_at_point((123, 23))
+        assert i is box2 and h is box2.handles()[0], (i, h)
+
+        canvas.remove(box2)
+        while gtk.events_pending():
+            gtk.main_iteration()
+        assert view.get_handle_at_point((123, 23)) == (None, None)
+
+        window.destroy()
+
+    def test_get_port_at_point(self):
+        """
+        The port closest to the point is returned, even when other items
+        are near as well.
+        """
+        canvas = Canvas()
+        view = GtkView(canvas)
+        window = gtk.Window(gtk.WINDOW_TOPLEVEL)
+        window.add(view)
+        window.show_all()
+
+        box1 = Box(20, 20)
+        canvas.add(box1)
+        box2 = Box(20, 20)
+        box2.matrix.translate(25, 0)
+        canvas.add(box2)
+
+        # Process pending (expose) events, which cause the canvas to be drawn.
+        while gtk.events_pending():
+            gtk.main_iteration()
+
+        item, port, glue_pos = view.get_port_at_point((21, 10))
+        assert item is box1, item
+        assert port is box1.ports()[1], port
+        self.assertEquals((20, 10), glue_pos)
+
+        item, port, glue_pos = view.get_port_at_point((24, 10))
+        assert item is box2, item
+        assert port is box2.ports()[3], port
+
+        item, port, glue_pos = view.get_port_at_point((24, 10), exclude=(box2,))
+        assert item is box1, item
+
+        item, port, glue_pos = view.get_port_at_point((100, 100))
+        assert item is None and port is None and glue_pos is None
+
+        window.destroy()
+
+    def test_port_index_follows_items(self):
+        canvas = Canvas()
+        view = GtkView(canvas)
+        window = gtk.Window(gtk.WINDOW_TOPLEVEL)
+        window.add(view)
+        window.show_all()
+
+        box = Box(20, 20)
+        canvas.add(box)
+        while gtk.events_pending():
+            gtk.main_iteration()
+
+        item, port, glue_pos = view.get_port_at_point((21, 10))
+        assert item is box and port is box.ports()[1], (item, port)
+
+        box.matrix.translate(100, 0)
+        canvas.request_matrix_update(box)
+        canvas.update_now()
+        while gtk.events_pending():
+            gtk.main_iteration()
+
+        item, port, glue_pos = view.get_port_at_point((21, 10))
+        assert item is None, item
+        item, port, glue_pos = view.get_port_at_point((121, 10))
+        assert item is box and port is box.ports()[1], (item, port)
+        self.assertEquals((120, 10), glue_pos)
+
+        window.destroy()
+
+    def test_zoom_keeps_canvas_bounds(self):
+        """
+        Bounding boxes are stored in canvas coordinates, zooming and
+        scrolling do not change them.
+        """
+        canvas = Canvas()
+        view = GtkView(canvas)
+        window = gtk.Window(gtk.WINDOW_TOPLEVEL)
+        window.add(view)
+        window.show_all()
+
+        box = Box(20, 20)
+        box.matrix.translate(10, 10)
+        canvas.add(box)
+
+        while gtk.events_pending():
+            gtk.main_iteration()
+
+        bounds = view._qtree.get_bounds(box)
+        view_bounds = view.get_item_bounding_box(box)
+
+        view.zoom(2)
+        while gtk.events_pending():
+            gtk.main_iteration()
+
+        assert view._qtree.get_bounds(box) == bounds
+        assert view.get_item_bounding_box(box).width > view_bounds.width
+        assert view.get_item_at_point((50, 50)) is box
+        assert view.get_item_at_point((15, 15)) is None
+
+        window.destroy()
+
+    def test_scrolling_does_not_refresh(self):
+        canvas = Canvas()
+        view = GtkView(canvas)
+        window = gtk.Window(gtk.WINDOW_TOPLEVEL)
+        window.add(view)
+        window.show_all()
+
+        while gtk.events_pending():
+            gtk.main_iteration()
+
+        refreshed = []
+        view.queue_draw_refresh = lambda: refreshed.append(True)
+
+        view.matrix.translate(10, -5)
+        view.update_view_matrix()
+        assert not refreshed
+
+        view.zoom(2)
+        assert refreshed
+
+        window.destroy()
+
+    def test_scrolling_moves_damage(self):
+        canvas = Canvas()
+        view = GtkView(canvas)
+        window = gtk.Window(gtk.WINDOW_TOPLEVEL)
+        window.add(view)
+        window.show_all()
+
+        while gtk.events_pending():
+            gtk.main_iteration()
+
+        # Damage not yet queued is moved along with the window content
+        view._damage.add((10, 10, 5, 5))
+        view.matrix.translate(10, -5)
+        view.update_view_matrix()
+        assert view._damage.rectangles() == [(20, 5, 5, 5)], view._damage.rectangles()
+
+        window.destroy()
+
+    def test_damage_is_not_merged_over_distance(self):
+        canvas = Canvas()
+        view = GtkView(canvas)
+        window = gtk.Window(gtk.WINDOW_TOPLEVEL)
+        window.add(view)
+        window.show_all()
+
+        box1 = Box(10, 10)
+        box2 = Box(10, 10)
+        box2.matrix.translate(400, 400)
+        canvas.add(box1)
+        canvas.add(box2)
+
+        while gtk.events_pending():
+            gtk.main_iteration()
+
+        areas = []
+        view.queue_draw_area = lambda *area: areas.append(area)
+        view.queue_draw_item(box1, box2)
+        view.queue_draw_item(box1)
+        while gtk.events_pending():
+            gtk.main_iteration()
+
+        assert len(areas) == 2, areas
+        for x, y, w, h in areas:
+            assert w < 100 and h < 100, areas
+        stats = view.damage_stats
+        assert stats['redundant'] == 0, stats
+
+        window.destroy()
+
+    def test_lazy_bounding_boxes(self):
+        canvas = Canvas()
+        view = GtkView(canvas)
+        view.lazy_bounding_boxes = True
+        window = gtk.Window(gtk.WINDOW_TOPLEVEL)
+        window.add(view)
+        window.set_default_size(200, 200)
+        window.show_all()
+
+        near = Box(20, 20)
+        far = Box(20, 20)
+        far.matrix.translate(5000, 5000)
+        canvas.add(near)
+        canvas.add(far)
+
+        while gtk.events_pending():
+            gtk.main_iteration()
+
+        assert view.estimated_items == set([far]), view.estimated_items
+        assert tuple(view.get_canvas_bounding_box(far)) == (5000, 5000, 20, 20), view.get_canvas_bounding_box(far)
+
+        # Scroll the far item into view
+        view.matrix.translate(-4950, -4950)
+        view.update_view_matrix()
+        while gtk.events_pending():
+            gtk.main_iteration()
+
+        assert not view.estimated_items, view.estimated_items
+
+        window.destroy()
+
+    def test_tile_cache(self):
+        from gaphas.tilecache import TileCache
+        canvas = Canvas()
+        view = GtkView(canvas)
+        view.tile_cache = TileCache(tile_size=64)
+        window = gtk.Window(gtk.WINDOW_TOPLEVEL)
+        window.add(view)
+        window.show_all()
+
+        box = Box(20, 20)
+        canvas.add(box)
+
+        while gtk.events_pending():
+            gtk.main_iteration()
+
+        scale = tuple(view.matrix)[:4] + (0, 0)
+        assert (scale, 0, 0) in view.tile_cache.keys(), view.tile_cache.keys()
+
+        box.matrix.translate(100, 100)
+        canvas.request_matrix_update(box)
+        canvas.update_now()
+        while gtk.events_pending():
+            gtk.main_iteration()
+
+        # The tile at the old location is rendered again
+        assert view.tile_cache.stats()['misses'] > 1
+
+        # Tiles are aligned to whole pixels
+        view.matrix.translate(10.5, 0.25)
+        view.update_view_matrix()
+        while gtk.events_pending():
+            gtk.main_iteration()
+        scale = tuple(view.matrix)[:4] + (0.5, 0.25)
+        assert (scale, 0, 0) in view.tile_cache.keys(), view.tile_cache.keys()
+
+        window.destroy()
+
+    def test_cached_item_painter(self):
+        import weakref
+        from gaphas.painter import PainterChain, CachedItemPainter
+        canvas = Canvas()
+        view = GtkView(canvas)
+        painter = CachedItemPainter()
+        view.painter = PainterChain().append(painter)
+        window = gtk.Window(gtk.WINDOW_TOPLEVEL)
+        window.add(view)
+        window.show_all()
+
+        box = Box(20, 20)
+        canvas.add(box)
+
+        while gtk.events_pending():
+            gtk.main_iteration()
+        assert weakref.ref(box) in painter._cache
+        misses = painter.misses
+
+        # Moving the item does not require drawing it again
+        box.matrix.translate(10, 10)
+        canvas.request_matrix_update(box)
+        view.queue_draw_refresh()
+        while gtk.events_pending():
+            gtk.main_iteration()
+        assert painter.misses == misses
+        assert painter.hits > 0
+
+        # Updated items are drawn again
+        box.request_update()
+        view.queue_draw_refresh()
+        while gtk.events_pending():
+            gtk.main_iteration()
+        assert painter.misses == misses + 1, painter.misses
+
+        # So are items with a new bounding box
+        bounds = view.get_item_bounding_box(box)
+        view.set_item_bounding_box(box, bounds + (0, 0, bounds.x1 + 10, bounds.y1))
+        view.queue_draw_refresh()
+        while gtk.events_pending():
+            gtk.main_iteration()
+        assert painter.misses == misses + 2, painter.misses
+
+        window.destroy()
+
+    def test_cached_item_painter_evicts_least_recently_used(self):
+        import cairo
+        import weakref
+        from gaphas.painter import CachedItemPainter
+
+        canvas = Canvas()
+        boxes = [Box(20, 20) for i in range(5)]
+        for i, box in enumerate(boxes):
+            box.matrix.translate(i * 50, 0)
+            canvas.add(box)
+        view = View(canvas)
+        painter = CachedItemPainter()
+        view.painter = painter
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 300, 100)
+        view.update_bounding_box(cairo.Context(surface))
+
+        def paint(*items):
+            painter.paint(Context(cairo=cairo.Context(surface),
+                                  items=items, area=None))
+
+        paint(boxes[0])
+        size = painter.memory()
+        assert size > 0
+        painter.max_memory = size * 4
+
+        paint(*boxes[:4])
+        assert painter.memory() == size * 4, painter.memory()
+        paint(boxes[0])
+        paint(boxes[4])
+        assert painter.memory() == size * 4, painter.memory()
+        assert weakref.ref(boxes[0]) in painter._cache
+        assert weakref.ref(boxes[1]) not in painter._cache
+
+    def test_level_of_detail(self):
+        canvas = Canvas()
+        view = GtkView(canvas)
+        window = gtk.Window(gtk.WINDOW_TOPLEVEL)
+        window.add(view)
+        window.show_all()
+
+        box = SmallBox(200, 200)
+        canvas.add(box)
+        del SmallBoxLevelOfDetail.drawn[:]
+
+        while gtk.events_pending():
+            gtk.main_iteration()
+        assert not SmallBoxLevelOfDetail.drawn
+
+        view.zoom(0.1)
+        while gtk.events_pending():
+            gtk.main_iteration()
+        drawn = SmallBoxLevelOfDetail.drawn
+        assert drawn
+        assert abs(drawn[-1] - 0.1) < 0.0001, drawn
+
+        window.destroy()
+
+    def test_level_of_detail_is_off_by_default(self):
+        import cairo
+        from gaphas.painter import HandlePainter
+
+        drawn = []
+        class DrawnBox(Box):
+            def draw(self, context):
+                drawn.append(context.scale)
+
+        canvas = Canvas()
+        box = DrawnBox(200, 200)
+        small = SmallBox(200, 200)
+        canvas.add(box)
+        canvas.add(small)
+        view = View(canvas)
+        view.zoom(0.1)
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 100, 100)
+        view.update_bounding_box(cairo.Context(surface))
+        view.paint(cairo.Context(surface))
+        assert drawn
+
+        # Handles are left out for SmallBox only
+        painter = HandlePainter(view)
+        assert painter._show_handles(box)
+        assert not painter._show_handles(small)
+
+    def test_progressive_painting(self):
+        canvas = Canvas()
+        view = GtkView(canvas)
+        view.frame_budget = 0
+        window = gtk.Window(gtk.WINDOW_TOPLEVEL)
+        window.add(view)
+        window.show_all()
+
+        for i in range(view.PAINT_CHUNK * 2 + 1):
+            box = Box(10, 10)
+            box.matrix.translate(i % 20, i % 20)
+            canvas.add(box)
+
+        while gtk.events_pending():
+            gtk.main_iteration()
+
+        stats = view.frame_stats
+        assert stats['frames'] > 0, stats
+        assert stats['passes'] == 3, stats
+        assert not view._paint_job
+
+        window.destroy()
+
+    def test_progressive_painting_expose_during_job(self):
+        from gaphas.geometry import Rectangle
+        canvas = Canvas()
+        view = GtkView(canvas)
+        view.frame_budget = 0
+        window = gtk.Window(gtk.WINDOW_TOPLEVEL)
+        window.add(view)
+        window.show_all()
+
+        for i in range(view.PAINT_CHUNK * 2 + 1):
+            box = Box(10, 10)
+            box.matrix.translate(i % 20, i % 20)
+            canvas.add(box)
+
+        while gtk.events_pending():
+            gtk.main_iteration()
+
+        cr = view.window.cairo_create()
+        view._paint_progressive(cr, Rectangle(0, 0, 100, 100))
+        job = view._paint_job
+        assert job.index == view.PAINT_CHUNK
+
+        # An expose within the area of the job does not start over
+        view._paint_progressive(cr, Rectangle(0, 0, 20, 20))
+        assert view._paint_job is job
+        assert job.index == view.PAINT_CHUNK * 2
+
+        while gtk.events_pending():
+            gtk.main_iteration()
+
+        assert not view._paint_job
+        assert view.frame_stats['passes'] == 3, view.frame_stats
+
+        window.destroy()
+
     def test_item_removal(self):
         canvas = Canvas()
         view = GtkView(canvas)
@@ -161,8 +737,7 @@ class ViewTestCase(unittest.TestCase):
         canvas.add(box)
 
         # By default no complex updating/calculations are done:
-        assert not box._matrix_i2v.has_key(view)
-        assert not box._matrix_v2i.has_key(view)
+        assert box not in view._matrices
 
         # GTK view does register for updates though
 
@@ -170,28 +745,110 @@ class ViewTestCase(unittest.TestCase):
         assert len(canvas._registered_views) == 1
         
         # No entry, since GtkView is not realized and has no window
-        assert not box._matrix_i2v.has_key(view)
-        assert not box._matrix_v2i.has_key(view)
+        assert box not in view._matrices
 
         window = gtk.Window(gtk.WINDOW_TOPLEVEL)
         window.add(view)
         window.show_all()
 
         # Now everything is realized and updated
-        assert box._matrix_i2v.has_key(view)
-        assert box._matrix_v2i.has_key(view)
+        assert box in view._matrices
 
         view.canvas = None
         assert len(canvas._registered_views) == 0
 
-        assert not box._matrix_i2v.has_key(view)
-        assert not box._matrix_v2i.has_key(view)
+        assert box not in view._matrices
 
         view.canvas = canvas
         assert len(canvas._registered_views) == 1
 
-        assert box._matrix_i2v.has_key(view)
-        assert box._matrix_v2i.has_key(view)
+        assert box in view._matrices
+
+
+    def test_item_bounds_are_not_drawn(self):
+        import cairo
+        from gaphas.painter import ItemPainter
+
+        class CountingBox(Box):
+            drawn = 0
+            def draw(self, context):
+                CountingBox.drawn += 1
+                super(CountingBox, self).draw(context)
+
+        canvas = Canvas()
+        box = CountingBox(20, 10)
+        box.matrix.translate(10, 10)
+        canvas.add(box)
+        view = View(canvas)
+        view.painter = ItemPainter()
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 0, 0)
+        view.update_bounding_box(cairo.Context(surface))
+
+        assert CountingBox.drawn == 0
+        bounds = view.get_canvas_bounding_box(box)
+        assert tuple(bounds) == (9, 9, 22, 12), bounds
+
+
+    def test_bounding_box_of_item_drawing_nothing(self):
+        import cairo
+        from gaphas.item import Element
+
+        canvas = Canvas()
+        element = Element(20, 10)
+        element.matrix.translate(10, 10)
+        canvas.add(element)
+        view = View(canvas)
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 0, 0)
+        view.update_bounding_box(cairo.Context(surface))
+
+        bounds = view.get_canvas_bounding_box(element)
+        assert tuple(bounds) == (10, 10, 20, 10), bounds
+
+
+    def test_item_painter_reuses_draw_context(self):
+        import cairo
+        from gaphas.painter import ItemPainter
+
+        contexts = []
+        class RecordingBox(Box):
+            def draw(self, context):
+                contexts.append((context, context.selected))
+                super(RecordingBox, self).draw(context)
+
+        canvas = Canvas()
+        box1 = RecordingBox()
+        box2 = RecordingBox()
+        canvas.add(box1)
+        canvas.add(box2)
+        view = View(canvas)
+        view.select_item(box2)
+        painter = ItemPainter(view)
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 100, 100)
+
+        for i in range(2):
+            painter.paint(Context(cairo=cairo.Context(surface),
+                                  items=[box1, box2], area=None))
+        assert len(set(c for c, selected in contexts)) == 1
+        assert [selected for c, selected in contexts] == [False, True] * 2
+        assert painter.frame_stats['items'] == 2, painter.frame_stats
+        assert painter.frame_stats['contexts'] == 0, painter.frame_stats
+
+
+    def test_matrices_follow_view_matrix(self):
+        canvas = Canvas()
+        view = View(canvas)
+        box = Box()
+        box.matrix.translate(10, 10)
+        canvas.add(box)
+
+        assert tuple(view.get_matrix_i2v(box)) == (1, 0, 0, 1, 10, 10)
+        assert box in view._matrices
+
+        # Zooming outdates the matrices, they are calculated when needed
+        view.zoom(2)
+        assert box not in view._matrices
+        assert tuple(view.get_matrix_i2v(box)) == (2, 0, 0, 2, 20, 20)
+        assert tuple(view.get_matrix_v2i(box)) == (0.5, 0, 0, 0.5, -10, -10)
 
 
     def test_view_registration_2(self):
@@ -207,11 +864,8 @@ class ViewTestCase(unittest.TestCase):
         box = Box()
         canvas.add(box)
 
-        assert hasattr(box, '_matrix_i2v')
-        assert hasattr(box, '_matrix_v2i')
-
-        assert box._matrix_i2v[view]
-        assert box._matrix_v2i[view]
+        assert view._matrices.get_i2v(box)
+        assert view._matrices.get_v2i(box)
 
         assert len(canvas._registered_views) == 1
         assert view in canvas._registered_views
@@ -220,8 +874,7 @@ class ViewTestCase(unittest.TestCase):
 
         assert len(canvas._registered_views) == 0
 
-        assert not box._matrix_i2v.has_key(view)
-        assert not box._matrix_v2i.has_key(view)
+        assert box not in view._matrices
         
 
     def test_scroll_adjustments_signal(self):
@@ -0,0 +1,149 @@
+"""
+Tile cache
+==========
+
+A backing store for views: the rendered view is kept in square off-screen
+surfaces, tiles. On an expose event tiles are copied to the screen. Only
+tiles that are not in the cache are rendered.
+
+Tiles are identified by a key. `gaphas.view.GtkView` uses
+``(scale, column, row)``: the linear part of the view matrix and the
+sub-pixel part of its translation, so tiles can be reused while scrolling,
+and the tile position.
+
+Tiles also keep their bounds in canvas coordinates. Tiles are invalidated
+by canvas area, regardless of the zoom level they were rendered for.
+
+The amount of memory used by the tiles is limited. Least recently used tiles
+are dropped first.
+"""
+
+__version__ = "$Revision$"
+# $HeadURL$
+
+from collections import OrderedDict
+from geometry import rectangle_intersects
+
+
+class TileCache(object):
+    """
+    Least recently used cache of rendered tiles.
+
+    >>> cache = TileCache(tile_size=100, max_memory=100 * 100 * 4 * 2)
+    >>> cache.max_tiles
+    2
+    >>> cache.put('a', 'surface a', (0, 0, 10, 10))
+    >>> cache.put('b', 'surface b', (10, 0, 10, 10))
+    >>> cache.get('a')
+    'surface a'
+
+    A third tile does not fit, the least recently used tile is dropped:
+
+    >>> cache.put('c', 'surface c', (20, 0, 10, 10))
+    >>> cache.get('b')
+    >>> sorted(cache.keys())
+    ['a', 'c']
+
+    Tiles are invalidated by area (in canvas coordinates):
+
+    >>> cache.invalidate((5, 5, 10, 10))
+    >>> sorted(cache.keys())
+    ['c']
+    >>> sorted(cache.stats().items())
+    [('evictions', 1), ('hits', 1), ('memory', 40000), ('misses', 1), ('tiles', 1)]
+    """
+
+    def __init__(self, tile_size=256, max_memory=32 * 1024 * 1024):
+        self._tile_size = tile_size
+        self._max_memory = max_memory
+
+        # key -> (surface, canvas bounds), least recently used first
+        self._tiles = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    tile_size = property(lambda s: s._tile_size,
+                         doc="Width and height of a tile, in pixels")
+
+    max_memory = property(lambda s: s._max_memory,
+                          doc="Maximum amount of memory used by tiles, in bytes")
+
+    tile_memory = property(lambda s: s._tile_size * s._tile_size * 4,
+                           doc="Memory used by a (32 bits) tile")
+
+    max_tiles = property(lambda s: max(1, s._max_memory / s.tile_memory))
+
+
+    def get(self, key):
+        """
+        Return the surface for tile ``key``, or None if the tile is not
+        cached.
+        """
+        tiles = self._tiles
+        try:
+            tile = tiles.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        tiles[key] = tile
+        self.hits += 1
+        return tile[0]
+
+
+    def put(self, key, surface, bounds):
+        """
+        Add a tile to the cache. ``bounds`` are the bounds of the tile in
+        canvas coordinates (x, y, width, height).
+        """
+        tiles = self._tiles
+        tiles.pop(key, None)
+        max_tiles = self.max_tiles
+        while len(tiles) >= max_tiles:
+            self._evict()
+        tiles[key] = (surface, tuple(bounds))
+
+
+    def _evict(self):
+        """
+        Drop the least recently used tile.
+        """
+        self._tiles.popitem(last=False)
+        self.evictions += 1
+
+
+    def invalidate(self, bounds):
+        """
+        Drop all tiles intersecting with ``bounds`` (x, y, width, height), in
+        canvas coordinates.
+        """
+        tiles = self._tiles
+        for key in [k for k, t in tiles.iteritems() if rectangle_intersects(t[1], bounds)]:
+            del tiles[key]
+
+
+    def clear(self):
+        """
+        Drop all tiles.
+        """
+        self._tiles.clear()
+
+
+    def keys(self):
+        return self._tiles.keys()
+
+
+    def stats(self):
+        """
+        Return a dictionary with cache statistics.
+        """
+        return dict(tiles=len(self._tiles),
+                    memory=len(self._tiles) * self.tile_memory,
+                    hits=self.hits,
+                    misses=self.misses,
+                    evictions=self.evictions)
+
+
+# vim:sw=4:et:ai
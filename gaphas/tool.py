@@ -497,8 +497,7 @@ class PanTool(Tool):
             dx = self.x1 - self.x0
             dy = self.y1 - self.y0
             view._matrix.translate(dx/view._matrix[0], dy/view._matrix[3])
-            # Make sure everything's updated
-            view.request_update((), view._canvas.get_all_items())
+            view.update_view_matrix()
             self.x0 = self.x1
             self.y0 = self.y1
             return True
@@ -518,7 +517,7 @@ class PanTool(Tool):
             view._matrix.translate(0, self.speed/view._matrix[3])
         elif direction == gdk.SCROLL_DOWN:
             view._matrix.translate(0, -self.speed/view._matrix[3])
-        view.request_update((), view._canvas.get_all_items())
+        view.update_view_matrix()
         return True
 
 
@@ -572,8 +571,7 @@ class ZoomTool(Tool):
                 m.scale(factor, factor)
                 m.translate(+ox, +oy)
 
-                # Make sure everything's updated
-                view.request_update((), view._canvas.get_all_items())
+                view.update_view_matrix()
 
                 self.lastdiff = dy;
             return True
@@ -591,8 +589,7 @@ class ZoomTool(Tool):
             view._matrix.translate(-ox, -oy)
             view._matrix.scale(factor, factor)
             view._matrix.translate(+ox, +oy)
-            # Make sure everything's updated
-            view.request_update((), view._canvas.get_all_items())
+            view.update_view_matrix()
             return True
 
 
@@ -1,20 +1,167 @@
 """
 Helper functions and classes for Cairo (drawing engine used by the canvas).
+
+Text metrics are cached in `text_cache`. Text is measured in the update,
+bounding box and paint passes, so the same label is measured again and
+again. Metrics are cached by font (the font name, or the face and matrix
+of the context) and text. Text in a font face of which the family, slant
+and weight can not be determined is not cached.
 """
 
 __version__ = "$Revision$"
 # $HeadURL$
 
 from math import pi
+import threading
 import cairo
 
 
+class TextCache(object):
+    """
+    Least recently used cache of text metrics. At most ``size`` entries are
+    kept, a size of 0 disables the cache. The cache can be used by several
+    threads (see `export.TileRenderer`).
+
+    >>> cache = TextCache(size=4)
+    >>> cache.put('a', (10, 12))
+    >>> cache.put('b', (20, 12))
+    >>> cache.get('a')
+    (10, 12)
+    >>> cache.get('c')
+
+    The least recently used entries are dropped:
+
+    >>> for key in 'cde':
+    ...     cache.put(key, (0, 0))
+    >>> sorted(cache.keys())
+    ['a', 'c', 'd', 'e']
+    >>> sorted(cache.stats().items())
+    [('entries', 4), ('hit_rate', 0.5), ('hits', 1), ('misses', 1), ('size', 4)]
+    """
+
+    def __init__(self, size=1024):
+        self.size = size
+        # key -> [metrics, last access time]
+        self._entries = {}
+        self._clock = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, key):
+        """
+        Return the metrics stored for ``key``, or None.
+        """
+        self._lock.acquire()
+        try:
+            try:
+                entry = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._clock += 1
+            entry[1] = self._clock
+            self.hits += 1
+            return entry[0]
+        finally:
+            self._lock.release()
+
+
+    def put(self, key, metrics):
+        self._lock.acquire()
+        try:
+            entries = self._entries
+            if len(entries) >= self.size:
+                self._evict()
+            if self.size > 0:
+                self._clock += 1
+                entries[key] = [metrics, self._clock]
+        finally:
+            self._lock.release()
+
+
+    def _evict(self):
+        """
+        Drop the least recently used quarter of the entries (at least one),
+        so the entries are not sorted on every insert. Called with the
+        lock held.
+        """
+        entries = self._entries
+        n = len(entries) - self.size + max(1, self.size / 4)
+        for key in sorted(entries, key=lambda k: entries[k][1])[:n]:
+            del entries[key]
+
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+        finally:
+            self._lock.release()
+
+
+    def keys(self):
+        return self._entries.keys()
+
+
+    def stats(self):
+        """
+        Return a dictionary with cache statistics.
+        """
+        lookups = self.hits + self.misses
+        return dict(entries=len(self._entries),
+                    size=self.size,
+                    hits=self.hits,
+                    misses=self.misses,
+                    hit_rate=lookups and float(self.hits) / lookups or 0.0)
+
+
+text_cache = TextCache()
+
+
+def _font_key(cr):
+    """
+    Return a key for the current font of ``cr``: the family, slant and
+    weight of the face and the font matrix. None is returned if the face is
+    not a toy font face (see `text_set_font()`).
+    """
+    face = cr.get_font_face()
+    try:
+        face = face.get_family(), face.get_slant(), face.get_weight()
+    except AttributeError:
+        return None
+    return face + tuple(cr.get_font_matrix())
+
+
+def _text_extents(cr, text):
+    """
+    Return ``cr.text_extents(text)``, for the current font.
+    """
+    font = _font_key(cr)
+    if font is None:
+        return cr.text_extents(text)
+    key = (font, text)
+    extents = text_cache.get(key)
+    if extents is None:
+        extents = cr.text_extents(text)
+        text_cache.put(key, extents)
+    return extents
+
+
 def text_extents(cr, text, font=None, multiline=False, padding=1):
     """
     Simple way to determine the size of a piece of text.
     """
     if not text:
         return 0, 0
+    # The font name includes the size
+    key = (font or _font_key(cr), text, multiline, padding)
+    if key[0] is not None:
+        size = text_cache.get(key)
+        if size is not None:
+            return size
+
     if font:
         cr.save()
         text_set_font(cr, font)
@@ -31,6 +178,8 @@ def text_extents(cr, text, font=None, multiline=False, padding=1):
 
     if font:
         cr.restore()
+    if key[0] is not None:
+        text_cache.put(key, (width, height))
     return width, height
 
 
@@ -51,7 +200,7 @@ def text_align(cr, x, y, text, align_x=0, align_y=0, padding_x=0, padding_y=0):
     if not text:
         return
 
-    x_bear, y_bear, w, h, x_adv, y_adv = cr.text_extents(text)
+    x_bear, y_bear, w, h, x_adv, y_adv = _text_extents(cr, text)
     if align_x == 0:
         x = 0.5 - (w / 2 + x_bear) + x
     elif align_x < 0:
@@ -79,8 +228,9 @@ def text_multiline(cr, x, y, text, padding=1):
     """
     if not text: return
     #cr.move_to(x, y)
+    # Lines are spaced by the height of the complete text
+    x_bear, y_bear, w, h, x_adv, y_adv = _text_extents(cr, text)
     for line in text.split('\n'):
-        x_bear, y_bear, w, h, x_adv, y_adv = cr.text_extents(text)
         y += h
         cr.move_to(x, y)
         cr.show_text(line)
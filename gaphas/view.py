@@ -5,12 +5,21 @@ This module contains everything to display a Canvas on a screen.
 __version__ = "$Revision$"
 # $HeadURL$
 
+import time
+from math import floor
+from heapq import heapify, heappop
+from operator import attrgetter
 import gobject
 import gtk
+import cairo
 from cairo import Matrix
+from matrix import MatrixTable
 from canvas import Context
-from geometry import Rectangle, distance_point_point_fast
+from geometry import Rectangle, distance_point_point, distance_point_segments
+from geometry import transform_rectangle
+from connector import LinePort, PointPort
 from quadtree import Quadtree
+from damage import DamageRegion
 from tool import DefaultTool
 from painter import DefaultPainter, BoundingBoxPainter
 from decorators import async, PRIORITY_HIGH_IDLE
@@ -23,13 +32,36 @@ DEBUG_DRAW_QUADTREE = False
 # The default cursor (use in case of a cursor reset)
 DEFAULT_CURSOR = gtk.gdk.LEFT_PTR
 
+# Margin (in view coordinates) around the bounding boxes of items, wide
+# enough to contain the handles. See `painter.BoundingBoxPainter`.
+BOUNDING_BOX_MARGIN = 6
+
+
+def port_segment(port):
+    """
+    Return the line segment (start, end), in item coordinates, covered by
+    ``port`` if it is glued like a `LinePort` or a `PointPort`. None is
+    returned for other ports.
+    """
+    glue = type(port).glue
+    if glue == LinePort.glue:
+        return port.start, port.end
+    elif glue == PointPort.glue:
+        return port.point, port.point
+    return None
+
 
 class View(object):
     """
     View class for gaphas.Canvas objects. 
+
+    The bounding boxes of the items are kept in a spatial index, in canvas
+    coordinates. Hence scrolling and zooming do not require the index to be
+    updated. By default a `quadtree.Quadtree` is used. Another index, such as
+    `arrayindex.ArrayIndex`, can be provided as ``spatial_index``.
     """
 
-    def __init__(self, canvas=None):
+    def __init__(self, canvas=None, spatial_index=None):
         self._matrix = Matrix()
         self._painter = DefaultPainter(self)
         self._bounding_box_painter = BoundingBoxPainter(self)
@@ -42,9 +74,28 @@ class View(object):
         self._dropzone_item = None
         ###/
 
-        self._qtree = Quadtree()
+        if spatial_index is None:
+            spatial_index = Quadtree(grow=True)
+        self._qtree = spatial_index
         self._bounds = Rectangle(0, 0, 0, 0)
 
+        # Item to view matrices
+        self._matrices = MatrixTable()
+
+        # Items with estimated bounding boxes, see estimate_bounding_box()
+        self._estimated_items = set()
+
+        # Handle positions, see get_handle_at_point()
+        self._handle_index = Quadtree(grow=True)
+        self._handle_counts = {}
+
+        # Port segments, see get_port_at_point()
+        self._port_index = Quadtree(grow=True)
+        self._port_counts = {}
+
+        # Last item found by get_item_at_point() and the area it owns
+        self._hit_cache = None
+
         self._canvas = None
         if canvas:
             self._set_canvas(canvas)
@@ -54,13 +105,42 @@ class View(object):
                       doc="Canvas to view transformation matrix")
 
 
+    def get_matrix_v2c(self):
+        """
+        Get the View to Canvas matrix.
+        """
+        v2c = Matrix(*self._matrix)
+        v2c.invert()
+        return v2c
+
+
+    def _distance_v2c(self, distance):
+        """
+        Convert a distance in view coordinates to canvas coordinates.
+        """
+        dx, dy = self.get_matrix_v2c().transform_distance(distance, distance)
+        return max(abs(dx), abs(dy))
+
+
+    def _rect_v2c(self, rect, margin=0):
+        """
+        Convert a rectangle (x, y, width, height) in view coordinates to canvas
+        coordinates, used to query the spatial index. The bounding boxes in
+        the index lack the margin for the handles, therefore the rectangle
+        can be expanded with ``margin`` (view coordinates).
+        """
+        rect = Rectangle(*rect)
+        rect.expand(margin)
+        return transform_rectangle(self.get_matrix_v2c(), rect)
+
+
     def _set_canvas(self, canvas):
         """
         Use view.canvas = my_canvas to set the canvas to be rendered
         in the view.
         """
         if self._canvas:
-            self._qtree.clear()
+            self.clear_index()
             self._selected_items.clear()
             self._focused_item = None
             self._hovered_item = None
@@ -71,6 +151,22 @@ class View(object):
     canvas = property(lambda s: s._canvas, _set_canvas)
 
 
+    def clear_index(self):
+        """
+        Forget the bounding boxes and matrices of all items, as well as
+        the handle and port indexes. They are rebuilt by
+        `update_bounding_box()`.
+        """
+        self._qtree.clear()
+        self._matrices.clear()
+        self._estimated_items.clear()
+        self._handle_index.clear()
+        self._handle_counts.clear()
+        self._port_index.clear()
+        self._port_counts.clear()
+        self._hit_cache = None
+
+
     def emit(self, *args, **kwargs):
         """
         Placeholder method for signal emission functionality.
@@ -226,59 +322,140 @@ class View(object):
 
         Parameters:
          - selected: if False returns first non-selected item
+
+        The last item found is remembered, together with the area it
+        owns: its bounding box, except for the bounding boxes of the
+        items above it. As long as ``pos`` stays in that area, no spatial
+        query is needed.
         """
-        items = self._qtree.find_intersect((pos[0], pos[1], 1, 1))
-        for item in self._canvas.sort(items, reverse=True):
-            if not selected and item in self.selected_items:
+        cx, cy = self.get_matrix_v2c().transform_point(*pos)
+        if selected and self._hit_cache:
+            item = self._get_cached_item_at_point(pos, cx, cy)
+            if item:
+                return item
+
+        candidates = self._qtree.find_point(cx, cy)
+        if self._estimated_items:
+            estimated = self._estimated_items.intersection(candidates)
+            if estimated:
+                self.refine_bounding_box(estimated)
+
+        # Visit the items topmost first. Items below the topmost hit are
+        # not even ordered.
+        items = [(-item._canvas_index, item) for item in candidates]
+        heapify(items)
+        selected_items = self.selected_items
+        get_matrix_v2i = self.get_matrix_v2i
+        while items:
+            item = heappop(items)[1]
+            if not selected and item in selected_items:
                 continue  # skip selected items
 
-            v2i = self.get_matrix_v2i(item)
-            ix, iy = v2i.transform_point(*pos)
+            ix, iy = get_matrix_v2i(item).transform_point(*pos)
             if item.point((ix, iy)) < 0.5:
+                if selected:
+                    self._cache_item_at_point(item)
                 return item
         return None
 
 
+    def _cache_item_at_point(self, item):
+        """
+        Remember ``item`` and the bounding boxes (canvas coordinates) of
+        the items above it.
+        """
+        qtree = self._qtree
+        bounds = qtree.get_bounds(item)
+        index = item._canvas_index
+        above = [qtree.get_bounds(i) for i in qtree.find_intersect(bounds)
+                 if i._canvas_index > index]
+        self._hit_cache = item, bounds, above
+
+
+    def _get_cached_item_at_point(self, pos, cx, cy):
+        """
+        Return the cached item if it owns point ``pos`` (view coordinates),
+        ``(cx, cy)`` in canvas coordinates.
+        """
+        item, (x, y, w, h), above = self._hit_cache
+        if not (x <= cx <= x + w and y <= cy <= y + h):
+            return None
+        for x, y, w, h in above:
+            if x <= cx <= x + w and y <= cy <= y + h:
+                return None
+        ix, iy = self.get_matrix_v2i(item).transform_point(*pos)
+        if item.point((ix, iy)) < 0.5:
+            return item
+        return None
+
+
     def get_handle_at_point(self, pos, distance=6):
         """
         Look for a handle at ``pos`` and return the
         tuple (item, handle).
-        """
-        def find(item):
-            """ Find item's handle at pos """
-            v2i = self.get_matrix_v2i(item)
-            d = distance_point_point_fast(v2i.transform_distance(0, distance))
-            x, y = v2i.transform_point(*pos)
 
-            for h in item.handles():
-                if not h.movable:
-                    continue
-                hx, hy = h.pos
-                if -d < (hx - x) < d and -d < (hy - y) < d:
-                    return h
+        Handles are looked up in the handle index: the positions of the
+        handles in canvas coordinates, updated together with the bounding
+        boxes. Of each item the handle nearest to ``pos`` is used. The
+        focused item and the hovered item are preferred, then the topmost
+        item.
+        """
+        vx, vy = pos
+        index = self._handle_index
+        rect = self._rect_v2c((vx - distance, vy - distance, 2 * distance, 2 * distance))
+        c2v = self._matrix.transform_point
+
+        # item -> (distance, handle number, handle)
+        found = {}
+        for key in index.find_intersect(rect):
+            handle = index.get_data(key)
+            if not handle.movable:
+                continue
+            hx, hy = c2v(*index.get_bounds(key)[:2])
+            dx, dy = abs(hx - vx), abs(hy - vy)
+            if dx < distance and dy < distance:
+                item, n = key
+                d = dx * dx + dy * dy, n, handle
+                if item not in found or d < found[item]:
+                    found[item] = d
+        if not found:
+            return None, None
+
+        # The focused item is the prefered item for handle grabbing,
+        # then try hovered item
+        for item in (self.focused_item, self.hovered_item):
+            if item in found:
+                return item, found[item][2]
 
-        # The focused item is the prefered item for handle grabbing
-        if self.focused_item:
-            h = find(self.focused_item)
-            if h:
-                return self.focused_item, h
+        item = max(found, key=attrgetter('_canvas_index'))
+        return item, found[item][2]
 
-        # then try hovered item
-        if self.hovered_item:
-            h = find(self.hovered_item)
-            if h:
-                return self.hovered_item, h
 
-        # Last try all items, checking the bounding box first
-        x, y = pos
-        items = self.get_items_in_rectangle((x - distance, y - distance, distance * 2, distance * 2), reverse=True)
+    def _update_handle_index(self, item):
+        """
+        Store the positions of the handles of ``item`` (in canvas
+        coordinates) in the handle index. Handles are keyed by
+        ``(item, handle number)``.
+        """
+        index = self._handle_index
+        handles = item.handles()
+        count = self._handle_counts.get(item, 0)
+        for n in xrange(len(handles), count):
+            index.remove((item, n))
+        i2c = self.canvas.get_matrix_i2c(item).transform_point
+        for n, h in enumerate(handles):
+            x, y = i2c(*h.pos)
+            index.add((item, n), (x, y, 0, 0), h)
+        self._handle_counts[item] = len(handles)
 
-        found_item, found_h = None, None
-        for item in items:
-            h = find(item)
-            if h:
-                return item, h
-        return None, None
+
+    def _remove_handle_index(self, item):
+        """
+        Remove the handles of ``item`` from the handle index.
+        """
+        index = self._handle_index
+        for n in xrange(self._handle_counts.pop(item, 0)):
+            index.remove((item, n))
 
 
     def get_port_at_point(self, vpos, distance=10, exclude=None):
@@ -301,39 +478,100 @@ class View(object):
             Max distance from point to a port (default 10)
          exclude
             Set of items to ignore.
+
+        Ports are looked up in the port index. Line and point ports are
+        stored as line segments, their distances are calculated in one go.
+        Other ports are glued the usual way.
         """
-        v2i = self.get_matrix_v2i
         vx, vy = vpos
+        index = self._port_index
+        rect = self._rect_v2c((vx - distance, vy - distance, 2 * distance, 2 * distance))
+        c2v = self._matrix.transform_point
+
+        segments = []
+        segment_ports = []
+        other_ports = []
+        for key in index.find_intersect(rect):
+            i = key[0]
+            if exclude and i in exclude:
+                continue
+            p, segment = index.get_data(key)
+            if not p.connectable:
+                continue
+            if segment:
+                x0, y0 = c2v(*segment[:2])
+                x1, y1 = c2v(*segment[2:])
+                segments.append((x0, y0, x1, y1))
+                segment_ports.append((i, p))
+            else:
+                other_ports.append((i, p))
 
         max_dist = distance
         port = None
         glue_pos = None
         item = None
 
-        rect = (vx - distance, vy - distance, distance * 2, distance * 2)
-        items = self.get_items_in_rectangle(rect, reverse=True)
-        for i in items:
-            if i in exclude:
+        nearest = distance_point_segments(vpos, segments)
+        if nearest:
+            n, d, pos = nearest
+            if d < max_dist:
+                max_dist = d
+                item, port = segment_ports[n]
+                glue_pos = pos
+
+        v2i = self.get_matrix_v2i
+        for i, p in other_ports:
+            ix, iy = v2i(i).transform_point(vx, vy)
+            pg, d = p.glue((ix, iy))
+
+            # transform coordinates from connectable item space to view
+            # space
+            gx, gy = self.get_matrix_i2v(i).transform_point(*pg)
+            d = distance_point_point((gx, gy), vpos)
+            if d >= max_dist:
                 continue
-            for p in i.ports():
-                if not p.connectable:
-                    continue
 
-                ix, iy = v2i(i).transform_point(vx, vy)
-                pg, d = p.glue((ix, iy))
+            max_dist = d
+            item = i
+            port = p
+            glue_pos = gx, gy
+
+        return item, port, glue_pos
 
-                if d >= max_dist:
-                    continue
 
-                item = i
-                port = p
+    def _update_port_index(self, item):
+        """
+        Store the ports of ``item`` in the port index, keyed by
+        ``(item, port number)``. Line and point ports are stored as line
+        segments in canvas coordinates. Other ports get the bounding box of
+        the item.
+        """
+        index = self._port_index
+        ports = item.ports()
+        count = self._port_counts.get(item, 0)
+        for n in xrange(len(ports), count):
+            index.remove((item, n))
+        i2c = self.canvas.get_matrix_i2c(item).transform_point
+        for n, port in enumerate(ports):
+            segment = port_segment(port)
+            if segment:
+                x0, y0 = i2c(*segment[0])
+                x1, y1 = i2c(*segment[1])
+                segment = x0, y0, x1, y1
+                bounds = min(x0, x1), min(y0, y1), abs(x1 - x0), abs(y1 - y0)
+            else:
+                bounds = self._qtree.get_bounds(item)
+            index.add((item, n), bounds, (port, segment))
+        self._port_counts[item] = len(ports)
 
-                # transform coordinates from connectable item space to view
-                # space
-                i2v = self.get_matrix_i2v(i).transform_point
-                glue_pos = i2v(*pg)
 
-        return item, port, glue_pos
+    def _remove_port_index(self, item):
+        """
+        Remove the ports of ``item`` from the port index.
+        """
+        index = self._port_index
+        for n in xrange(self._port_counts.pop(item, 0)):
+            index.remove((item, n))
 
 
     def get_items_in_rectangle(self, rect, intersect=True, reverse=False):
@@ -342,9 +580,9 @@ class View(object):
         Items are automatically sorted in canvas' processing order.
         """
         if intersect:
-            items = self._qtree.find_intersect(rect)
+            items = self._qtree.find_intersect(self._rect_v2c(rect, BOUNDING_BOX_MARGIN))
         else:
-            items = self._qtree.find_inside(rect)
+            items = self._qtree.find_inside(self._rect_v2c(rect))
         return self._canvas.sort(items, reverse=reverse)
 
 
@@ -353,7 +591,7 @@ class View(object):
         Select all items who have their bounding box within the
         rectangle @rect.
         """
-        items = self._qtree.find_inside(rect)
+        items = self._qtree.find_inside(self._rect_v2c(rect))
         map(self.select_item, items)
 
 
@@ -363,31 +601,114 @@ class View(object):
         """
         # TODO: should the scale factor be clipped?
         self._matrix.scale(factor, factor)
+        self.update_view_matrix()
 
-        # Make sure everything's updated
-        #map(self.update_matrix, self._canvas.get_all_items())
-        self.request_update((), self._canvas.get_all_items())
+
+    def update_view_matrix(self):
+        """
+        Call this method after the view matrix (``view.matrix``) has been
+        changed, e.g. by scrolling or zooming.
+
+        Bounding boxes are kept in canvas coordinates, so they do not need
+        to be recalculated. Only the item matrices are reset. They are
+        calculated when needed.
+        """
+        # Outdate all item matrices at once; they are calculated when needed
+        self._matrices.invalidate()
+        self._bounds = self._rect_c2v(self._qtree.soft_bounds)
+
+
+    def _rect_c2v(self, rect):
+        """
+        Convert a bounding box from the spatial index (canvas coordinates)
+        to view coordinates, including the margin for handles.
+        """
+        bounds = transform_rectangle(self._matrix, rect)
+        bounds.expand(BOUNDING_BOX_MARGIN)
+        return bounds
 
 
     def set_item_bounding_box(self, item, bounds):
         """
         Update the bounding box of the item.
 
-        ``bounds`` is in view coordinates.
+        ``bounds`` is in view coordinates. It is stored in canvas
+        coordinates.
 
         Coordinates are calculated back to item coordinates, so matrix-only
         updates can occur.
         """
-        v2i = self.get_matrix_v2i(item).transform_point
-        ix0, iy0 = v2i(bounds.x, bounds.y)
-        ix1, iy1 = v2i(bounds.x1, bounds.y1)
-        self._qtree.add(item=item, bounds=bounds, data=(ix0, iy0, ix1, iy1))
+        v2i = self.get_matrix_v2i(item)
+        ibounds = transform_rectangle(v2i, bounds)
+        cbounds = transform_rectangle(self.canvas.get_matrix_i2c(item), ibounds)
+        self._hit_cache = None
+        self._estimated_items.discard(item)
+        self._qtree.add(item=item, bounds=cbounds,
+                        data=(ibounds.x, ibounds.y, ibounds.x1, ibounds.y1))
+        self._update_handle_index(item)
+        self._update_port_index(item)
+
+
+    def estimate_bounding_box(self, item):
+        """
+        Set an estimated bounding box for ``item``, without drawing it: the
+        extents of its handles, combined with its bounds (`Item.bounds()`)
+        or else its previous bounding box (if any).
+
+        The estimate is replaced by the real bounding box by
+        `refine_bounding_box()`.
+        """
+        xs = []
+        ys = []
+        for h in item.handles():
+            x, y = h.pos
+            xs.append(x)
+            ys.append(y)
+        ibounds = item.bounds()
+        if ibounds is not None:
+            x, y, w, h = ibounds
+            xs.extend((x, x + w))
+            ys.extend((y, y + h))
+        elif item in self._qtree:
+            x0, y0, x1, y1 = self._qtree.get_data(item)
+            xs.extend((x0, x1))
+            ys.extend((y0, y1))
+        if not xs:
+            xs = ys = [0]
+        x0, y0, x1, y1 = min(xs), min(ys), max(xs), max(ys)
+        cbounds = transform_rectangle(self.canvas.get_matrix_i2c(item),
+                                      (x0, y0, x1 - x0, y1 - y0))
+        self._hit_cache = None
+        self._estimated_items.add(item)
+        self._qtree.add(item=item, bounds=cbounds, data=(x0, y0, x1, y1))
+        self._update_handle_index(item)
+        self._update_port_index(item)
+
+
+    def refine_bounding_box(self, items):
+        """
+        Replace estimated bounding boxes by real ones. Placeholder, a plain
+        View always calculates real bounding boxes.
+        """
+        pass
+
+
+    estimated_items = property(lambda s: frozenset(s._estimated_items),
+            doc="Items with an estimated bounding box")
 
 
     def get_item_bounding_box(self, item):
         """
         Get the bounding box for the item, in view coordinates.
         """
+        return self._rect_c2v(self._qtree.get_bounds(item))
+
+
+    def get_canvas_bounding_box(self, item):
+        """
+        Get the bounding box for the item, in canvas coordinates. Unlike
+        `get_item_bounding_box()` no margin for the handles is added.
+        """
         return self._qtree.get_bounds(item)
 
 
@@ -409,7 +730,7 @@ class View(object):
                               area=None))
 
         # Update the view's bounding box with the rest of the items
-        self._bounds = Rectangle(*self._qtree.soft_bounds)
+        self._bounds = self._rect_c2v(self._qtree.soft_bounds)
 
 
     def paint(self, cr):
@@ -422,23 +743,28 @@ class View(object):
         """
         Get Item to View matrix for ``item``.
         """
-        if self not in item._matrix_i2v:
+        i2v = self._matrices.get_i2v(item)
+        if i2v is None:
             self.update_matrix(item)
-        return item._matrix_i2v[self]
+            i2v = self._matrices.get_i2v(item)
+        return i2v
 
 
     def get_matrix_v2i(self, item):
         """
         Get View to Item matrix for ``item``.
         """
-        if self not in item._matrix_v2i:
+        v2i = self._matrices.get_v2i(item)
+        if v2i is None:
             self.update_matrix(item)
-        return item._matrix_v2i[self]
+            v2i = self._matrices.get_v2i(item)
+        return v2i
 
 
     def update_matrix(self, item):
         """
-        Update item matrices related to view.
+        Update item matrices related to view. The view to item matrix is
+        calculated when needed.
         """
         matrix_i2c = self.canvas.get_matrix_i2c(item)
         try:
@@ -447,25 +773,35 @@ class View(object):
             # Fall back to old behaviour
             i2v = matrix_i2c * self._matrix
 
-        item._matrix_i2v[self] = i2v
-
-        v2i = Matrix(*i2v)
-        v2i.invert()
-        item._matrix_v2i[self] = v2i
+        self._matrices.set(item, i2v)
 
 
     def _clear_matrices(self):
         """
-        Clear registered data in Item's _matrix{i2c|v2i} attributes.
+        Forget all item matrices.
         """
-        for item in self.canvas.get_all_items():
-            try:
-                del item._matrix_i2v[self]
-                del item._matrix_v2i[self]
-            except KeyError:
-                pass
+        self._matrices.clear()
+
+
 
 
+class _PaintJob(object):
+    """
+    State of a progressive paint operation, see `GtkView.frame_budget`.
+    Items are painted on ``surface``, which covers ``area``. ``painted``
+    holds the items painted so far.
+    """
+
+    def __init__(self, area, surface, items):
+        self.area = area
+        self.surface = surface
+        self.items = items
+        self.item_set = set(items)
+        self.painted = set()
+        self.index = 0
+        self.time = 0.0
+        self.passes = 0
+
 
 
 class GtkView(gtk.DrawingArea, View):
@@ -478,11 +814,27 @@ class GtkView(gtk.DrawingArea, View):
     The widget already contains adjustment objects (`hadjustment`,
     `vadjustment`) to be used for scrollbars.
 
+    Rendered content can be kept in a `tilecache.TileCache`
+    (``view.tile_cache = TileCache()``). Expose events are then handled by
+    copying tiles from the cache. Only the invalidated tiles are rendered
+    again.
+
+    Huge diagrams can be painted progressively: set ``frame_budget`` to the
+    time (in seconds) an expose event may take. Items that are not painted
+    in time are shown as outlines and are painted in idle time.
+
+    With ``lazy_bounding_boxes`` set, only items near the visible area get
+    real (drawn) bounding boxes. The other items get estimated bounding
+    boxes, until they are scrolled into view or hit.
+
     This view registers itself on the canvas, so it will receive update events.
     """
 
     # Just defined a name to make GTK register this class.
     __gtype_name__ = 'GaphasView'
+
+    # Number of items painted between two checks of the frame budget
+    PAINT_CHUNK = 50
     
     # Signals: emited after the change takes effect.
     __gsignals__ = {
@@ -503,13 +855,24 @@ class GtkView(gtk.DrawingArea, View):
     }
 
 
-    def __init__(self, canvas=None, hadjustment=None, vadjustment=None):
+    def __init__(self, canvas=None, hadjustment=None, vadjustment=None,
+                 spatial_index=None):
         gtk.DrawingArea.__init__(self)
 
         self._dirty_items = set()
         self._dirty_matrix_items = set()
+        self._damage = DamageRegion()
+        self._lazy_bounding_boxes = False
+        self._tile_cache = None
+        self._frame_budget = None
+        self._paint_job = None
+        self._paint_job_id = None
+        self._frame_stats = dict(frames=0, passes=0, time=0.0, max_time=0.0)
+
+        View.__init__(self, canvas, spatial_index)
 
-        View.__init__(self, canvas)
+        # The view matrix the window content is drawn with
+        self._painted_matrix = tuple(self._matrix)
 
         self.set_flags(gtk.CAN_FOCUS)
         self.add_events(gtk.gdk.BUTTON_PRESS_MASK
@@ -550,6 +913,10 @@ class GtkView(gtk.DrawingArea, View):
             self._clear_matrices()
             self._canvas.unregister_view(self)
 
+        if self._tile_cache:
+            self._tile_cache.clear()
+        self._cancel_paint_job()
+
         super(GtkView, self)._set_canvas(canvas)
         
         if self._canvas:
@@ -572,6 +939,53 @@ class GtkView(gtk.DrawingArea, View):
     tool = property(lambda s: s._tool, _set_tool)
 
 
+    def _set_painter(self, painter):
+        """
+        Set the painter to use. Cached tiles are dropped.
+        """
+        super(GtkView, self)._set_painter(painter)
+        if self._tile_cache:
+            self._tile_cache.clear()
+        self._cancel_paint_job()
+        self.queue_draw_refresh()
+
+
+    painter = property(lambda s: s._painter, _set_painter)
+
+
+    def _set_tile_cache(self, tile_cache):
+        """
+        Set the tile cache (`tilecache.TileCache`) to use, None disables
+        tile caching.
+        """
+        self._tile_cache = tile_cache
+        self.queue_draw_refresh()
+
+
+    tile_cache = property(lambda s: s._tile_cache, _set_tile_cache)
+
+
+    def _set_frame_budget(self, budget):
+        """
+        Set the time (in seconds) painting may take, before the view is
+        updated and painting continues in idle time. None disables
+        progressive painting. Progressive painting is not used in
+        combination with a tile cache.
+        """
+        self._frame_budget = budget
+        self._cancel_paint_job()
+        self.queue_draw_refresh()
+
+
+    frame_budget = property(lambda s: s._frame_budget, _set_frame_budget)
+
+
+    frame_stats = property(lambda s: dict(s._frame_stats),
+            doc="""Statistics of progressive painting: number of frames,
+            passes and time (seconds) needed for the last frame and the
+            maximum time for a frame""")
+
+
     hadjustment = property(lambda s: s._hadjustment)
 
 
@@ -598,11 +1012,35 @@ class GtkView(gtk.DrawingArea, View):
         self.update_adjustments()
 
 
-    def zoom(self, factor):
+    def update_view_matrix(self):
         """
-        Zoom in/out by factor ``factor``.
+        The view matrix has changed: update the scrollbars and redraw the
+        view.
+
+        If the view is only scrolled, by whole pixels, the window content
+        is moved and only the newly exposed parts are redrawn.
         """
-        super(GtkView, self).zoom(factor)
+        super(GtkView, self).update_view_matrix()
+        self.update_adjustments()
+        self._refine_visible_items()
+
+        matrix = tuple(self._matrix)
+        old = self._painted_matrix
+        self._painted_matrix = matrix
+        # A half finished frame can not be scrolled
+        if self._cancel_paint_job():
+            old = ()
+        if self.window and matrix[:4] == old[:4]:
+            dx = matrix[4] - old[4]
+            dy = matrix[5] - old[5]
+            # Allow for rounding errors, e.g. PanTool translates by dx/scale
+            if abs(dx - round(dx)) < 1e-6 and abs(dy - round(dy)) < 1e-6:
+                dx, dy = int(round(dx)), int(round(dy))
+                # Areas queued for drawing are moved along with the window
+                # content, so move the areas yet to be queued too
+                self._damage.translate(dx, dy)
+                self.window.scroll(dx, dy)
+                return
         self.queue_draw_refresh()
 
 
@@ -615,7 +1053,7 @@ class GtkView(gtk.DrawingArea, View):
         vadjustment = self._vadjustment
 
         # canvas limits (in view coordinates)
-        c = Rectangle(*self._qtree.soft_bounds)
+        c = self._rect_c2v(self._qtree.soft_bounds)
 
         # view limits
         v = Rectangle(0, 0, allocation.width, allocation.height)
@@ -654,20 +1092,35 @@ class GtkView(gtk.DrawingArea, View):
         item as update areas. Of course with a pythonic flavor: update
         any number of items at once.
 
-        TODO: Should we also create a (sorted) list of items that need redrawal?
+        The areas are collected in a `damage.DamageRegion`, that is
+        flushed once per main loop iteration (see `flush_damage()`).
+        Nearby areas are merged, far apart areas are drawn separately.
         """
-        get_bounds = self._qtree.get_bounds
-        items = filter(None, items)
-        try:
-            # create a copy, otherwise we'll change the original rectangle
-            bounds = Rectangle(*get_bounds(items[0]))
-            for item in items[1:]:
-                bounds += get_bounds(item)
-            self.queue_draw_area(*bounds)
-        except IndexError:
-            pass
-        except KeyError:
-            pass # No bounds calculated yet? bummer.
+        get_bounds = self.get_item_bounding_box
+        damage = self._damage
+        for item in items:
+            if not item:
+                continue
+            try:
+                damage.add(get_bounds(item))
+            except KeyError:
+                pass # No bounds calculated yet? bummer.
+        if damage:
+            self.flush_damage()
+
+
+    @async(single=True, priority=PRIORITY_HIGH_IDLE)
+    def flush_damage(self):
+        """
+        Queue the collected damage areas for drawing.
+        """
+        for rect in self._damage.flush():
+            self.queue_draw_area(*rect)
+
+
+    damage_stats = property(lambda s: s._damage.stats(),
+            doc="""Statistics of the damage areas queued by
+            `queue_draw_item()`, see `damage.DamageRegion.stats()`""")
 
 
     def queue_draw_area(self, x, y, w, h):
@@ -675,11 +1128,17 @@ class GtkView(gtk.DrawingArea, View):
         Wrap draw_area to convert all values to ints.
         """
         try:
-            super(GtkView, self).queue_draw_area(int(x), int(y), int(w+1), int(h+1))
+            x, y, w, h = int(x), int(y), int(w+1), int(h+1)
+            super(GtkView, self).queue_draw_area(x, y, w, h)
         except OverflowError:
             # Okay, now the zoom factor is very large or something
             a = self.allocation
             super(GtkView, self).queue_draw_area(0, 0, a.width, a.height)
+            if self._tile_cache:
+                self._tile_cache.clear()
+        else:
+            if self._tile_cache:
+                self._tile_cache.invalidate(self._rect_v2c((x, y, w, h)))
 
 
     def queue_draw_refresh(self):
@@ -700,6 +1159,9 @@ class GtkView(gtk.DrawingArea, View):
         if matrix_only_items:
             self._dirty_matrix_items.update(matrix_only_items)
 
+        # Items may have been moved or reordered
+        self._hit_cache = None
+
         # Remove removed items:
         if removed_items:
             self._dirty_items.difference_update(removed_items)
@@ -707,6 +1169,10 @@ class GtkView(gtk.DrawingArea, View):
 
             for item in removed_items:
                 self._qtree.remove(item)
+                self._estimated_items.discard(item)
+                self._matrices.remove(item)
+                self._remove_handle_index(item)
+                self._remove_port_index(item)
                 self.selected_items.discard(item)
 
             if self.focused_item in removed_items:
@@ -746,11 +1212,13 @@ class GtkView(gtk.DrawingArea, View):
                     # Only matrix has changed, so calculate new bb based
                     # on quadtree data (= bb in item coordinates).
                     bounds = self._qtree.get_data(i)
-                    i2v = self.get_matrix_i2v(i).transform_point
-                    x0, y0 = i2v(bounds[0], bounds[1])
-                    x1, y1 = i2v(bounds[2], bounds[3])
-                    vbounds = Rectangle(x0, y0, x1=x1, y1=y1)
-                    self._qtree.add(i, vbounds, bounds)
+                    x0, y0, x1, y1 = bounds
+                    cbounds = transform_rectangle(self.canvas.get_matrix_i2c(i),
+                                                  (x0, y0, x1 - x0, y1 - y0))
+                    self._qtree.add(i, cbounds, bounds)
+                    self._update_handle_index(i)
+                    self._update_port_index(i)
+                    self._hit_cache = None
 
             self.queue_draw_item(*dirty_matrix_items)
 
@@ -765,6 +1233,22 @@ class GtkView(gtk.DrawingArea, View):
     def update_bounding_box(self, items):
         """
         Update bounding box is not necessary.
+
+        If ``lazy_bounding_boxes`` is set, only items near the visible area
+        get a real bounding box. Other items get an estimated bounding
+        box, see `View.estimate_bounding_box()`.
+        """
+        exact_items = items
+        if self._lazy_bounding_boxes:
+            exact_items = self._estimate_far_items(items)
+        self._update_bounding_box(exact_items)
+        self.queue_draw_item(*items)
+        self.update_adjustments()
+
+
+    def _update_bounding_box(self, items):
+        """
+        Calculate the bounding boxes of ``items`` right away.
         """
         cr = self.window.cairo_create()
 
@@ -775,8 +1259,63 @@ class GtkView(gtk.DrawingArea, View):
             super(GtkView, self).update_bounding_box(cr, items)
         finally:
             cr.restore()
-        self.queue_draw_item(*items)
-        self.update_adjustments()
+
+
+    def _get_lazy_area(self):
+        """
+        The area (in canvas coordinates) in which items get a real
+        bounding box: the visible area, extended by half its size on each
+        side.
+        """
+        a = self.allocation
+        w, h = a.width, a.height
+        return self._rect_v2c((-w / 2, -h / 2, w * 2, h * 2), BOUNDING_BOX_MARGIN)
+
+
+    def _estimate_far_items(self, items):
+        """
+        Estimate the bounding boxes of ``items``. Return the items near
+        the visible area, that need a real bounding box.
+        """
+        for item in items:
+            self.estimate_bounding_box(item)
+        return self._qtree.find_intersect(self._get_lazy_area()).intersection(items)
+
+
+    def refine_bounding_box(self, items):
+        """
+        Calculate the real bounding box of the ``items`` that have an
+        estimated bounding box.
+        """
+        items = self._estimated_items.intersection(items)
+        if items and self.window:
+            self._update_bounding_box(items)
+            self.queue_draw_item(*items)
+
+
+    @async(single=True)
+    def _refine_visible_items(self):
+        """
+        Items near the visible area should have real bounding boxes. Called
+        when the visible area changes.
+        """
+        if self._estimated_items and self.window:
+            self.refine_bounding_box(self._qtree.find_intersect(self._get_lazy_area()))
+
+
+    def _set_lazy_bounding_boxes(self, lazy):
+        """
+        Only calculate real bounding boxes for items near the visible area.
+        When lazy bounding boxes are disabled, all estimated bounding boxes
+        are refined.
+        """
+        self._lazy_bounding_boxes = lazy
+        if not lazy:
+            self.refine_bounding_box(set(self._estimated_items))
+
+
+    lazy_bounding_boxes = property(lambda s: s._lazy_bounding_boxes,
+                                   _set_lazy_bounding_boxes)
 
 
     @nonrecursive
@@ -786,7 +1325,7 @@ class GtkView(gtk.DrawingArea, View):
         """
         gtk.DrawingArea.do_size_allocate(self, allocation)
         self.update_adjustments(allocation)
-        self._qtree.resize((0, 0, allocation.width, allocation.height))
+        self._refine_visible_items()
        
 
     def do_realize(self):
@@ -800,13 +1339,22 @@ class GtkView(gtk.DrawingArea, View):
 
     def do_unrealize(self):
         if self.canvas:
-            # Although Item._matrix_{i2v|v2i} keys are automatically removed
-            # (weak refs), better do it explicitly to be sure.
+            # The matrix table holds references to the items
             self._clear_matrices()
         self._qtree.clear()
+        self._estimated_items.clear()
+        self._handle_index.clear()
+        self._handle_counts.clear()
+        self._port_index.clear()
+        self._port_counts.clear()
+        self._hit_cache = None
 
         self._dirty_items.clear()
         self._dirty_matrix_items.clear()
+        self._damage.clear()
+        if self._tile_cache:
+            self._tile_cache.clear()
+        self._cancel_paint_job()
 
         self._canvas.unregister_view(self)
 
@@ -819,6 +1367,8 @@ class GtkView(gtk.DrawingArea, View):
         if not self._canvas:
             return
 
+        self._painted_matrix = tuple(self._matrix)
+
         area = event.area
         x, y, w, h = area.x, area.y, area.width, area.height
         cr = self.window.cairo_create()
@@ -828,9 +1378,14 @@ class GtkView(gtk.DrawingArea, View):
         cr.clip()
 
         area = Rectangle(x, y, width=w, height=h)
-        self._painter.paint(Context(cairo=cr,
-                                    items=self.get_items_in_rectangle(area),
-                                    area=area))
+        if self._tile_cache:
+            self._paint_tiles(cr, area)
+        elif self._frame_budget is not None:
+            self._paint_progressive(cr, area)
+        else:
+            self._painter.paint(Context(cairo=cr,
+                                        items=self.get_items_in_rectangle(area),
+                                        area=area))
 
         if DEBUG_DRAW_BOUNDING_BOX:
             cr.save()
@@ -843,19 +1398,238 @@ class GtkView(gtk.DrawingArea, View):
             cr.restore()
 
         # Draw Quadtree structure
-        if DEBUG_DRAW_QUADTREE:
+        if DEBUG_DRAW_QUADTREE and hasattr(self._qtree, '_bucket'):
             def draw_qtree_bucket(bucket):
                 cr.rectangle(*bucket.bounds)
                 cr.stroke()
                 for b in bucket._buckets:
                     draw_qtree_bucket(b)
+            cr.save()
+            cr.set_matrix(self._matrix)
             cr.set_source_rgb(0, 0, .8)
             cr.set_line_width(1.0)
             draw_qtree_bucket(self._qtree._bucket)
+            cr.restore()
+
+        return False
+
+
+    def _paint_tiles(self, cr, area):
+        """
+        Paint ``area`` (in view coordinates) from the tile cache. Missing
+        tiles are rendered first.
+
+        Tiles are positioned relative to the translation of the view matrix,
+        so they can be reused while scrolling. The tile grid is aligned to
+        whole device pixels, so tiles are copied without resampling. The
+        sub-pixel part of the translation is part of the tile key.
+        """
+        cache = self._tile_cache
+        size = cache.tile_size
+        xx, yx, xy, yy, tx, ty = tuple(self._matrix)
+        ox, oy = floor(tx), floor(ty)
+        scale = (xx, yx, xy, yy, tx - ox, ty - oy)
+
+        c0 = int(floor((area.x - ox) / size))
+        c1 = int(floor((area.x1 - ox) / size))
+        r0 = int(floor((area.y - oy) / size))
+        r1 = int(floor((area.y1 - oy) / size))
+        for column in xrange(c0, c1 + 1):
+            for row in xrange(r0, r1 + 1):
+                key = (scale, column, row)
+                x, y = column * size + ox, row * size + oy
+                surface = cache.get(key)
+                if surface is None:
+                    surface = self._render_tile(cr, x, y, size)
+                    cache.put(key, surface, self._rect_v2c((x, y, size, size)))
+                cr.set_source_surface(surface, x, y)
+                cr.paint()
+
+
+    def _render_tile(self, cr, x, y, size):
+        """
+        Render a tile located at (x, y) in view coordinates. A new surface,
+        similar to the target of ``cr``, is returned.
+        """
+        surface = cr.get_target().create_similar(cairo.CONTENT_COLOR_ALPHA, size, size)
+        # Painters set the view matrix, so shift the surface instead
+        surface.set_device_offset(-x, -y)
+        tile_cr = cairo.Context(surface)
+        area = Rectangle(x, y, size, size)
+        tile_cr.rectangle(*area)
+        tile_cr.clip()
+        self._painter.paint(Context(cairo=tile_cr,
+                                    items=self.get_items_in_rectangle(area),
+                                    area=area))
+        surface.set_device_offset(0, 0)
+        return surface
+
+
+    def _paint_progressive(self, cr, area):
+        """
+        Start painting ``area`` progressively. Items are painted on an
+        off-screen surface until the frame budget is spent. The rest is
+        painted in idle time (see `_paint_step()`).
 
+        If a job is running and ``area`` lies within the area of the job
+        (e.g. an item is hovered), only ``area`` is painted again and the
+        job continues. Otherwise the job starts over.
+        """
+        job = self._paint_job
+        if job and area in job.area:
+            self._repaint(job, area)
+            self._paint_step(cr, job)
+            return
+
+        job = self._cancel_paint_job()
+        if job:
+            # Start over, including the area that was not finished
+            area = area + job.area
+
+        x, y = int(area.x), int(area.y)
+        surface = cr.get_target().create_similar(cairo.CONTENT_COLOR,
+                                                 int(area.width), int(area.height))
+        # The surface replaces the window content
+        self._paint_background(cairo.Context(surface))
+
+        job = _PaintJob(Rectangle(x, y, int(area.width), int(area.height)),
+                        surface, self.get_items_in_rectangle(area))
+        self._paint_job = job
+        if self._paint_step(cr, job):
+            self._paint_job_id = gobject.idle_add(self._paint_idle)
+
+
+    def _paint_background(self, cr):
+        """
+        Fill (the clip area of) ``cr`` with the background color.
+        """
+        color = self.style.bg[gtk.STATE_NORMAL]
+        cr.set_source_rgb(color.red / 65535., color.green / 65535., color.blue / 65535.)
+        cr.paint()
+
+
+    def _repaint(self, job, rect):
+        """
+        Paint ``rect`` on the surface of ``job`` again. Only the items the
+        job has painted so far (and items added since the job started) are
+        painted, the job gets to the other items later.
+        """
+        area = job.area
+        surface = job.surface
+        surface.set_device_offset(-area.x, -area.y)
+        scr = cairo.Context(surface)
+        scr.rectangle(*rect)
+        scr.clip()
+        self._paint_background(scr)
+        painted = job.painted
+        item_set = job.item_set
+        items = [i for i in self.get_items_in_rectangle(rect)
+                 if i in painted or i not in item_set]
+        self._painter.paint_items(Context(cairo=scr, items=items, area=rect))
+        surface.set_device_offset(0, 0)
+
+
+    def _paint_step(self, cr, job):
+        """
+        Paint the next items of ``job`` until the frame budget is spent.
+        The result is shown on ``cr``: items that are not painted yet are
+        shown as outlines. Returns True if items are left to paint.
+        """
+        start = time.time()
+        area = job.area
+        items = job.items
+        canvas = self._canvas
+        chunk = self.PAINT_CHUNK
+
+        surface = job.surface
+        surface.set_device_offset(-area.x, -area.y)
+        scr = cairo.Context(surface)
+        paint_items = self._painter.paint_items
+        while job.index < len(items):
+            # Items may have been removed in the mean time
+            painted = [i for i in items[job.index:job.index + chunk] if i.canvas is canvas]
+            paint_items(Context(cairo=scr, items=painted, area=area))
+            job.painted.update(painted)
+            job.index += chunk
+            if time.time() - start > self._frame_budget:
+                break
+        surface.set_device_offset(0, 0)
+
+        cr.save()
+        cr.set_operator(cairo.OPERATOR_SOURCE)
+        cr.set_source_surface(surface, area.x, area.y)
+        cr.paint()
+        cr.restore()
+
+        remaining = [i for i in items[job.index:] if i.canvas is canvas]
+        if remaining:
+            self._draw_placeholders(cr, remaining)
+
+        # Decorations, such as handles, are drawn on top
+        self._painter.paint(Context(cairo=cr, items=(), area=area))
+
+        job.time += time.time() - start
+        job.passes += 1
+        if remaining:
+            return True
+
+        stats = self._frame_stats
+        stats['frames'] += 1
+        stats['passes'] = job.passes
+        stats['time'] = job.time
+        stats['max_time'] = max(stats['max_time'], job.time)
+        self._paint_job = None
+        return False
+
+
+    def _paint_idle(self):
+        """
+        Continue painting the current paint job.
+        """
+        job = self._paint_job
+        if not job or not self.window:
+            self._paint_job_id = None
+            return False
+        cr = self.window.cairo_create()
+        cr.rectangle(*job.area)
+        cr.clip()
+        if self._paint_step(cr, job):
+            return True
+        self._paint_job_id = None
         return False
 
 
+    def _cancel_paint_job(self):
+        """
+        Stop painting progressively. The unfinished job is returned.
+        """
+        job = self._paint_job
+        if self._paint_job_id:
+            gobject.source_remove(self._paint_job_id)
+        self._paint_job = None
+        self._paint_job_id = None
+        return job
+
+
+    def _draw_placeholders(self, cr, items):
+        """
+        Draw outlines of ``items``, while they are not painted.
+        """
+        get_bounds = self.get_canvas_bounding_box
+        cr.save()
+        cr.set_matrix(self._matrix)
+        for item in items:
+            try:
+                cr.rectangle(*get_bounds(item))
+            except KeyError:
+                pass
+        cr.identity_matrix()
+        cr.set_source_rgb(.7, .7, .7)
+        cr.set_line_width(1.0)
+        cr.stroke()
+        cr.restore()
+
+
     def do_event(self, event):
         """
         Handle GDK events. Events are delegated to a `tool.Tool`.
@@ -883,10 +1657,8 @@ class GtkView(gtk.DrawingArea, View):
             m.translate(0, - adj.value)
         self._matrix *= m
 
-        # Force recalculation of the bounding boxes:
-        self.request_update((), self._canvas.get_all_items())
-
-        self.queue_draw_refresh()
+        # Bounding boxes are in canvas coordinates, only reset the matrices
+        self.update_view_matrix()
 
 
 # Set a signal to set adjustments. This way a ScrolledWindow can set its own